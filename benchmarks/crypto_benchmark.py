@@ -0,0 +1,81 @@
+"""
+Compare the per-turn encryption cost of the memory storage backends.
+
+A turn decrypts the user's memory when loading it and encrypts what changed
+when saving it. This times that for a realistic full memory (a full dialogue
+buffer and summary buffer) with:
+- blob/cryptocode: the whole memory dict as one cryptocode string
+- records/cryptocode: one cryptocode string per MemoryRecord
+- records/v2: one lliza.crypto v2 string per MemoryRecord
+
+Usage: python benchmarks/crypto_benchmark.py [--messages 50] [--bullets 40] [--turns 5]
+"""
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import time
+
+import cryptocode
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lliza"))
+from lliza import crypto  # noqa: E402
+
+SECRET = "benchmark-passphrase"
+
+def random_text(n_chars: int) -> str:
+    words = ["".join(random.choices(string.ascii_lowercase, k=random.randint(2, 9))) for _ in range(n_chars // 5)]
+    return " ".join(words)[:n_chars]
+
+def make_memory(n_messages: int, n_bullets: int):
+    dialogue = [{"role": "user" if i % 2 == 0 else "assistant",
+                 "content": random_text(random.randint(50, 500))} for i in range(n_messages)]
+    bullets = [random_text(random.randint(40, 120)) for _ in range(n_bullets)]
+    return dialogue, bullets
+
+def time_turns(turn, n_turns: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n_turns):
+        turn()
+    return (time.perf_counter() - start) / n_turns
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--bullets", type=int, default=40)
+    parser.add_argument("--turns", type=int, default=5)
+    args = parser.parse_args()
+
+    dialogue, bullets = make_memory(args.messages, args.bullets)
+    new_messages = dialogue[-2:]  # A turn adds a user message and a reply
+    memory_dict = {"dialogue_buffer": dialogue, "summary_buffer": bullets, "crisis_mode": False}
+    contents = [json.dumps(message) for message in dialogue] + [json.dumps(bullet) for bullet in bullets]
+
+    blob = cryptocode.encrypt(json.dumps(memory_dict), SECRET)
+    def blob_turn():
+        json.loads(cryptocode.decrypt(blob, SECRET))
+        cryptocode.encrypt(json.dumps(memory_dict), SECRET)
+
+    def records_turn(encrypt, decrypt):
+        records = [encrypt(content, SECRET) for content in contents]
+        def turn():
+            for record in records:
+                json.loads(decrypt(record, SECRET))
+            for message in new_messages:
+                encrypt(json.dumps(message), SECRET)
+        return turn
+
+    crypto.derive_key(SECRET)  # Paid once per process, not per turn
+    results = [
+        ("blob/cryptocode", time_turns(blob_turn, args.turns)),
+        ("records/cryptocode", time_turns(records_turn(cryptocode.encrypt, cryptocode.decrypt), args.turns)),
+        ("records/v2", time_turns(records_turn(crypto.encrypt, crypto.decrypt), args.turns)),
+    ]
+    print(f"{args.messages} messages, {args.bullets} summary bullets, mean of {args.turns} turns")
+    for name, seconds in results:
+        print(f"{name:<20} {seconds * 1000:10.2f} ms/turn")
+
+if __name__ == "__main__":
+    main()
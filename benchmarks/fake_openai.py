@@ -0,0 +1,197 @@
+"""
+A local stand-in for the OpenAI API, for load testing without spending money.
+
+Serves /v1/chat/completions (including n choices and streaming) and
+/v1/moderations with latencies drawn from configurable lognormal
+distributions. Chat replies are picked from a pool of therapist lines, the
+ranker is given a valid ranking and the summarizer bullet points, so CarlBot
+runs its whole turn as it would against OpenAI. Nothing is ever flagged.
+
+Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+
+Usage: python benchmarks/fake_openai.py [--port 8001] [--chat-latency 0.8,0.4] [--moderation-latency 0.15,0.3]
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+DEFAULT_REPLIES = [
+    "It sounds like that has been weighing on you.",
+    "You feel torn between what you want and what others expect of you.",
+    "That must have been really painful.",
+    "So part of you is relieved, and part of you misses it.",
+    "You're not sure yet what you want to do about it.",
+]
+MODERATION_CATEGORIES = ["harassment", "harassment/threatening", "hate", "hate/threatening", "illicit",
+                         "illicit/violent", "self-harm", "self-harm/instructions", "self-harm/intent",
+                         "sexual", "sexual/minors", "violence", "violence/graphic"]
+
+
+class LatencyDistribution:
+    """Lognormal latencies, given as "median" or "median,sigma" in seconds"""
+
+    def __init__(self, median: float, sigma: float = 0.0):
+        self.median = median
+        self.sigma = sigma
+
+    @classmethod
+    def parse(cls, spec: str):
+        return cls(*[float(part) for part in spec.split(",")])
+
+    def sample(self) -> float:
+        return self.median * math.exp(self.sigma * random.gauss(0, 1))
+
+
+class FakeOpenAI:
+
+    def __init__(self,
+                 chat_latency: LatencyDistribution = LatencyDistribution(0.8, 0.4),
+                 per_choice_latency: float = 0.05,
+                 moderation_latency: LatencyDistribution = LatencyDistribution(0.15, 0.3),
+                 token_seconds: float = 0.02,
+                 replies: List[str] = None):
+        """
+        :param per_choice_latency: Extra seconds per choice after the first, for n > 1
+        :param token_seconds: Seconds between streamed tokens, after the first arrives
+        :param replies: Lines to answer chat completions with
+        """
+        self.chat_latency = chat_latency
+        self.per_choice_latency = per_choice_latency
+        self.moderation_latency = moderation_latency
+        self.token_seconds = token_seconds
+        self.replies = replies or DEFAULT_REPLIES
+        self.n_requests = 0
+        self._lock = threading.Lock()
+
+    def completion_content(self, body: dict) -> str:
+        messages = body.get("messages", [])
+        if messages and "rank the responses" in messages[0]["content"]:
+            n_responses = messages[-1]["content"].count("[Response ")
+            return "\n".join(["Explanations."] + [", ".join(str(i) for i in random.sample(range(1, n_responses + 1), n_responses))])
+        if messages and "bullet" in messages[-1]["content"]:
+            return "- I feel unsure about what comes next\n- I want to be understood"
+        return random.choice(self.replies)
+
+    @staticmethod
+    def usage(body: dict, completion_text: str) -> dict:
+        prompt_tokens = len(json.dumps(body.get("messages", []))) // 4
+        completion_tokens = len(completion_text) // 4
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0}}
+
+    def chat_completion(self, body: dict) -> dict:
+        n = body.get("n") or 1
+        time.sleep(self.chat_latency.sample() + (n - 1) * self.per_choice_latency)
+        contents = [self.completion_content(body) for _ in range(n)]
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": i, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                        for i, content in enumerate(contents)],
+            "usage": self.usage(body, "".join(contents)),
+        }
+
+    def chat_completion_chunks(self, body: dict):
+        """The chunks of a streamed completion, sleeping as the real thing would between them"""
+        content = self.completion_content(body)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def chunk(choices, usage=None):
+            return {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": body.get("model", "fake"), "choices": choices, "usage": usage}
+        time.sleep(self.chat_latency.sample() / 2)  # Time to first token
+        for i, token in enumerate(content.split(" ")):
+            if i:
+                time.sleep(self.token_seconds)
+                token = " " + token
+            yield chunk([{"index": 0, "delta": {"content": token}, "finish_reason": None}])
+        yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield chunk([], self.usage(body, content))
+
+    def moderation(self, body: dict) -> dict:
+        time.sleep(self.moderation_latency.sample())
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        return {
+            "id": f"modr-{uuid.uuid4().hex}",
+            "model": body.get("model") or "omni-moderation-latest",
+            "results": [{"flagged": False,
+                         "categories": {category: False for category in MODERATION_CATEGORIES},
+                         "category_scores": {category: 0.0 for category in MODERATION_CATEGORIES}}
+                        for _ in inputs],
+        }
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, as the app's pooled client expects
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                with fake._lock:
+                    fake.n_requests += 1
+                if self.path.endswith("/chat/completions") and body.get("stream"):
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Connection", "close")
+                    self.end_headers()
+                    for chunk in fake.chat_completion_chunks(body):
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                        self.wfile.flush()
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.close_connection = True
+                    return
+                if self.path.endswith("/chat/completions"):
+                    response = fake.chat_completion(body)
+                elif self.path.endswith("/moderations"):
+                    response = fake.moderation(body)
+                else:
+                    self.send_error(404)
+                    return
+                data = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve(self, port: int = 0) -> ThreadingHTTPServer:
+        """Serve in a background thread, returning the server (its port is server.server_address[1])"""
+        server = ThreadingHTTPServer(("127.0.0.1", port), self.handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+        return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--chat-latency", type=LatencyDistribution.parse, default="0.8,0.4",
+                        help="Median and lognormal sigma of chat completion latency in seconds")
+    parser.add_argument("--per-choice-latency", type=float, default=0.05)
+    parser.add_argument("--moderation-latency", type=LatencyDistribution.parse, default="0.15,0.3")
+    parser.add_argument("--token-seconds", type=float, default=0.02)
+    args = parser.parse_args()
+    fake = FakeOpenAI(args.chat_latency, args.per_choice_latency, args.moderation_latency, args.token_seconds)
+    server = fake.serve(args.port)
+    print(f"Fake OpenAI listening on http://127.0.0.1:{server.server_address[1]}/v1")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+A local stand-in for Twilio's REST API, for load testing without sending texts.
+
+Accepts the Messages and Calls creates the app makes and answers them as
+Twilio would, after a configurable latency. Sent messages are passed to an
+on_message callback, so a load driver can tell when each reply arrives.
+Status callbacks are not made.
+
+Point the app at it with TWILIO_API_BASE_URL=http://127.0.0.1:<port>.
+
+Usage: python benchmarks/fake_twilio.py [--port 8002] [--latency 0.1,0.3]
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from urllib.parse import parse_qs
+
+from fake_openai import LatencyDistribution
+
+
+class FakeTwilio:
+
+    def __init__(self, latency: LatencyDistribution = LatencyDistribution(0.1, 0.3),
+                 on_message: Callable[[str, str], None] = None):
+        """
+        :param on_message: Called as on_message(to, body) for each message sent
+        """
+        self.latency = latency
+        self.on_message = on_message
+        self.n_messages = 0
+        self.n_calls = 0
+        self._lock = threading.Lock()
+
+    def create_message(self, account_sid: str, form: dict) -> dict:
+        time.sleep(self.latency.sample())
+        with self._lock:
+            self.n_messages += 1
+        if self.on_message is not None:
+            self.on_message(form.get("To"), form.get("Body"))
+        return {"sid": f"SM{uuid.uuid4().hex}", "account_sid": account_sid, "to": form.get("To"),
+                "body": form.get("Body"), "status": "queued", "num_segments": "1", "direction": "outbound-api"}
+
+    def create_call(self, account_sid: str, form: dict) -> dict:
+        time.sleep(self.latency.sample())
+        with self._lock:
+            self.n_calls += 1
+        return {"sid": f"CA{uuid.uuid4().hex}", "account_sid": account_sid, "to": form.get("To"),
+                "from": form.get("From"), "status": "queued", "direction": "outbound-api"}
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                # /2010-04-01/Accounts/<sid>/Messages.json or Calls.json
+                form = {key: values[0] for key, values in parse_qs(
+                    self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()).items()}
+                parts = self.path.strip("/").split("/")
+                if len(parts) == 4 and parts[3] == "Messages.json":
+                    response = fake.create_message(parts[2], form)
+                elif len(parts) == 4 and parts[3] == "Calls.json":
+                    response = fake.create_call(parts[2], form)
+                else:
+                    self.send_error(404)
+                    return
+                data = json.dumps(response).encode()
+                self.send_response(201)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve(self, port: int = 0) -> ThreadingHTTPServer:
+        """Serve in a background thread, returning the server (its port is server.server_address[1])"""
+        server = ThreadingHTTPServer(("127.0.0.1", port), self.handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="fake-twilio", daemon=True).start()
+        return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--latency", type=LatencyDistribution.parse, default="0.1,0.3",
+                        help="Median and lognormal sigma of API latency in seconds")
+    args = parser.parse_args()
+    fake = FakeTwilio(args.latency, on_message=lambda to, body: print(f"Message to {to}: {body}"))
+    server = fake.serve(args.port)
+    print(f"Fake Twilio listening on http://127.0.0.1:{server.server_address[1]}")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
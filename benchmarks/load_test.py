@@ -0,0 +1,250 @@
+"""
+Offline load test of the SMS webhook and the Conversation Relay consumer.
+
+Starts the fake OpenAI and Twilio servers, then for each worker count runs the
+app under gunicorn with uvicorn workers (as the Dockerfile does) against them
+and replays concurrent users:
+- SMS users POST their messages to /webhook. A turn ends when its reply
+  arrives, either inline in the TwiML or as a REST message to the fake Twilio.
+- Voice users open a /conversation-relay websocket and send prompts. A turn
+  ends when the last token of the reply arrives.
+Each user replays the client side of one of the finetuning pipeline's
+cleaned dialogues (jsonl files of {"messages": [...]}), or canned lines if
+none are given. We report p50/p95/p99 turn latency and turns per second.
+
+The app's own configuration comes from the environment, e.g. set
+SMS_AGGREGATION_SECONDS=3 to answer bursts of texts by REST, or RANKER=heuristic.
+Django's ALLOWED_HOSTS doesn't include localhost, so requests are sent with
+the production Host header. SQLite serializes writes, so for more than one
+worker use --database-url with a Postgres database.
+
+Usage: python benchmarks/load_test.py [--dialogues finetuning/input_data/cleaned_jsonl_dialogues]
+           [--workers 1,2,4] [--sms-users 50] [--voice-users 10] [--turns 5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Dict, List
+
+import httpx
+import websockets
+
+from fake_openai import FakeOpenAI, LatencyDistribution
+from fake_twilio import FakeTwilio
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "lliza"))
+from lliza.metrics import percentile  # noqa: E402
+
+HOST = "lliza-production.up.railway.app"  # One of ALLOWED_HOSTS
+CANNED_MESSAGES = [
+    "I've been feeling really stuck at work lately.",
+    "My manager keeps overlooking my ideas and I don't know what to do.",
+    "I guess I'm afraid that if I speak up it will make things worse.",
+    "It reminds me of how things were with my dad.",
+    "I don't know, maybe I just need to accept it.",
+]
+MAX_SMS_LENGTH = 1600  # Longest text carriers deliver, the webhook rejects anything over 2100
+
+
+def load_dialogues(path: str) -> List[Dict]:
+    """Dialogues from a jsonl file or a directory of them"""
+    if path is None:
+        return [{"messages": [{"role": "user", "content": content} for content in CANNED_MESSAGES]}]
+    paths = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".jsonl")] \
+        if os.path.isdir(path) else [path]
+    dialogues = []
+    for jsonl_path in paths:
+        with open(jsonl_path, encoding="utf8") as f:
+            dialogues += [json.loads(line) for line in f if line.strip()]
+    return [dialogue for dialogue in dialogues if any(message["role"] == "user" for message in dialogue["messages"])]
+
+
+def client_turns(dialogue: Dict, n_turns: int) -> List[str]:
+    return [message["content"][:MAX_SMS_LENGTH] for message in dialogue["messages"] if message["role"] == "user"][:n_turns]
+
+
+class ReplyWaiter:
+    """Lets SMS users wait for the fake Twilio to receive their replies"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queues = {}
+
+    def queue(self, number: str) -> asyncio.Queue:
+        return self.queues.setdefault(number, asyncio.Queue())
+
+    def on_message(self, to: str, body: str):
+        # Called from the fake Twilio's threads
+        if to in self.queues:
+            self.loop.call_soon_threadsafe(self.queues[to].put_nowait, body)
+
+
+async def run_sms_user(client: httpx.AsyncClient, waiter: ReplyWaiter, number: str, turns: List[str],
+                       think_seconds: float, timeout: float, latencies: List[float], errors: List[str]):
+    replies = waiter.queue(number)
+    for content in turns:
+        start = time.perf_counter()
+        try:
+            response = await client.post("/webhook", data={"MessageSid": f"SM{uuid.uuid4().hex}", "From": number, "Body": content})
+            response.raise_for_status()
+            if "<Message" not in response.text:  # Answered later by REST
+                await asyncio.wait_for(replies.get(), timeout)
+            latencies.append(time.perf_counter() - start)
+        except asyncio.TimeoutError:
+            errors.append(f"sms: no reply within {timeout}s")
+        except Exception as e:
+            errors.append(f"sms: {type(e).__name__} {e}")
+        await asyncio.sleep(think_seconds)
+
+
+async def run_voice_user(base_ws_url: str, number: str, turns: List[str], think_seconds: float, timeout: float,
+                         latencies: List[float], first_token_latencies: List[float], errors: List[str]):
+    try:
+        async with websockets.connect(f"{base_ws_url}/conversation-relay") as ws:
+            await ws.send(json.dumps({"type": "setup", "direction": "inbound", "from": number, "to": "+15550000000"}))
+            for content in turns:
+                start = time.perf_counter()
+                await ws.send(json.dumps({"type": "prompt", "voicePrompt": content, "last": True}))
+                first_token = None
+                while True:
+                    message = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+                    if message.get("type") != "text":
+                        continue
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    if message.get("last"):
+                        break
+                latencies.append(time.perf_counter() - start)
+                first_token_latencies.append(first_token)
+                await asyncio.sleep(think_seconds)
+    except asyncio.TimeoutError:
+        errors.append(f"voice: no reply within {timeout}s")
+    except Exception as e:
+        errors.append(f"voice: {type(e).__name__} {e}")
+
+
+def start_app(n_workers: int, port: int, env: dict) -> subprocess.Popen:
+    output = None if env.get("LOAD_TEST_APP_OUTPUT") else subprocess.DEVNULL
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-k", "uvicorn.workers.UvicornWorker", "--workers", str(n_workers),
+         "--timeout", "0", "--bind", f"127.0.0.1:{port}", "lliza.asgi:application"],
+        cwd=ROOT, env=env, stdout=output, stderr=output)
+
+
+async def wait_until_healthy(base_url: str, app: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url, headers={"Host": HOST}) as client:
+        while time.monotonic() < deadline:
+            if app.poll() is not None:
+                raise RuntimeError("The app exited on startup, set LOAD_TEST_APP_OUTPUT=1 to see why")
+            try:
+                if (await client.get("/health")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.5)
+    raise TimeoutError("The app didn't become healthy")
+
+
+async def run_load(args, dialogues: List[Dict], n_workers: int, env: dict, waiter: ReplyWaiter) -> dict:
+    app = start_app(n_workers, args.port, env)
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        await wait_until_healthy(base_url, app)
+        sms_latencies, voice_latencies, voice_first_token_latencies, errors = [], [], [], []
+        run_id = random.randrange(10 ** 6)  # Fresh numbers, so each run starts with new users
+        limits = httpx.Limits(max_connections=args.sms_users, max_keepalive_connections=args.sms_users)
+        async with httpx.AsyncClient(base_url=base_url, headers={"Host": HOST}, limits=limits,
+                                     timeout=args.timeout) as client:
+            users = [run_sms_user(client, waiter, f"+1555{run_id:06d}{i:04d}",
+                                  client_turns(dialogues[i % len(dialogues)], args.turns),
+                                  args.think_seconds, args.timeout, sms_latencies, errors)
+                     for i in range(args.sms_users)]
+            users += [run_voice_user(f"ws://127.0.0.1:{args.port}", f"+1556{run_id:06d}{i:04d}",
+                                     client_turns(dialogues[(args.sms_users + i) % len(dialogues)], args.turns),
+                                     args.think_seconds, args.timeout, voice_latencies,
+                                     voice_first_token_latencies, errors)
+                      for i in range(args.voice_users)]
+            start = time.perf_counter()
+            await asyncio.gather(*users)
+            seconds = time.perf_counter() - start
+    finally:
+        app.terminate()
+        app.wait()
+    return {"workers": n_workers, "seconds": seconds, "sms": sms_latencies, "voice": voice_latencies,
+            "voice_first_token": voice_first_token_latencies, "errors": errors}
+
+
+def report(result: dict):
+    n_turns = len(result["sms"]) + len(result["voice"])
+    print(f"\n{result['workers']} workers: {n_turns} turns in {result['seconds']:.1f}s, "
+          f"{n_turns / result['seconds']:.2f} turns/s, {len(result['errors'])} errors")
+    for name in ["sms", "voice", "voice_first_token"]:
+        latencies = result[name]
+        if latencies:
+            print(f"  {name:<18} p50 {percentile(latencies, 0.50):7.2f}s  p95 {percentile(latencies, 0.95):7.2f}s"
+                  f"  p99 {percentile(latencies, 0.99):7.2f}s  ({len(latencies)} turns)")
+    for error in sorted(set(result["errors"]))[:5]:
+        print(f"  {error}")
+
+
+async def main(args):
+    dialogues = load_dialogues(args.dialogues)
+    random.Random(args.seed).shuffle(dialogues)
+    replies = [message["content"] for dialogue in dialogues for message in dialogue["messages"]
+               if message["role"] == "assistant"]
+    waiter = ReplyWaiter(asyncio.get_running_loop())
+    fake_openai = FakeOpenAI(args.chat_latency, args.per_choice_latency, args.moderation_latency,
+                             args.token_seconds, replies=replies or None).serve()
+    fake_twilio = FakeTwilio(args.twilio_latency, on_message=waiter.on_message).serve()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'load_test.sqlite3')}"
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(filter(None, [os.path.join(ROOT, "lliza"), os.environ.get("PYTHONPATH")])),
+        "DATABASE_PUBLIC_URL": database_url,
+        "DJANGO_SECRET_KEY": os.environ.get("DJANGO_SECRET_KEY", "load-test"),
+        "ENCRYPTION_KEY": os.environ.get("ENCRYPTION_KEY", "load-test"),
+        "OPENAI_API_KEY": "load-test",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{fake_openai.server_address[1]}/v1",
+        "TWILIO_API_BASE_URL": f"http://127.0.0.1:{fake_twilio.server_address[1]}",
+        "TWILIO_ACCOUNT_SID": "ACloadtest",
+        "TWILIO_AUTH_TOKEN": "load-test",
+        "RAILWAY_PUBLIC_DOMAIN": HOST,
+    }
+    subprocess.run([sys.executable, os.path.join(ROOT, "lliza", "manage.py"), "migrate", "-v", "0"],
+                   env=env, check=True)
+
+    print(f"{len(dialogues)} dialogues, {args.sms_users} SMS and {args.voice_users} voice users, {args.turns} turns each")
+    for n_workers in args.workers:
+        report(await run_load(args, dialogues, n_workers, env, waiter))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--dialogues", type=str, default=None,
+                        help="Cleaned dialogues jsonl file or directory, e.g. finetuning/input_data/cleaned_jsonl_dialogues")
+    parser.add_argument("--workers", type=lambda spec: [int(n) for n in spec.split(",")], default=[1],
+                        help="Comma-separated worker counts to run the app with")
+    parser.add_argument("--sms-users", type=int, default=20)
+    parser.add_argument("--voice-users", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=5, help="Most turns each user replays")
+    parser.add_argument("--think-seconds", type=float, default=0.0, help="Pause between a reply and the next message")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds to wait for a reply")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--database-url", type=str, default=None, help="Defaults to a fresh SQLite database")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chat-latency", type=LatencyDistribution.parse, default="0.8,0.4")
+    parser.add_argument("--per-choice-latency", type=float, default=0.05)
+    parser.add_argument("--moderation-latency", type=LatencyDistribution.parse, default="0.15,0.3")
+    parser.add_argument("--token-seconds", type=float, default=0.02)
+    parser.add_argument("--twilio-latency", type=LatencyDistribution.parse, default="0.1,0.3")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,76 @@
+"""
+Evaluate the response rankers offline against finetuning's evals_dataset.jsonl.
+
+Each example is {"messages": [...], "ideal": "<the therapist's real reply>"}.
+The ideal reply is ranked against --distractors real replies taken from other
+examples, and we report how often it comes first (top-1), its mean reciprocal
+rank, and the time per ranking. With --llm the LLMRanker is run on the same
+candidates too (which calls OpenAI) and its agreement with the heuristic's
+top pick is reported.
+
+Usage: python benchmarks/ranker_eval.py finetuning/output_data/evals_dataset.jsonl [--distractors 4] [--limit 200] [--llm]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lliza"))
+from lliza.rankers import HeuristicRanker, LLMRanker  # noqa: E402
+
+def load_examples(path: str):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def evaluate(ranker, examples, candidate_lists):
+    n_top1 = 0
+    reciprocal_ranks = 0.0
+    top_picks = []
+    start = time.perf_counter()
+    for example, candidates in zip(examples, candidate_lists):
+        ranked = ranker.rank(example["messages"], candidates)
+        rank = ranked.index(example["ideal"]) + 1
+        n_top1 += rank == 1
+        reciprocal_ranks += 1 / rank
+        top_picks.append(ranked[0])
+    seconds = time.perf_counter() - start
+    return n_top1 / len(examples), reciprocal_ranks / len(examples), seconds / len(examples), top_picks
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("dataset", type=str)
+    parser.add_argument("--distractors", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--llm", action="store_true", help="Also run the LLM ranker, which calls OpenAI")
+    parser.add_argument("--llm-model", type=str, default="gpt-4o-mini-2024-07-18")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    examples = load_examples(args.dataset)[:args.limit]
+    replies = [example["ideal"] for example in examples]
+    candidate_lists = []
+    for i, example in enumerate(examples):
+        distractors = random.sample(replies[:i] + replies[i + 1:], min(args.distractors, len(replies) - 1))
+        candidates = distractors + [example["ideal"]]
+        random.shuffle(candidates)
+        candidate_lists.append(candidates)
+
+    rankers = [("heuristic", HeuristicRanker())]
+    if args.llm:
+        from lliza.llm_transport import LLMTransport
+        rankers.append(("llm", LLMRanker(LLMTransport.from_env(), args.llm_model)))
+
+    print(f"{len(examples)} examples, {args.distractors} distractors each")
+    top_picks = {}
+    for name, ranker in rankers:
+        top1, mrr, seconds, top_picks[name] = evaluate(ranker, examples, candidate_lists)
+        print(f"{name:<10} top-1 {top1:6.3f}  MRR {mrr:6.3f}  {seconds * 1000:10.3f} ms/ranking")
+    if args.llm:
+        agreement = sum(a == b for a, b in zip(top_picks["heuristic"], top_picks["llm"])) / len(examples)
+        print(f"heuristic and llm agree on the top response for {agreement:.3f} of examples")
+
+if __name__ == "__main__":
+    main()
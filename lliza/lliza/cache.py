@@ -0,0 +1,43 @@
+"""
+Per-process cache of decoded CarlBot state, so bursts of turns from the same
+user skip reading and decrypting their memory records.
+Entries are tagged with the User's memory_version, which every save bumps,
+so writes from other workers make the cached state miss.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+
+class BotStateCache:
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (version, expiry time, state)
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """Return a copy of the cached state if it's for this version and hasn't expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            cached_version, expires_at, state = entry
+            if cached_version != version or expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return copy.deepcopy(state)
+
+    def put(self, key, version, state):
+        with self._lock:
+            self._entries[key] = (version, time.monotonic() + self.ttl_seconds, copy.deepcopy(state))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
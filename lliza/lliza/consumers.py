@@ -1,44 +1,61 @@
-from channels.generic.websocket import WebsocketConsumer
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from asgiref.sync import sync_to_async
+import asyncio
 import json
-import cryptocode
+import time
 import urllib
-from lliza.utils import get_user_from_number, log_message, load_carlbot, save_carlbot, ENCRYPTION_KEY, HELP_MESSAGE, send_message
+from django.db.models import F
+from lliza.lliza import AsyncCarlBot
+from lliza import crypto, metrics, usage
+from lliza.models import User
+from lliza.utils import get_user_from_number, log_message, load_carlbot, save_carlbot_merging, ENCRYPTION_KEY, HELP_MESSAGE, send_message_now, VOICE_STREAMING
 
-class ConversationRelayConsumer(WebsocketConsumer):
-    def connect(self):
+class ConversationRelayConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
         """Handle WebSocket connection."""
         log_message("Client connected to Conversation Relay.")
-        self.accept()
+        await self.accept()
         self.user = None
         self.new_user = False
         self.carlbot = None
         self.is_me = False
+        # Prompts are handled in tasks so interrupts and errors can be received
+        # while a response is being generated. The lock keeps turns in order.
+        self.prompt_lock = asyncio.Lock()
+        self.prompt_tasks = set()
+        self.interrupted_reply = None  # Amendment to the reply being generated, applied once it's added
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         """Handle WebSocket disconnection."""
+        for task in self.prompt_tasks:
+            task.cancel()
         if self.user is not None and self.carlbot is not None:
-            save_carlbot(self.user, self.carlbot)
-            self.user.save() #superfluous bc save_carlbot already saves user
+            try:
+                # Merges with anything written during the call, e.g. a scheduled text session
+                await database_sync_to_async(save_carlbot_merging)(self.user, self.carlbot)
+            except Exception as e:
+                log_message(f"Error saving call: {e}")
             if self.new_user:
-                number = cryptocode.decrypt(self.user.user_id, ENCRYPTION_KEY)
+                number = crypto.decrypt(self.user.user_id, ENCRYPTION_KEY)
                 url_compatible_user_id = urllib.parse.quote(self.user.user_id)
                 formatted_help = HELP_MESSAGE.format(url_compatible_user_id)
-                send_message(number, formatted_help)
-            
+                await sync_to_async(send_message_now)(number, formatted_help)
+
         log_message("Client disconnected.")
 
-    def receive(self, text_data):
+    async def receive(self, text_data):
         """Handle incoming messages from Twilio."""
         try:
-            log_message("Processing incoming message")
             data = json.loads(text_data)
-            # pretty print the data
-            log_message(json.dumps(data, indent=4))
+            log_message(f"Processing {data.get('type')} message")
 
             if data['type'] == 'setup':
-                self.handle_setup(data)
+                await self.handle_setup(data)
             elif data['type'] == 'prompt':
-                self.handle_prompt(data)
+                task = asyncio.create_task(self.handle_prompt(data))
+                self.prompt_tasks.add(task)
+                task.add_done_callback(self.prompt_tasks.discard)
             elif data['type'] == 'interrupt':
                 self.handle_interrupt(data)
             elif data['type'] == 'error':
@@ -47,7 +64,7 @@ class ConversationRelayConsumer(WebsocketConsumer):
         except Exception as e:
             log_message(f"Error processing message: {e}")
 
-    def handle_setup(self, data):
+    async def handle_setup(self, data):
         """Handle setup message from Twilio."""
         try:
             if data['direction'] == 'inbound':
@@ -55,38 +72,72 @@ class ConversationRelayConsumer(WebsocketConsumer):
             else:
                 number = data['to']
             self.is_me = "8583662653" in number
-            self.user = get_user_from_number(number)
+            self.user = await database_sync_to_async(get_user_from_number)(number)
             if self.user.num_messages == 0:
                 self.new_user = True
-            self.carlbot = load_carlbot(self.user)
+            self.carlbot = await database_sync_to_async(load_carlbot)(self.user, bot_class=AsyncCarlBot)
             log_message("Setup complete.")
         except Exception as e:
             log_message(f"Error processing setup message: {e}")
 
-    def handle_prompt(self, data):
+    async def handle_prompt(self, data):
         """Handle messages from user"""
-        try:
-            raw_message = data['voicePrompt']
-            unicode_decoded = raw_message.encode().decode('unicode-escape')
-            self.carlbot.add_message(role="user", content=unicode_decoded)
-            reply = self.carlbot.get_response(is_me=self.is_me)
-            self.carlbot.add_message(role="assistant", content=reply)            
-            self.user.num_messages += 1
-            twilio_response = {
-                "type": "text",
-                "token": reply,
-                "last": True
-            }
-            log_message(f"Replying with: {reply}")
-            self.send(text_data=json.dumps(twilio_response))
-        except Exception as e:
-            log_message(f"Error processing prompt: {e}")
+        received_time = time.perf_counter()
+        with metrics.trace("voice_turn", log=log_message), usage.account(self.user.pk if self.user else None):
+            async with self.prompt_lock:
+                self.interrupted_reply = None
+                try:
+                    raw_message = data['voicePrompt']
+                    unicode_decoded = raw_message.encode().decode('unicode-escape')
+                    if VOICE_STREAMING:
+                        reply = await self.stream_reply(unicode_decoded, received_time)
+                    else:
+                        reply = await self.carlbot.respond_to_user(unicode_decoded, is_me=self.is_me)
+                        await self.send_token(reply, last=True)
+                        metrics.record("voice_time_to_first_token", time.perf_counter() - received_time)
+                    if self.interrupted_reply is not None:
+                        log_message("Reply was interrupted, adding it as far as it was spoken")
+                        reply = self.interrupted_reply
+                    await self.carlbot.add_message(role="assistant", content=reply)
+                    self.user.num_messages += 1
+                    await database_sync_to_async(User.objects.filter(pk=self.user.pk).update)(
+                        num_messages=F('num_messages') + 1)
+                    log_message("Replied")
+                except Exception as e:
+                    log_message(f"Error processing prompt: {e}")
+
+    async def stream_reply(self, content, received_time) -> str:
+        """Stream the reply to Twilio token by token, returning the full text"""
+        tokens = []
+        async for token in self.carlbot.stream_respond_to_user(content, is_me=self.is_me):
+            if not tokens:
+                metrics.record("voice_streaming_time_to_first_token", time.perf_counter() - received_time)
+            tokens.append(token)
+            await self.send_token(token, last=False)
+        await self.send_token("", last=True)
+        return "".join(tokens)
+
+    async def send_token(self, token, last):
+        twilio_response = {
+            "type": "text",
+            "token": token,
+            "last": last
+        }
+        await self.send(text_data=json.dumps(twilio_response))
 
     def handle_interrupt(self, data):
         """Handle user interruptions"""
         try:
             amended_content = data["utteranceUntilInterrupt"] + "..."
-            log_message(f"Interrputed, amending {data['utteranceUntilInterrupt']} to {amended_content}")
+            if self.prompt_lock.locked():
+                # The reply is still being generated or streamed, and the last
+                # message is the user's, so amend the reply once it's added
+                self.interrupted_reply = amended_content
+                return
+            if not self.carlbot.dialogue_buffer or self.carlbot.dialogue_buffer[-1]["role"] != "assistant":
+                log_message("Interrupted, but there is no reply to amend")
+                return
+            log_message("Interrupted, amending the last reply")
             self.carlbot.dialogue_buffer[-1] = {"role": "assistant",
                                                 "content": amended_content}
         except Exception as e:
@@ -94,6 +145,6 @@ class ConversationRelayConsumer(WebsocketConsumer):
 
     def handle_error(self, data):
         try:
-            print("Error: ", data)
+            log_message(f"Error from Conversation Relay: {data.get('description')}")
         except Exception as e:
-            log_message(f"Error processing error: {e}")
\ No newline at end of file
+            log_message(f"Error processing error: {e}")
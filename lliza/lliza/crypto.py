@@ -0,0 +1,49 @@
+"""
+Symmetric encryption for memory records and user ids.
+
+Every ciphertext carries a version so the backend can change under existing data:
+- v1 is cryptocode's "ciphertext*salt*nonce*tag", which derives a new scrypt key
+  from the passphrase on every call. It's only decrypted now.
+- v2 is "v2$" + base64(nonce + tag + ciphertext), AES-GCM with a key derived
+  from the passphrase once per process.
+Anything decrypted from v1 is re-encrypted as v2 the next time it's written.
+"""
+import hashlib
+from base64 import b64encode, b64decode
+from functools import lru_cache
+
+import cryptocode
+from Cryptodome.Cipher import AES
+from Cryptodome.Random import get_random_bytes
+
+V2_PREFIX = "v2$"
+V2_KEY_SALT = b"lliza-encryption-v2"
+NONCE_BYTES = 12
+TAG_BYTES = 16
+
+@lru_cache(maxsize=4)
+def derive_key(secret: str) -> bytes:
+    return hashlib.scrypt(secret.encode(), salt=V2_KEY_SALT, n=2 ** 14, r=8, p=1, dklen=32)
+
+def is_legacy(token: str) -> bool:
+    return not token.startswith(V2_PREFIX)
+
+def encrypt(plaintext: str, secret: str) -> str:
+    cipher = AES.new(derive_key(secret), AES.MODE_GCM, nonce=get_random_bytes(NONCE_BYTES))
+    ciphertext, tag = cipher.encrypt_and_digest(plaintext.encode())
+    return V2_PREFIX + b64encode(cipher.nonce + tag + ciphertext).decode()
+
+def decrypt(token: str, secret: str):
+    """
+    Decrypt a v1 or v2 token.
+    Like cryptocode.decrypt, returns False if the token can't be decrypted.
+    """
+    if is_legacy(token):
+        return cryptocode.decrypt(token, secret)
+    try:
+        raw = b64decode(token[len(V2_PREFIX):])
+        nonce, tag, ciphertext = raw[:NONCE_BYTES], raw[NONCE_BYTES:NONCE_BYTES + TAG_BYTES], raw[NONCE_BYTES + TAG_BYTES:]
+        cipher = AES.new(derive_key(secret), AES.MODE_GCM, nonce=nonce)
+        return cipher.decrypt_and_verify(ciphertext, tag).decode()
+    except (ValueError, KeyError):
+        return False
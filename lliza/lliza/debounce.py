@@ -0,0 +1,44 @@
+"""
+Per-key debouncing: run a callback once things have been quiet for a while.
+Used to answer a burst of SMS fragments with one turn once the last arrives.
+"""
+import threading
+from typing import Callable, Hashable
+
+
+class Debouncer:
+
+    def __init__(self, delay: float, callback: Callable, log: Callable[[str], None] = print):
+        """
+        :param delay: Seconds without a trigger before the callback runs
+        :param callback: Called as callback(key, *args) with the args of the last trigger for key
+        """
+        self.delay = delay
+        self.callback = callback
+        self.log = log
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def trigger(self, key: Hashable, *args):
+        """(Re)start the wait for key, replacing the arguments of earlier triggers"""
+        with self._lock:
+            if key in self._timers:
+                self._timers[key].cancel()
+            timer = threading.Timer(self.delay, self._fire, args=(key, args))
+            self._timers[key] = timer
+            timer.start()
+
+    def pending(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._timers
+
+    def _fire(self, key: Hashable, args: tuple):
+        with self._lock:
+            # A trigger which raced with this timer firing has replaced it
+            if self._timers.get(key) is not threading.current_thread():
+                return
+            del self._timers[key]
+        try:
+            self.callback(key, *args)
+        except Exception as e:
+            self.log(f"Error in debounced callback: {e}")
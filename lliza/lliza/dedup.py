@@ -0,0 +1,90 @@
+"""
+Store of Twilio webhooks already handled, so duplicate deliveries are dropped.
+
+Events are recorded in the ProcessedEvent table, whose unique constraint makes
+the check-and-record atomic across workers. Each worker also remembers the
+events it has seen recently, so most duplicates never reach the database.
+Records expire after ttl_seconds, by which time Twilio has stopped retrying.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from lliza import metrics
+from lliza.models import ProcessedEvent
+
+
+class DedupStore:
+
+    def __init__(self, ttl_seconds: float, cache_size: int, prune_every: int = 1000):
+        """
+        :param ttl_seconds: How long an event is remembered
+        :param cache_size: Most events each worker remembers in memory
+        :param prune_every: Expired records are deleted after this many new events
+        """
+        self.ttl_seconds = ttl_seconds
+        self.cache_size = cache_size
+        self.prune_every = prune_every
+        self._seen = OrderedDict()  # (kind, key) -> expiry time
+        self._n_since_prune = 0
+        self._lock = threading.Lock()
+
+    def _seen_recently(self, event) -> bool:
+        with self._lock:
+            expires_at = self._seen.get(event)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self._seen[event]
+                return False
+            return True
+
+    def _remember(self, event):
+        with self._lock:
+            self._seen[event] = time.monotonic() + self.ttl_seconds
+            self._seen.move_to_end(event)
+            while len(self._seen) > self.cache_size:
+                self._seen.popitem(last=False)
+            self._n_since_prune += 1
+            prune = self._n_since_prune >= self.prune_every
+            if prune:
+                self._n_since_prune = 0
+        if prune:
+            self.prune()
+
+    def is_duplicate(self, kind: str, key: str) -> bool:
+        """
+        Record the event, returning True if it was already recorded.
+        Events without a key can't be deduplicated and are never duplicates.
+        """
+        if not key:
+            return False
+        event = (kind, key)
+        if self._seen_recently(event):
+            duplicate = True
+        else:
+            try:
+                with transaction.atomic():
+                    ProcessedEvent.objects.create(kind=kind, key=key)
+                duplicate = False
+            except IntegrityError:
+                duplicate = True
+            self._remember(event)
+        if duplicate:
+            metrics.increment(f"duplicate_{kind}_suppressed")
+        return duplicate
+
+    def forget(self, kind: str, key: str):
+        """Drop a recorded event, e.g. because handling it failed, so a retry isn't a duplicate"""
+        if not key:
+            return
+        with self._lock:
+            self._seen.pop((kind, key), None)
+        ProcessedEvent.objects.filter(kind=kind, key=key).delete()
+
+    def prune(self):
+        ProcessedEvent.objects.filter(processed_at__lt=timezone.now() - timedelta(seconds=self.ttl_seconds)).delete()
@@ -1,30 +1,76 @@
 import urllib3
-from openai import OpenAI
+import hashlib
+import json
 import random
-
-client = OpenAI()
+import asyncio
+import contextvars
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
 
+from lliza import metrics, tokens, usage
+from lliza.llm_transport import LLMTransport, GENERATION, SUMMARIZATION
+from lliza.rankers import Ranker, make_ranker, stringify_dialogue, RANKER
+from lliza.sampling import SamplingPolicy
+
 urllib3.disable_warnings()
 
+transport = LLMTransport.from_env()
+sampling_policy = SamplingPolicy.from_env()  # Shared so its ranker agreement history outlives each turn's bot
+executor = ThreadPoolExecutor(max_workers=16)  # For running OpenAI calls concurrently
+
+SESSION_BOUNDARY = "session_boundary"  # Role of the marker message appended when a new session starts
+NEW_SESSION_NOTE = "A new session has started."
+# What used to be appended as a system message at the start of each session,
+# still found in older memories and treated as a session boundary
+LEGACY_NEW_SESSION_PROMPT = """
+        The previous session has ended. The assistant should now prompt the user to begin a new session.
+        Something neutral like "Well, how are things today?"
+        Do not respond to this message, just start the new session.
+        """
+NEW_SESSION_MESSAGES = [
+    "Well, how are things today?",
+    "How is it today?",
+    "What’s on your mind today that you would like to talk about?",
+    "Well – how do you want to use the time today?",
+    "How goes it today?",
+    "Well what's new today?",
+    "Where do you want to start today?",
+    "Well, do you know where you want to begin today?",
+]
+
 SYSTEM_PROMPT = "You are LLiza, a Rogerian therapist AI. Your mission is to embody congruence (transparency about your own feelings and reactions), unconditional positive regard (a strong sense of caring for the client), and empathetic understanding (understand the client's frame of reference well enough to sense deeper meanings underneath the surface) so therapeutic movement occurs in your client.\nSpecifically, she'll explore her feelings more deeply, discover hidden aspects of herself, prize herself more, understand her own meanings better, be more real with herself, feel what's going on inside more clearly, relate more directly, see life less rigidly, accept herself, and recognize her own judgment capacity.\nStart by asking what the client wants to talk about. Don't give advice, direct the client, ask questions, interpret, bring in outside opinions, merely repeat facts, summarize all of what they said, or use long sentences. Allow the client to lead the session and discover their own answers while you understand their inner world, reflect their most important emotions succinctly, and be transparent with your reactions.\nExample 1:\n###\nClient: I would like to be more present and comfortable with myself so that other people, including my children and so forth, could do what they do, and that I could be a source of support and not be personally threatened  by every little thing. \nYou: And that has meaning to me. You'd like to be sufficiently accepting of yourself, that then you can be comfortable with what your children do or what other people do and not feel frightened, thrown off balance. \n###\nExample 2:\n###\nClient: I plan to go to work in the fall, and I believe that deep down I'm really afraid. \nYou: Are you afraid of the responsibility or, or what aspect of it is most frightening?\n###\n"
 
 class CarlBot:
 
     def __init__(self,
                  base_system_prompt=SYSTEM_PROMPT,
-                 min_n_dialogue_buffer_messages=25,
-                 max_n_dialogue_buffer_messages=50,
+                 min_dialogue_buffer_tokens=3000,
+                 max_dialogue_buffer_tokens=6000,
                  max_summary_buffer_points=40,
-                 max_user_message_chars=700):
-        self.max_n_dialogue_buffer_messages = max_n_dialogue_buffer_messages
-        self.min_n_dialogue_buffer_messages = min_n_dialogue_buffer_messages
+                 max_user_message_tokens=200,
+                 defer_summary=False,
+                 ranker: Ranker = None,
+                 policy: SamplingPolicy = None):
+        # The dialogue buffer is summarized down to min_dialogue_buffer_tokens
+        # when it grows past max_dialogue_buffer_tokens, and never more than
+        # max_dialogue_buffer_tokens of it are sent, so prompts stay bounded
+        self.max_dialogue_buffer_tokens = max_dialogue_buffer_tokens
+        self.min_dialogue_buffer_tokens = min_dialogue_buffer_tokens
         self.max_summary_buffer_points = max_summary_buffer_points
         self.base_system_prompt = base_system_prompt
-        self.max_user_message_chars = max_user_message_chars
-        self.n = 5
+        self.max_user_message_tokens = max_user_message_tokens
+        # If set, a full dialogue buffer is left for a background task to
+        # summarize (see compute_summary/apply_summary) instead of blocking the turn
+        self.defer_summary = defer_summary
+        self.sampling_policy = policy or sampling_policy
         self.summarizer_model = "gpt-4o-mini-2024-07-18"
         self.chat_model = "ft:gpt-4o-mini-2024-07-18:personal:110-dialogues-25-min-6000:AZCDM2kA"
+        self.ranker = ranker or make_ranker(RANKER, transport, self.summarizer_model,
+                                            on_completion=self._count_usage)
+        self.turn_usage = Counter()  # Tokens spent on OpenAI completions this turn
+        self.turn_cancelled = threading.Event()  # Set when moderation flags the turn, so get_response stops early
 
         # Initialize memory
         self.all_summary_points = [
@@ -35,88 +81,257 @@ class CarlBot:
         # Initialize dialogue
         self.full_dialogue = []
         self.dialogue_buffer = []
+        self.dialogue_offset = 0  # Number of messages ever trimmed from the front of dialogue_buffer
+        self.saved_memory = None  # Bookkeeping of what's already been stored, see utils.save_carlbot
 
         # Initialize crisis mode
         self.crisis_mode = False
         self.crisis_response = "It sounds like you are going through a very difficult time right now. I'm concerned about your safety and well-being based on what you've told me. I think this chat needs to come to an end, as I'm just an AI assistant without the proper training to provide any counseling or emergency support. But I want you to know there are compassionate people available to talk to you. Please reach out right away to the National Suicide Prevention Lifeline at the phone number 988 or chat with them online at https://988lifeline.org/chat. They have people there 24/7 ready to listen, care and assist you during this crisis. Your life matters and help is available."
 
-    @staticmethod
-    def stringify_dialogue(dialogue: List[dict]):
-        return "\n".join([
-            f"{message['role']}: {message['content']}" for message in dialogue
-        ])
+    stringify_dialogue = staticmethod(stringify_dialogue)
 
     @staticmethod
     def stringify_summary(summary: List[str]):
         return "\n- ".join([""] + summary)[1:]
 
+    # The messages are laid out most to least stable so OpenAI's prompt cache
+    # can reuse the longest prefix: the system prompt (the same for every user
+    # and turn), then the summary (changes only when the buffer is summarized),
+    # then the dialogue (appended to every turn).
+
     @property
     def system_prompt_message(self):
-        content = f"{self.base_system_prompt}\nPreviously Expressed Attitudes:\n{self.summary_buffer_str}"
-        return {"role": "system", "content": content}
+        return {"role": "system", "content": self.base_system_prompt}
+
+    @property
+    def summary_message(self):
+        return {"role": "system", "content": f"Previously Expressed Attitudes:\n{self.summary_buffer_str}"}
+
+    @staticmethod
+    def is_session_boundary(message: Dict) -> bool:
+        return message["role"] == SESSION_BOUNDARY or (
+            message["role"] == "system" and message["content"].strip() == LEGACY_NEW_SESSION_PROMPT.strip())
+
+    @staticmethod
+    def session_boundary() -> Dict:
+        return {"role": SESSION_BOUNDARY, "content": ""}
+
+    @staticmethod
+    def n_tokens(message: Dict) -> int:
+        """Tokens in a message, counted once and stored alongside it"""
+        if CarlBot.is_session_boundary(message):
+            return 0  # Rendered as a short note, see prompt_dialogue
+        if "n_tokens" not in message:
+            message["n_tokens"] = tokens.count_message_tokens(message)
+        return message["n_tokens"]
+
+    @property
+    def dialogue_buffer_tokens(self) -> int:
+        return sum(self.n_tokens(message) for message in self.dialogue_buffer)
+
+    @property
+    def prompt_dialogue(self) -> List[Dict[str, str]]:
+        """
+        The newest messages which fit in max_dialogue_buffer_tokens, without
+        their token counts. The buffer is only over budget while a deferred
+        summary is pending.
+        Only the latest session boundary is kept, as a short system note.
+        """
+        n_tokens = 0
+        start = len(self.dialogue_buffer)
+        while start > 0 and n_tokens + self.n_tokens(self.dialogue_buffer[start - 1]) <= self.max_dialogue_buffer_tokens:
+            start -= 1
+            n_tokens += self.n_tokens(self.dialogue_buffer[start])
+        dialogue = self.dialogue_buffer[start:]
+        last_boundary = max((i for i, message in enumerate(dialogue) if self.is_session_boundary(message)), default=None)
+        prompt_dialogue = []
+        for i, message in enumerate(dialogue):
+            if i == last_boundary:
+                prompt_dialogue.append({"role": "system", "content": NEW_SESSION_NOTE})
+            elif not self.is_session_boundary(message):
+                prompt_dialogue.append({"role": message["role"], "content": message["content"]})
+        return prompt_dialogue
 
     @property
     def messages(self):
-        return [self.system_prompt_message] + self.dialogue_buffer
+        return [self.system_prompt_message, self.summary_message] + self.prompt_dialogue
 
-    def summarize_attitudes_in_dialogue(self, dialogue: List[Dict[str, str]],
-                                        n_bullets: int) -> List[str]:
-        dialogue_str = self.stringify_dialogue(dialogue)
-        completion = client.chat.completions.create(
+    # The request building and response parsing below is shared by CarlBot
+    # and AsyncCarlBot, which only differ in how they make the OpenAI calls.
+
+    def _summarize_attitudes_in_dialogue_kwargs(self, dialogue: List[Dict[str, str]],
+                                                n_bullets: int) -> dict:
+        dialogue_str = self.stringify_dialogue(
+            [message for message in dialogue if not self.is_session_boundary(message)])
+        return dict(
             model=self.summarizer_model,
             messages=[{"role": "user", "content": f"{dialogue_str}\n###\nMake a bulletpoint list of the most important attitudes (at most {n_bullets} bullets) coming out in this interview. Do not say anything first, just reply with the bullet points. Use first person."}],
             max_tokens=200,  # 100 left unfinished bullets
             temperature=0.0)
-        summary = "\n" + completion.choices[0].message.content
-        bullets = summary.split("\n- ")[1:] # All but first empty string
-        return bullets
-    
-    def summarize_attitudes(self, summary_points: List[str],
-                            n_bullets: int) -> List[str]:
+
+    def _summarize_attitudes_kwargs(self, summary_points: List[str],
+                                    n_bullets: int) -> dict:
         summary_str = self.stringify_summary(summary_points)
-        completion = client.chat.completions.create(
+        return dict(
             model=self.summarizer_model,
-            messages=[{"role": "user", "content": f"{summary_str}\n###\nCondense these attitudes to at most {n_bullets} bulletpoints. Do not say anything first, just reply with the bullet points. Use first person."}],            
+            messages=[{"role": "user", "content": f"{summary_str}\n###\nCondense these attitudes to at most {n_bullets} bulletpoints. Do not say anything first, just reply with the bullet points. Use first person."}],
             max_tokens=200,  # 100 left unfinished bullets
             temperature=0.0)
+
+    @staticmethod
+    def _parse_bullets(completion) -> List[str]:
         summary = "\n" + completion.choices[0].message.content
         bullets = summary.split("\n- ")[1:] # All but first empty string
         return bullets
 
-    def update_summary(self):
-        n_bullets = min(self.max_summary_buffer_points,
-                        max(2, self.max_summary_buffer_points // 3))
-        bullets = self.summarize_attitudes_in_dialogue(
-            self.dialogue_buffer[:-self.min_n_dialogue_buffer_messages],
-            n_bullets)
+    @property
+    def n_summary_bullets(self) -> int:
+        return min(self.max_summary_buffer_points,
+                   max(2, self.max_summary_buffer_points // 3))
+
+    @property
+    def dialogue_to_summarize(self) -> List[Dict[str, str]]:
+        """The oldest messages, leaving the newest (at least one) which fit in min_dialogue_buffer_tokens"""
+        n_kept_tokens = self.n_tokens(self.dialogue_buffer[-1]) if self.dialogue_buffer else 0
+        end = len(self.dialogue_buffer) - 1
+        while end > 0 and n_kept_tokens + self.n_tokens(self.dialogue_buffer[end - 1]) <= self.min_dialogue_buffer_tokens:
+            end -= 1
+            n_kept_tokens += self.n_tokens(self.dialogue_buffer[end])
+        return self.dialogue_buffer[:max(end, 0)]
+
+    def _extend_summary(self, bullets: List[str]) -> bool:
+        """Add new bullets, returning whether the summary buffer needs condensing"""
         self.all_summary_points.extend(bullets)
         self.summary_buffer.extend(bullets)
-        if len(self.summary_buffer) > self.max_summary_buffer_points:
-            self.summary_buffer = self.summarize_attitudes(
-                self.summary_buffer, n_bullets)
+        return len(self.summary_buffer) > self.max_summary_buffer_points
 
-    def is_crisis(self, content: str) -> bool:
-        response = client.moderations.create(input=content)
+    def _count_usage(self, completion):
+        usage = getattr(completion, "usage", None)
+        if usage is not None:
+            self.turn_usage["prompt_tokens"] += usage.prompt_tokens
+            self.turn_usage["completion_tokens"] += usage.completion_tokens
+            details = getattr(usage, "prompt_tokens_details", None)
+            self.turn_usage["cached_tokens"] += (details and details.cached_tokens) or 0
+
+    def _start_turn(self):
+        self.turn_usage = Counter()
+        self.turn_cancelled = threading.Event()
+
+    def _finish_response(self, candidates: List[str], ranked: List[str], n_initial: int):
+        if len(candidates) > n_initial:
+            self.sampling_policy.record_escalation(ranked[0] in candidates[n_initial:])
+        metrics.record("turn_candidates", len(candidates))
+        metrics.record("turn_tokens", self.turn_usage["prompt_tokens"] + self.turn_usage["completion_tokens"])
+        metrics.record("turn_cached_tokens", self.turn_usage["cached_tokens"])
+
+    @staticmethod
+    def _moderation_is_crisis(response) -> bool:
         moderation_categories = response.results[0].categories
         return any(
             getattr(moderation_categories, category) for category in
             ["self-harm", "self-harm/intent", "self-harm/instructions"])
 
-    def _add_message(self, role: str, content: str):
-        if role == "user" and self.is_crisis(content):
-            self.crisis_mode = True
+    def _append_message(self, role: str, content: str) -> bool:
+        """Append a message, returning whether the dialogue buffer is over its limit"""
         message = {"role": role, "content": content}
+        self.n_tokens(message)
         self.full_dialogue.append(message)
         self.dialogue_buffer.append(message)
-        if len(self.dialogue_buffer) > self.max_n_dialogue_buffer_messages:
+        return self.needs_summary
+
+    def _trim_dialogue_buffer(self, n_messages=None):
+        if n_messages is None:
+            n_messages = len(self.dialogue_to_summarize)
+        self.dialogue_buffer = self.dialogue_buffer[n_messages:]
+        self.dialogue_offset += n_messages
+
+    @property
+    def needs_summary(self) -> bool:
+        return self.dialogue_buffer_tokens > self.max_dialogue_buffer_tokens
+
+    @staticmethod
+    def _dialogue_digest(dialogue: List[Dict[str, str]]) -> str:
+        # Only what was said, since token counts may be missing from messages saved before them
+        dialogue = [{"role": message["role"], "content": message["content"]} for message in dialogue]
+        return hashlib.sha256(json.dumps(dialogue, sort_keys=True).encode()).hexdigest()
+
+    def _summary_result(self, dialogue: List[Dict[str, str]], bullets: List[str], summary_buffer: List[str]) -> dict:
+        return {
+            "dialogue_offset": self.dialogue_offset,
+            "n_messages": len(dialogue),
+            "dialogue_digest": self._dialogue_digest(dialogue),
+            "bullets": bullets,
+            "summary_buffer": summary_buffer,
+        }
+
+    def apply_summary(self, summary: dict) -> bool:
+        """
+        Apply a summary made by compute_summary, possibly on an older copy of
+        this bot. The summarized messages are only dropped if they are still
+        the ones at the front of the dialogue buffer, so messages added since
+        are never lost and stale summaries are ignored.
+        """
+        n_messages = summary["n_messages"]
+        if (summary["dialogue_offset"] != self.dialogue_offset
+                or len(self.dialogue_buffer) < n_messages
+                or self._dialogue_digest(self.dialogue_buffer[:n_messages]) != summary["dialogue_digest"]):
+            return False
+        self.all_summary_points.extend(summary["bullets"])
+        self.summary_buffer = summary["summary_buffer"]
+        self._trim_dialogue_buffer(n_messages)
+        return True
+
+    def summarize_attitudes_in_dialogue(self, dialogue: List[Dict[str, str]],
+                                        n_bullets: int) -> List[str]:
+        completion = transport.chat(
+            SUMMARIZATION, **self._summarize_attitudes_in_dialogue_kwargs(dialogue, n_bullets))
+        self._count_usage(completion)
+        return self._parse_bullets(completion)
+    
+    def summarize_attitudes(self, summary_points: List[str],
+                            n_bullets: int) -> List[str]:
+        completion = transport.chat(
+            SUMMARIZATION, **self._summarize_attitudes_kwargs(summary_points, n_bullets))
+        self._count_usage(completion)
+        return self._parse_bullets(completion)
+
+    def update_summary(self):
+        with metrics.span("summarization"):
+            bullets = self.summarize_attitudes_in_dialogue(
+                self.dialogue_to_summarize, self.n_summary_bullets)
+            if self._extend_summary(bullets):
+                self.summary_buffer = self.summarize_attitudes(
+                    self.summary_buffer, self.n_summary_bullets)
+
+    def compute_summary(self) -> dict:
+        """Summarize the oldest messages without changing this bot, for apply_summary"""
+        with metrics.span("summarization"):
+            dialogue = self.dialogue_to_summarize
+            bullets = self.summarize_attitudes_in_dialogue(dialogue, self.n_summary_bullets)
+            summary_buffer = self.summary_buffer + bullets
+            if len(summary_buffer) > self.max_summary_buffer_points:
+                summary_buffer = self.summarize_attitudes(summary_buffer, self.n_summary_bullets)
+        return self._summary_result(dialogue, bullets, summary_buffer)
+
+    def is_crisis(self, content: str) -> bool:
+        with metrics.span("moderation"):
+            response = transport.moderate(input=content)
+        return self._moderation_is_crisis(response)
+
+    def _add_message(self, role: str, content: str, moderate: bool = True):
+        if moderate and role == "user" and self.is_crisis(content):
+            self.crisis_mode = True
+        if self._append_message(role, content) and not self.defer_summary:
             self.update_summary()
-            self.dialogue_buffer = self.dialogue_buffer[
-                -self.min_n_dialogue_buffer_messages:]
+            self._trim_dialogue_buffer()
 
     def split_content(self, content: str) -> List[str]:
-        if len(content) <= self.max_user_message_chars:
+        if tokens.count_tokens(content) <= self.max_user_message_tokens:
             return [content]
-        split_point = content[:self.max_user_message_chars].rfind(" ")
+        prefix = tokens.truncate(content, self.max_user_message_tokens)
+        split_point = prefix.rfind(" ")
+        if split_point <= 0:  # One long word
+            return [prefix] + self.split_content(content[len(prefix):])
         return [content[:split_point]] + self.split_content(
             content[split_point + 1:])
 
@@ -129,76 +344,99 @@ class CarlBot:
     def summary_buffer_str(self):
         return self.stringify_summary(self.summary_buffer)
 
-    def rank_responses(self, responses: List[str]) -> List[str]:
-        ranking_prompt = f"""
-        Below is the context for a dialogue, followed by {self.n} possible responses.
-        Your task is to rank the responses in order of appropriateness for the context.
-        
-        Here is the data:
-        [BEGIN DATA] 
-        ***
-        {self.stringify_dialogue(self.messages)}
-        ***
-        """
-        for i, response in enumerate(responses, start=1):
-            ranking_prompt += f"[Response {i}]\n{response}\n\n"
-        ranking_prompt += "[END DATA]"
-        ranking_prompt += """
-        Rank the responses in order of appropriateness for the context. Heavily penalize responses which hallucinate things that were not in the context or merely repeat the client's words. Reward responses which are empathetic, congruent, and reflect the client's feelings and attitudes.
-        Without yet ranking them, write a terse explanation of each ranking choice's appropriateness in the order they were presented (ie Response 1, Response 2...).
-        Then on a new line write a comma-separated list of the response numbers in order of appropriateness.
-        E.g. "2,1,3"
-        """
-        completion = client.chat.completions.create(
-            model=self.summarizer_model,
-            messages=[{"role": "user", "content": ranking_prompt}],
-            max_tokens=100*self.n,  # 100 left unfinished bullets
-            temperature=0.0)
-        ranking = completion.choices[0].message.content
-        ranks = ranking.split("\n")[-1].split(",")
-        return [responses[int(rank) - 1] for rank in ranks]
+    def _get_response_kwargs(self, n: int) -> dict:
+        return dict(
+            model=self.chat_model,
+            messages=self.messages,
+            temperature=0.3,
+            n=n
+            )
 
-    def get_response(self, is_me: bool = False) -> str:
-        if self.crisis_mode and not is_me:
-            return self.crisis_response
-        
-        response = client.chat.completions.create(
+    def _candidates(self, completion) -> List[str]:
+        self._count_usage(completion)
+        return [choice.message.content for choice in completion.choices]
+
+    def _stream_response_kwargs(self) -> dict:
+        # A single streamed candidate, so there is nothing to rank
+        return dict(
             model=self.chat_model,
             messages=self.messages,
             temperature=0.3,
-            n=self.n
+            stream=True,
+            stream_options={"include_usage": True}
             )
 
-        message_choices = [choice.message.content for choice in response.choices]
-        ranked_responses = self.rank_responses(message_choices)
+    def rank_responses(self, responses: List[str]) -> List[str]:
+        with metrics.span("ranking"):
+            return self.ranker.rank(self.messages, responses)
+
+    def get_response(self, is_me: bool = False) -> str:
+        """
+        Generate candidates and return the best ranked.
+        Starts with the number the sampling policy chooses, and only generates
+        more if those disagree.
+        """
+        if self.crisis_mode and not is_me:
+            return self.crisis_response
+
+        n_initial = self.sampling_policy.choose_n(self.dialogue_buffer)
+        with metrics.span("generation"):
+            candidates = self._candidates(transport.chat(GENERATION, **self._get_response_kwargs(n_initial)))
+        # A request already sent can't be stopped, but the turn's later calls can
+        if self.turn_cancelled.is_set():
+            return self.crisis_response
+        extra_n = self.sampling_policy.choose_extra_n(candidates)
+        if extra_n:
+            with metrics.span("generation"):
+                candidates += self._candidates(transport.chat(GENERATION, **self._get_response_kwargs(extra_n)))
+            if self.turn_cancelled.is_set():
+                return self.crisis_response
+        ranked_responses = self.rank_responses(candidates) if len(candidates) > 1 else candidates
+        self._finish_response(candidates, ranked_responses, n_initial)
         return ranked_responses[0]
 
-    def load(self, dialogue_buffer, summary_buffer, crisis_mode):
+    def respond_to_user(self, content: str, is_me: bool = False) -> str:
+        """
+        Add a user message and get a response, running the crisis moderation
+        concurrently with candidate generation instead of before it.
+        If moderation flags the message the generated response is discarded.
+        """
+        self._start_turn()
+        split_contents = self.split_content(content)
+        # Run in copies of this context so their spans add to the turn's trace
+        crisis_futures = [executor.submit(contextvars.copy_context().run, self.is_crisis, split_content)
+                          for split_content in split_contents]
+        for split_content in split_contents:
+            self._add_message("user", split_content, moderate=False)
+        response_future = executor.submit(contextvars.copy_context().run, self.get_response, is_me)
+        if any(future.result() for future in crisis_futures):
+            self.crisis_mode = True
+            if not is_me:
+                self.turn_cancelled.set()  # In case get_response has already started
+                response_future.cancel()
+                return self.crisis_response
+        return response_future.result()
+
+    def load(self, dialogue_buffer, summary_buffer, crisis_mode, dialogue_offset=0):
         self.dialogue_buffer = dialogue_buffer
         self.summary_buffer = summary_buffer
         self.crisis_mode = crisis_mode
+        self.dialogue_offset = dialogue_offset
 
     def load_from_dict(self, memory_dict):
         self.load(memory_dict['dialogue_buffer'], memory_dict['summary_buffer'],
-                  memory_dict['crisis_mode'])
+                  memory_dict['crisis_mode'], memory_dict.get('dialogue_offset', 0))
     
     def save_to_dict(self):
         return {
             "dialogue_buffer": self.dialogue_buffer,
             "summary_buffer": self.summary_buffer,
-            "crisis_mode": self.crisis_mode
+            "crisis_mode": self.crisis_mode,
+            "dialogue_offset": self.dialogue_offset
         }
     
-    def get_new_session_prompt(self) -> str:
-        new_session_prompt = """
-        The previous session has ended. The assistant should now prompt the user to begin a new session.
-        Something neutral like "Well, how are things today?"
-        Do not respond to this message, just start the new session.
-        """
-        return new_session_prompt
-
-
-    def get_new_session_message(self, is_me: bool = False) -> str:
+    @staticmethod
+    def get_new_session_message(is_me: bool = False) -> str:
         """
         Returns a message to start a new session.
         This will be used when we send scheduled messages to 
@@ -206,30 +444,163 @@ class CarlBot:
         It'd be helpful to generate one based on the past session history.
 
         """            
-        new_session_messages = [
-            "Well, how are things today?",
-            "How is it today?",
-            "What’s on your mind today that you would like to talk about?",
-            "Well – how do you want to use the time today?",
-            "How goes it today?",
-            "Well what's new today?",
-            "Where do you want to start today?",
-            "Well, do you know where you want to begin today?",
-        ]
-        return random.choice(new_session_messages)
+        return random.choice(NEW_SESSION_MESSAGES)
     
     def start_new_session(self, is_me: bool = False) -> str:
-        self.add_message(role="system", content=self.get_new_session_prompt())
+        self._append_message(SESSION_BOUNDARY, "")
         new_session_message = self.get_new_session_message(is_me=is_me)
         self.add_message(role="assistant", content=new_session_message)
         return new_session_message
 
 
+class AsyncCarlBot(CarlBot):
+    """
+    CarlBot whose OpenAI-backed methods are coroutines, for use from the
+    Channels consumer and async views without tying up a thread per turn.
+    """
+
+    async def summarize_attitudes_in_dialogue(self, dialogue: List[Dict[str, str]],
+                                              n_bullets: int) -> List[str]:
+        completion = await transport.achat(
+            SUMMARIZATION, **self._summarize_attitudes_in_dialogue_kwargs(dialogue, n_bullets))
+        self._count_usage(completion)
+        return self._parse_bullets(completion)
+
+    async def summarize_attitudes(self, summary_points: List[str],
+                                  n_bullets: int) -> List[str]:
+        completion = await transport.achat(
+            SUMMARIZATION, **self._summarize_attitudes_kwargs(summary_points, n_bullets))
+        self._count_usage(completion)
+        return self._parse_bullets(completion)
+
+    async def update_summary(self):
+        with metrics.span("summarization"):
+            bullets = await self.summarize_attitudes_in_dialogue(
+                self.dialogue_to_summarize, self.n_summary_bullets)
+            if self._extend_summary(bullets):
+                self.summary_buffer = await self.summarize_attitudes(
+                    self.summary_buffer, self.n_summary_bullets)
+
+    async def compute_summary(self) -> dict:
+        with metrics.span("summarization"):
+            dialogue = self.dialogue_to_summarize
+            bullets = await self.summarize_attitudes_in_dialogue(dialogue, self.n_summary_bullets)
+            summary_buffer = self.summary_buffer + bullets
+            if len(summary_buffer) > self.max_summary_buffer_points:
+                summary_buffer = await self.summarize_attitudes(summary_buffer, self.n_summary_bullets)
+        return self._summary_result(dialogue, bullets, summary_buffer)
+
+    async def is_crisis(self, content: str) -> bool:
+        with metrics.span("moderation"):
+            response = await transport.amoderate(input=content)
+        return self._moderation_is_crisis(response)
+
+    async def _add_message(self, role: str, content: str, moderate: bool = True):
+        if moderate and role == "user" and await self.is_crisis(content):
+            self.crisis_mode = True
+        if self._append_message(role, content) and not self.defer_summary:
+            await self.update_summary()
+            self._trim_dialogue_buffer()
+
+    async def add_message(self, role: str, content: str):
+        for split_content in self.split_content(content):
+            await self._add_message(role, split_content)
+
+    async def rank_responses(self, responses: List[str]) -> List[str]:
+        with metrics.span("ranking"):
+            return await self.ranker.arank(self.messages, responses)
+
+    async def get_response(self, is_me: bool = False) -> str:
+        if self.crisis_mode and not is_me:
+            return self.crisis_response
+
+        n_initial = self.sampling_policy.choose_n(self.dialogue_buffer)
+        with metrics.span("generation"):
+            candidates = self._candidates(await transport.achat(GENERATION, **self._get_response_kwargs(n_initial)))
+        extra_n = self.sampling_policy.choose_extra_n(candidates)
+        if extra_n:
+            with metrics.span("generation"):
+                candidates += self._candidates(await transport.achat(GENERATION, **self._get_response_kwargs(extra_n)))
+        ranked_responses = await self.rank_responses(candidates) if len(candidates) > 1 else candidates
+        self._finish_response(candidates, ranked_responses, n_initial)
+        return ranked_responses[0]
+
+    async def respond_to_user(self, content: str, is_me: bool = False) -> str:
+        self._start_turn()
+        split_contents = self.split_content(content)
+        crisis_tasks = [asyncio.create_task(self.is_crisis(split_content)) for split_content in split_contents]
+        for split_content in split_contents:
+            await self._add_message("user", split_content, moderate=False)
+        response_task = asyncio.create_task(self.get_response(is_me))
+        if any(await asyncio.gather(*crisis_tasks)):
+            self.crisis_mode = True
+            if not is_me:
+                response_task.cancel()
+                return self.crisis_response
+        return await response_task
+
+    async def stream_response(self, is_me: bool = False):
+        """Yield the tokens of a single unranked response as they arrive"""
+        if self.crisis_mode and not is_me:
+            yield self.crisis_response
+            return
+
+        with metrics.span("generation"):
+            async with await transport.achat(GENERATION, **self._stream_response_kwargs()) as stream:
+                async for chunk in stream:
+                    if chunk.usage is not None:  # The last chunk
+                        self._count_usage(chunk)
+                        usage.meter.record(GENERATION, chunk.model, chunk.usage)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+
+    async def stream_respond_to_user(self, content: str, is_me: bool = False):
+        """
+        Streaming counterpart of respond_to_user.
+        Tokens are held back until moderation has cleared the message, so a
+        flagged message only ever produces the crisis response.
+        """
+        self._start_turn()
+        split_contents = self.split_content(content)
+        crisis_task = asyncio.ensure_future(asyncio.gather(
+            *[self.is_crisis(split_content) for split_content in split_contents]))
+        for split_content in split_contents:
+            await self._add_message("user", split_content, moderate=False)
+
+        held_tokens = []
+        response_stream = self.stream_response(is_me)
+        try:
+            async for token in response_stream:
+                held_tokens.append(token)
+                if crisis_task.done():
+                    if any(crisis_task.result()) and not is_me:
+                        break
+                    for held_token in held_tokens:
+                        yield held_token
+                    held_tokens = []
+        finally:
+            # Breaking out doesn't close the generator, which would leave the
+            # HTTP stream and its generation span open
+            await response_stream.aclose()
+        if any(await crisis_task):
+            self.crisis_mode = True
+            if not is_me:
+                yield self.crisis_response
+                return
+        for held_token in held_tokens:
+            yield held_token
+
+    async def start_new_session(self, is_me: bool = False) -> str:
+        self._append_message(SESSION_BOUNDARY, "")
+        new_session_message = self.get_new_session_message(is_me=is_me)
+        await self.add_message(role="assistant", content=new_session_message)
+        return new_session_message
+
+
 if __name__ == "__main__":
     carl = CarlBot()
     while True:
         user_input = input("You: ")
-        carl.add_message("user", user_input)
-        response = carl.get_response(True)
+        response = carl.respond_to_user(user_input, True)
         print(f"Carl: {response}")
         carl.add_message("assistant", response)
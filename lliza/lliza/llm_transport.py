@@ -0,0 +1,187 @@
+"""
+Transport for the OpenAI calls CarlBot makes.
+
+One pooled, keep-alive client per process (sync and async), with a deadline
+and retry budget per call type so a slow completion can't hang a worker, and
+optional hedged requests: if a call takes longer than the recent p95 latency
+for its type, a duplicate is fired and whichever finishes first is used.
+The usage of every response is counted by lliza.usage, including the one a
+hedge discards, since OpenAI bills it all the same.
+"""
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Iterable
+
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+
+from lliza import metrics, usage
+
+MODERATION = "moderation"
+GENERATION = "generation"
+RANKING = "ranking"
+SUMMARIZATION = "summarization"
+CALL_TYPES = [MODERATION, GENERATION, RANKING, SUMMARIZATION]
+
+# Seconds per attempt
+DEFAULT_DEADLINES = {
+    MODERATION: 5.0,
+    GENERATION: 20.0,
+    RANKING: 15.0,
+    SUMMARIZATION: 30.0,
+}
+
+
+class LLMTransport:
+
+    def __init__(self,
+                 deadlines: Dict[str, float] = None,
+                 max_retries: int = 1,
+                 max_connections: int = 100,
+                 max_keepalive_connections: int = 20,
+                 hedged_call_types: Iterable[str] = (),
+                 hedge_min_samples: int = 20,
+                 latency_window: int = 200):
+        self.deadlines = {**DEFAULT_DEADLINES, **(deadlines or {})}
+        self.max_retries = max_retries
+        self.hedged_call_types = set(hedged_call_types)
+        self.hedge_min_samples = hedge_min_samples
+        limits = httpx.Limits(max_connections=max_connections,
+                              max_keepalive_connections=max_keepalive_connections)
+        self.client = OpenAI(max_retries=max_retries,
+                             http_client=DefaultHttpxClient(limits=limits))
+        self.async_client = AsyncOpenAI(max_retries=max_retries,
+                                        http_client=DefaultAsyncHttpxClient(limits=limits))
+        self._latencies = defaultdict(lambda: deque(maxlen=latency_window))
+        self._latencies_lock = threading.Lock()
+        self._hedge_executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="llm-hedge")
+        # Async hedges that lost but are left to finish, so their usage is counted
+        self._hedge_losers = set()
+
+    @classmethod
+    def from_env(cls):
+        deadlines = {call_type: float(os.environ[f"LLM_DEADLINE_{call_type.upper()}"])
+                     for call_type in CALL_TYPES if f"LLM_DEADLINE_{call_type.upper()}" in os.environ}
+        hedged_call_types = [call_type for call_type in os.getenv("LLM_HEDGED_CALL_TYPES", "").split(",") if call_type]
+        return cls(deadlines=deadlines,
+                   max_retries=int(os.getenv("LLM_MAX_RETRIES", "1")),
+                   max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "100")),
+                   max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20")),
+                   hedged_call_types=hedged_call_types)
+
+    def _options(self, call_type: str) -> dict:
+        return dict(timeout=self.deadlines[call_type], max_retries=self.max_retries)
+
+    def _record_latency(self, call_type: str, seconds: float):
+        with self._latencies_lock:
+            self._latencies[call_type].append(seconds)
+        metrics.record(f"openai_{call_type}_seconds", seconds)
+
+    def hedge_delay(self, call_type: str):
+        """Seconds to wait before hedging a call, or None if it shouldn't be hedged"""
+        if call_type not in self.hedged_call_types:
+            return None
+        with self._latencies_lock:
+            latencies = list(self._latencies[call_type])
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return metrics.percentile(latencies, 0.95)
+
+    def _call(self, call_type: str, request: Callable):
+        start = time.perf_counter()
+        delay = self.hedge_delay(call_type)
+        if delay is None:
+            result = request()
+        else:
+            first = self._submit(request)
+            done, _ = wait([first], timeout=delay)
+            if done:
+                result = first.result()
+            else:
+                metrics.increment(f"openai_{call_type}_hedged")
+                result = self._first_success([first, self._submit(request)])
+        self._record_latency(call_type, time.perf_counter() - start)
+        return result
+
+    def _submit(self, request: Callable):
+        # Run in a copy of the caller's context, so the usage is counted against its account
+        return self._hedge_executor.submit(contextvars.copy_context().run, request)
+
+    @staticmethod
+    def _first_success(futures):
+        pending = set(futures)
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None or not pending:
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+
+    async def _acall(self, call_type: str, request: Callable):
+        start = time.perf_counter()
+        delay = self.hedge_delay(call_type)
+        if delay is None:
+            result = await request()
+        else:
+            first = asyncio.ensure_future(request())
+            done, _ = await asyncio.wait([first], timeout=delay)
+            if done:
+                result = first.result()
+            else:
+                metrics.increment(f"openai_{call_type}_hedged")
+                result = await self._afirst_success([first, asyncio.ensure_future(request())])
+        self._record_latency(call_type, time.perf_counter() - start)
+        return result
+
+    async def _afirst_success(self, tasks):
+        pending = set(tasks)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None or not pending:
+                    # Like a thread that's already running, the loser isn't cancelled: OpenAI
+                    # bills it anyway, and letting it finish gets its usage counted
+                    self._hedge_losers.update(pending)
+                    for other in pending:
+                        other.add_done_callback(self._hedge_losers.discard)
+                    return task.result()
+
+    @staticmethod
+    def _record_usage(call_type: str, response):
+        # Moderation responses have no usage, so they're just counted as calls
+        usage.meter.record(call_type, response.model, getattr(response, "usage", None))
+        return response
+
+    def _recorded(self, call_type: str, request: Callable) -> Callable:
+        return lambda: self._record_usage(call_type, request())
+
+    def _arecorded(self, call_type: str, request: Callable) -> Callable:
+        async def recorded():
+            return self._record_usage(call_type, await request())
+        return recorded
+
+    def chat(self, call_type: str, **kwargs):
+        client = self.client.with_options(**self._options(call_type))
+        return self._call(call_type, self._recorded(call_type, lambda: client.chat.completions.create(**kwargs)))
+
+    def moderate(self, **kwargs):
+        client = self.client.with_options(**self._options(MODERATION))
+        return self._call(MODERATION, self._recorded(MODERATION, lambda: client.moderations.create(**kwargs)))
+
+    async def achat(self, call_type: str, **kwargs):
+        client = self.async_client.with_options(**self._options(call_type))
+        if kwargs.get("stream"):
+            # Streams can't be hedged, and their latency is only time to first byte.
+            # Their usage comes in the last chunk, for the caller to record.
+            return await client.chat.completions.create(**kwargs)
+        return await self._acall(call_type, self._arecorded(call_type, lambda: client.chat.completions.create(**kwargs)))
+
+    async def amoderate(self, **kwargs):
+        client = self.async_client.with_options(**self._options(MODERATION))
+        return await self._acall(MODERATION, self._arecorded(MODERATION, lambda: client.moderations.create(**kwargs)))
@@ -0,0 +1,28 @@
+from ast import literal_eval
+
+from django.core.management.base import BaseCommand
+from django_q.models import Schedule
+
+from lliza import crypto
+from lliza.models import User, UserSchedule
+from lliza.utils import ENCRYPTION_KEY, hash_number
+
+
+class Command(BaseCommand):
+    help = "Link existing start_session schedules to their users"
+
+    def handle(self, *args, **options):
+        schedules = Schedule.objects.filter(
+            func="lliza.twilio_views.start_session",
+            user_schedule__isnull=True)
+        n_linked = 0
+        for schedule in schedules:
+            user_id = literal_eval(schedule.args)[0]
+            number = crypto.decrypt(user_id, ENCRYPTION_KEY)
+            user = User.objects.filter(number_hash=hash_number(number)).first() if number else None
+            if user is None:
+                self.stderr.write(f"No user for schedule {schedule.id}, skipping")
+                continue
+            UserSchedule.objects.create(user=user, schedule=schedule)
+            n_linked += 1
+        self.stdout.write(f"Linked {n_linked} schedules")
@@ -0,0 +1,58 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from django.utils import timezone
+
+from lliza.models import UsageCounter
+from lliza.usage import USAGE_FIELDS
+
+# USD per million (prompt, cached prompt, completion) tokens, by model prefix
+PRICES = {
+    "ft:gpt-4o-mini": (0.30, 0.15, 1.20),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+
+
+def cost(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    """Estimated USD cost, 0 for models without a price (e.g. moderation, which is free)"""
+    for prefix, (prompt_price, cached_price, completion_price) in PRICES.items():
+        if model.startswith(prefix):
+            return ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price
+                    + completion_tokens * completion_price) / 1e6
+    return 0.0
+
+
+class Command(BaseCommand):
+    help = "Report OpenAI token usage and estimated cost by call type and model, and the heaviest users"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=7, help="Days to report, including today")
+        parser.add_argument("--users", type=int, default=10, help="Number of heaviest users to list")
+
+    def handle(self, *args, **options):
+        since = timezone.now().date() - timedelta(days=options["days"] - 1)
+        counters = UsageCounter.objects.filter(day__gte=since)
+        sums = {field: Sum(field) for field in USAGE_FIELDS}
+
+        self.stdout.write(f"OpenAI usage since {since}")
+        self.stdout.write(f"{'call type':<14}{'model':<60}{'calls':>9}{'prompt':>12}{'cached':>12}{'completion':>12}{'cost $':>10}")
+        total_cost = 0.0
+        for row in counters.values("call_type", "model").annotate(**sums).order_by("call_type", "model"):
+            row_cost = cost(row["model"], row["prompt_tokens"], row["cached_tokens"], row["completion_tokens"])
+            total_cost += row_cost
+            self.stdout.write(f"{row['call_type']:<14}{row['model']:<60}{row['n_calls']:>9}{row['prompt_tokens']:>12}"
+                              f"{row['cached_tokens']:>12}{row['completion_tokens']:>12}{row_cost:>10.4f}")
+        self.stdout.write(f"Total estimated cost ${total_cost:.2f}")
+
+        # Costs are summed per model, since each user's calls can use several
+        user_costs = {}
+        for row in counters.values("user", "model").annotate(**sums):
+            user_costs.setdefault(row["user"], [0, 0.0])
+            user_costs[row["user"]][0] += row["prompt_tokens"] + row["completion_tokens"]
+            user_costs[row["user"]][1] += cost(row["model"], row["prompt_tokens"], row["cached_tokens"], row["completion_tokens"])
+        heaviest = sorted(user_costs.items(), key=lambda item: -item[1][1])[:options["users"]]
+        if heaviest:
+            self.stdout.write(f"\n{'user':<12}{'tokens':>12}{'cost $':>10}")
+            for user_pk, (n_tokens, user_cost) in heaviest:
+                self.stdout.write(f"{user_pk if user_pk is not None else 'none':<12}{n_tokens:>12}{user_cost:>10.4f}")
@@ -0,0 +1,107 @@
+"""
+In-process latency metrics and counters.
+Each worker keeps a bounded window of recent samples per metric name,
+which the metrics view reports as percentiles, and a running total per counter.
+
+Stages of a request are timed with span, which also adds the time to a
+histogram of all the stage's durations since the worker started. Spans inside
+a trace (a webhook, voice prompt or session start) are totalled per stage, so
+slow traces can be logged with where their time went.
+"""
+import contextvars
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+MAX_SAMPLES = 1000
+HISTOGRAM_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Upper bounds in seconds
+SLOW_TRACE_SECONDS = 10  # Traces slower than this are logged with their stage breakdown
+
+_samples = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+_counters = defaultdict(int)
+_histograms = defaultdict(lambda: [0] * (len(HISTOGRAM_BUCKETS) + 1))  # Count per bucket, then over the last
+_histogram_sums = defaultdict(float)
+_lock = threading.Lock()
+_trace_stages = contextvars.ContextVar("trace_stages", default=None)
+
+def record(name: str, value: float):
+    with _lock:
+        _samples[name].append(value)
+
+def observe(name: str, seconds: float):
+    """Record a duration as a sample and in the name's histogram"""
+    bucket = next((i for i, bound in enumerate(HISTOGRAM_BUCKETS) if seconds <= bound), len(HISTOGRAM_BUCKETS))
+    with _lock:
+        _samples[name].append(seconds)
+        _histograms[name][bucket] += 1
+        _histogram_sums[name] += seconds
+
+@contextmanager
+def span(stage: str):
+    """Time a stage, as stage_<stage>_seconds, and add it to the current trace"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        observe(f"stage_{stage}_seconds", seconds)
+        stages = _trace_stages.get()
+        if stages is not None:
+            stages[stage] += seconds
+
+@contextmanager
+def trace(name: str, log: Callable[[str], None] = print):
+    """
+    Time a whole request, as <name>_seconds, logging the time spent in each
+    stage if it was slow. Also usable as a decorator of sync functions.
+    Threads started inside need copy_context().run to add to it.
+    """
+    stages = Counter()
+    token = _trace_stages.set(stages)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _trace_stages.reset(token)
+        seconds = time.perf_counter() - start
+        observe(f"{name}_seconds", seconds)
+        if seconds > SLOW_TRACE_SECONDS:
+            breakdown = ", ".join(f"{stage} {stage_seconds:.2f}s" for stage, stage_seconds in stages.most_common())
+            log(f"Slow {name} took {seconds:.2f}s: {breakdown}")
+
+def increment(name: str, n: int = 1):
+    with _lock:
+        _counters[name] += n
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(q * len(ordered)))
+    return ordered[index]
+
+def summary() -> Dict[str, Dict[str, float]]:
+    with _lock:
+        snapshot = {name: list(values) for name, values in _samples.items()}
+        counters = dict(_counters)
+        histograms = {name: (list(counts), _histogram_sums[name]) for name, counts in _histograms.items()}
+    stats = {name: {"total": total} for name, total in counters.items()}
+    stats.update({
+        name: {
+            "count": len(values),
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 0.50),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+        }
+        for name, values in snapshot.items() if values
+    })
+    for name, (counts, total_seconds) in histograms.items():
+        # Cumulative like Prometheus' le buckets, with the count and sum over all time
+        cumulative = [sum(counts[:i + 1]) for i in range(len(counts))]
+        stats[name]["histogram"] = {
+            **{str(bound): n for bound, n in zip(HISTOGRAM_BUCKETS, cumulative)},
+            "+Inf": cumulative[-1],
+        }
+        stats[name]["histogram_sum"] = total_seconds
+    return stats
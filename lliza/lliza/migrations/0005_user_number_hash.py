@@ -0,0 +1,35 @@
+# Generated by Django 5.1.1 on 2026-10-18 12:00
+
+import hashlib
+import hmac
+import os
+
+import cryptocode
+from django.db import migrations, models
+
+
+def backfill_number_hash(apps, schema_editor):
+    User = apps.get_model('lliza', 'User')
+    encryption_key = os.getenv("ENCRYPTION_KEY")
+    for user in User.objects.filter(number_hash__isnull=True):
+        number = cryptocode.decrypt(user.user_id, encryption_key)
+        if not number:
+            continue
+        user.number_hash = hmac.new(encryption_key.encode(), number.encode(), hashlib.sha256).hexdigest()
+        user.save(update_fields=['number_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lliza', '0004_user_last_message_time_user_num_messages'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='number_hash',
+            field=models.CharField(max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_number_hash, migrations.RunPython.noop),
+    ]
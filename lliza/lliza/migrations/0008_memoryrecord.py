@@ -0,0 +1,73 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:45
+
+import json
+import os
+
+import cryptocode
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_memory_dicts_to_records(apps, schema_editor):
+    User = apps.get_model('lliza', 'User')
+    MemoryRecord = apps.get_model('lliza', 'MemoryRecord')
+    encryption_key = os.getenv("ENCRYPTION_KEY")
+
+    def encrypt(content):
+        return cryptocode.encrypt(json.dumps(content), encryption_key)
+
+    for user in User.objects.filter(encrypted_memory_dict_string__isnull=False):
+        decrypted = cryptocode.decrypt(user.encrypted_memory_dict_string, encryption_key)
+        if not decrypted:
+            continue
+        memory_dict = json.loads(decrypted)
+        dialogue_offset = memory_dict.get('dialogue_offset', 0)
+        records = [MemoryRecord(user=user, kind='dialogue', seq=dialogue_offset + i, encrypted_content=encrypt(message))
+                   for i, message in enumerate(memory_dict['dialogue_buffer'])]
+        records += [MemoryRecord(user=user, kind='summary', seq=i, encrypted_content=encrypt(bullet))
+                    for i, bullet in enumerate(memory_dict['summary_buffer'])]
+        MemoryRecord.objects.bulk_create(records)
+        user.dialogue_offset = dialogue_offset
+        user.summary_offset = 0
+        user.crisis_mode = memory_dict['crisis_mode']
+        user.encrypted_memory_dict_string = None
+        user.save(update_fields=['dialogue_offset', 'summary_offset', 'crisis_mode', 'encrypted_memory_dict_string'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lliza', '0007_pendingsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='crisis_mode',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='dialogue_offset',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='summary_offset',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='MemoryRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('dialogue', 'Dialogue'), ('summary', 'Summary'), ('summary_point', 'Summary point')], max_length=16)),
+                ('seq', models.IntegerField()),
+                ('encrypted_content', models.TextField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memory_records', to='lliza.user')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'kind', 'seq'), name='unique_memory_record')],
+            },
+        ),
+        migrations.RunPython(move_memory_dicts_to_records, migrations.RunPython.noop),
+    ]
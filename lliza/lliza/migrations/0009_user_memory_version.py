@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lliza', '0008_memoryrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='memory_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lliza', '0009_user_memory_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='turn_claimed_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.CreateModel(
+            name='InboxMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('encrypted_content', models.TextField()),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_messages', to='lliza.user')),
+            ],
+        ),
+    ]
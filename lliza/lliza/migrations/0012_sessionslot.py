@@ -0,0 +1,64 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:04
+
+from ast import literal_eval
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+START_SESSION_FUNC = 'lliza.twilio_views.start_session'
+DISPATCH_FUNC = 'lliza.scheduler.dispatch_due_sessions'
+
+
+def move_schedules_to_slots(apps, schema_editor):
+    """
+    Replace each user's start_session Schedules with SessionSlots, and schedule the dispatcher.
+    Schedules not linked to a user by backfill_user_schedules are left to run start_session as before.
+    """
+    Schedule = apps.get_model('django_q', 'Schedule')
+    SessionSlot = apps.get_model('lliza', 'SessionSlot')
+    schedules = Schedule.objects.filter(func=START_SESSION_FUNC, user_schedule__isnull=False)
+    for schedule in schedules.select_related('user_schedule__user'):
+        _, call_or_text = literal_eval(schedule.args)
+        if not schedule.cron or schedule.next_run is None:
+            continue
+        SessionSlot.objects.create(user=schedule.user_schedule.user, call_or_text=call_or_text,
+                                   cron=schedule.cron, next_run=schedule.next_run)
+        schedule.delete()
+    Schedule.objects.get_or_create(
+        func=DISPATCH_FUNC,
+        defaults={'name': 'Dispatch due sessions', 'schedule_type': 'I', 'minutes': 1, 'repeats': -1})
+
+
+def move_slots_to_schedules(apps, schema_editor):
+    """Recreate a start_session Schedule for each SessionSlot, and remove the dispatcher"""
+    Schedule = apps.get_model('django_q', 'Schedule')
+    UserSchedule = apps.get_model('lliza', 'UserSchedule')
+    SessionSlot = apps.get_model('lliza', 'SessionSlot')
+    for slot in SessionSlot.objects.select_related('user'):
+        schedule = Schedule.objects.create(
+            func=START_SESSION_FUNC, args=repr((slot.user.user_id, slot.call_or_text)), kwargs='{}',
+            schedule_type='C', cron=slot.cron, next_run=slot.next_run, repeats=-1)
+        UserSchedule.objects.create(user=slot.user, schedule=schedule)
+    Schedule.objects.filter(func=DISPATCH_FUNC).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_q', '0019_alter_task_options_alter_ormq_key_alter_ormq_lock_and_more'),
+        ('lliza', '0011_processedevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionSlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('call_or_text', models.CharField(max_length=8)),
+                ('cron', models.CharField(max_length=64)),
+                ('next_run', models.DateTimeField(db_index=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='session_slots', to='lliza.user')),
+            ],
+        ),
+        migrations.RunPython(move_schedules_to_slots, move_slots_to_schedules),
+    ]
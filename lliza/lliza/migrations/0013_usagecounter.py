@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lliza', '0012_sessionslot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('call_type', models.CharField(max_length=16)),
+                ('model', models.CharField(max_length=128)),
+                ('n_calls', models.IntegerField(default=0)),
+                ('prompt_tokens', models.BigIntegerField(default=0)),
+                ('cached_tokens', models.BigIntegerField(default=0)),
+                ('completion_tokens', models.BigIntegerField(default=0)),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='usage_counters', to='lliza.user')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'day', 'call_type', 'model'), name='unique_usage_counter')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lliza', '0013_usagecounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sessionslot',
+            name='claimed_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
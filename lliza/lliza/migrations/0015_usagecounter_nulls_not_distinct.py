@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lliza', '0014_sessionslot_claimed_at'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='usagecounter',
+            name='unique_usage_counter',
+        ),
+        migrations.AddConstraint(
+            model_name='usagecounter',
+            constraint=models.UniqueConstraint(fields=('user', 'day', 'call_type', 'model'), name='unique_usage_counter', nulls_distinct=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lliza', '0015_usagecounter_nulls_not_distinct'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='summary_requested_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
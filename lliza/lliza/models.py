@@ -1,4 +1,5 @@
 from django.db import models
+from django_q.models import Schedule
 
 class User(models.Model):
     """
@@ -9,7 +10,120 @@ class User(models.Model):
     - settings: JSONField - General settings of the pipeline.
     """
     user_id = models.CharField(max_length=255)
-    encrypted_memory_dict_string = models.TextField(null=True)
+    number_hash = models.CharField(max_length=64, null=True, unique=True)  # HMAC of the phone number, used for lookups
+    encrypted_memory_dict_string = models.TextField(null=True)  # Legacy whole-memory blob, superseded by MemoryRecord
+    # Where the active windows of the user's MemoryRecords start
+    dialogue_offset = models.IntegerField(default=0)
+    summary_offset = models.IntegerField(default=0)
+    crisis_mode = models.BooleanField(default=False)
+    memory_version = models.IntegerField(default=0)  # Bumped on every memory write, checked by the bot state cache and save_carlbot
+    turn_claimed_at = models.DateTimeField(null=True)  # Set while a worker is running a turn for the user, see utils.claim_turn
+    summary_requested_at = models.DateTimeField(null=True)  # Set while a background summary is queued or running, see utils.schedule_summary
     opt_out = models.BooleanField(default=False)
     last_message_time = models.DateTimeField(auto_now=True)
-    num_messages = models.IntegerField(default=0)
\ No newline at end of file
+    num_messages = models.IntegerField(default=0)
+
+class MemoryRecord(models.Model):
+    """
+    One encrypted message or summary bullet of a user's CarlBot memory.
+    Records are append-only, so a turn only writes the records it added.
+    """
+    DIALOGUE = 'dialogue'  # A message, in dialogue order
+    SUMMARY = 'summary'  # A bullet of the summary buffer
+    SUMMARY_POINT = 'summary_point'  # A bullet summarizing raw dialogue, kept for all_summary_points
+    KIND_CHOICES = [
+        (DIALOGUE, 'Dialogue'),
+        (SUMMARY, 'Summary'),
+        (SUMMARY_POINT, 'Summary point'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='memory_records')
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    seq = models.IntegerField()
+    encrypted_content = models.TextField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'kind', 'seq'], name='unique_memory_record'),
+        ]
+
+class UserSchedule(models.Model):
+    """
+    Links a django-q Schedule to the User it starts sessions for, so a user's
+    schedules can be found without decrypting every Schedule's args.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='user_schedules')
+    schedule = models.OneToOneField(Schedule, on_delete=models.CASCADE, related_name='user_schedule')
+
+
+class SessionSlot(models.Model):
+    """
+    A weekly time to start a session with a user. Due slots are started in
+    batches by lliza.scheduler.dispatch_due_sessions, which runs every minute.
+    """
+    TEXT = 'Text'
+    CALL = 'Call'
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='session_slots')
+    call_or_text = models.CharField(max_length=8)
+    cron = models.CharField(max_length=64)  # In UTC
+    next_run = models.DateTimeField(db_index=True)
+    claimed_at = models.DateTimeField(null=True)  # Set while this run is being started, see scheduler.dispatch_due_sessions
+
+
+class PendingSummary(models.Model):
+    """
+    A summary of a user's oldest messages made by a background task,
+    applied to their CarlBot the next time it is loaded.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='pending_summary')
+    encrypted_summary_string = models.TextField()
+
+
+class InboxMessage(models.Model):
+    """
+    A message from a user waiting to be answered. A burst of texts collects
+    here while one worker runs a turn, and is answered together in its next one.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='inbox_messages')
+    encrypted_content = models.TextField()
+    received_at = models.DateTimeField(auto_now_add=True)
+
+
+class ProcessedEvent(models.Model):
+    """
+    A Twilio webhook already handled, so a retried or duplicate delivery can be
+    ignored. Expired by lliza.dedup.DedupStore once Twilio won't retry it.
+    """
+    INBOUND_MESSAGE = 'inbound'  # Keyed by MessageSid
+    MESSAGE_STATUS = 'status'  # Keyed by MessageSid and status
+
+    kind = models.CharField(max_length=16)
+    key = models.CharField(max_length=64)
+    processed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'key'], name='unique_processed_event'),
+        ]
+
+class UsageCounter(models.Model):
+    """
+    OpenAI usage summed per user, day, call type and model.
+    Added to in batches by each worker's lliza.usage.UsageMeter.
+    """
+    user = models.ForeignKey(User, null=True, on_delete=models.CASCADE, related_name='usage_counters')  # None for calls outside a user's turn
+    day = models.DateField()
+    call_type = models.CharField(max_length=16)
+    model = models.CharField(max_length=128)
+    n_calls = models.IntegerField(default=0)
+    prompt_tokens = models.BigIntegerField(default=0)
+    cached_tokens = models.BigIntegerField(default=0)  # Of the prompt tokens
+    completion_tokens = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Also unique for calls outside a user's turn, whose user is NULL
+            models.UniqueConstraint(fields=['user', 'day', 'call_type', 'model'], name='unique_usage_counter',
+                                    nulls_distinct=False),
+        ]
@@ -0,0 +1,111 @@
+"""
+Queue for outbound SMS.
+Messages are sent in the background by a small pool of threads sharing one
+Twilio client, rate limited so fan-outs (e.g. many scheduled session starts at
+once) don't trip Twilio's throughput limits or block the caller.
+Messages to the same number are sent one at a time, in the order they were
+enqueued, including retries.
+The queue is in memory, so messages still in it are lost if the process
+stops; replies to a user are sent synchronously instead, and callers such as
+the session scheduler flush it before they finish.
+"""
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+
+class OutboundMessageQueue:
+
+    def __init__(self, send: Callable[[str, str], None], max_per_second: float,
+                 batch_size: int = 10, n_senders: int = 4, max_attempts: int = 3,
+                 log: Callable[[str], None] = print):
+        """
+        :param send: Function which sends one message, called as send(to, body)
+        :param max_per_second: Most messages to start sending per second
+        :param batch_size: Most messages handed to the senders at once
+        :param n_senders: Number of threads sending messages
+        :param max_attempts: Times to try a message before giving up on it
+        """
+        self.send = send
+        self.min_interval = 1 / max_per_second
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.log = log
+        self._queue = queue.Queue()
+        self._senders = ThreadPoolExecutor(max_workers=n_senders, thread_name_prefix="outbound-sender")
+        self._n_unfinished = 0
+        self._unfinished_lock = threading.Condition()
+        self._dispatcher = None
+        self._dispatcher_lock = threading.Lock()
+        # Numbers with a message being sent -> messages waiting behind it
+        self._waiting = {}
+        self._waiting_lock = threading.Lock()
+
+    def enqueue(self, to: str, body: str):
+        with self._unfinished_lock:
+            self._n_unfinished += 1
+        self._queue.put((to, body, 1, False))
+        self._ensure_dispatcher()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait for every enqueued message to be sent or given up on"""
+        with self._unfinished_lock:
+            return self._unfinished_lock.wait_for(lambda: self._n_unfinished == 0, timeout)
+
+    def _ensure_dispatcher(self):
+        # Started lazily so the thread belongs to the process which sends,
+        # e.g. a django-q worker rather than the process which forked it
+        with self._dispatcher_lock:
+            if self._dispatcher is None or not self._dispatcher.is_alive():
+                self._dispatcher = threading.Thread(target=self._dispatch, name="outbound-dispatcher", daemon=True)
+                self._dispatcher.start()
+
+    def _dispatch(self):
+        next_send_time = time.monotonic()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for to, body, attempt, is_next in batch:
+                with self._waiting_lock:
+                    if not is_next:
+                        if to in self._waiting:
+                            # Wait for the message being sent to this number
+                            self._waiting[to].append((body, attempt))
+                            continue
+                        self._waiting[to] = deque()
+                delay = next_send_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_send_time = max(next_send_time, time.monotonic()) + self.min_interval
+                self._senders.submit(self._send, to, body, attempt)
+
+    def _send(self, to: str, body: str, attempt: int):
+        finished = True
+        try:
+            self.send(to, body)
+        except Exception as e:
+            if attempt < self.max_attempts:
+                self.log(f"Error sending message (attempt {attempt}), retrying: {e}")
+                finished = False
+            else:
+                self.log(f"Error sending message, giving up after {attempt} attempts: {e}")
+        with self._waiting_lock:
+            waiting = self._waiting[to]
+            if not finished:
+                waiting.appendleft((body, attempt + 1))
+            if waiting:
+                # Hand the number's next message back to the dispatcher, so it's rate limited
+                self._queue.put((to, *waiting.popleft(), True))
+            else:
+                del self._waiting[to]
+        if finished:
+            with self._unfinished_lock:
+                self._n_unfinished -= 1
+                self._unfinished_lock.notify_all()
@@ -0,0 +1,189 @@
+"""
+Rankers order CarlBot's candidate responses, best first.
+
+LLMRanker asks the summarizer model to rank them, which costs a completion
+per turn. HeuristicRanker scores them in-process in well under a millisecond
+using a few features of what a good Rogerian reflection looks like.
+"""
+import os
+import re
+from typing import Callable, Dict, List
+
+from lliza.llm_transport import LLMTransport, RANKING
+
+RANKER = os.getenv("RANKER", "llm")  # "llm" or "heuristic"
+
+
+def stringify_dialogue(dialogue: List[Dict[str, str]]) -> str:
+    return "\n".join([
+        f"{message['role']}: {message['content']}" for message in dialogue
+    ])
+
+
+class Ranker:
+
+    def rank(self, dialogue: List[Dict[str, str]], responses: List[str]) -> List[str]:
+        """Return the responses ordered from most to least appropriate for the dialogue"""
+        raise NotImplementedError
+
+    async def arank(self, dialogue: List[Dict[str, str]], responses: List[str]) -> List[str]:
+        return self.rank(dialogue, responses)
+
+
+RANKING_INSTRUCTIONS = """
+Below is the context for a dialogue, followed by some possible responses.
+Your task is to rank the responses in order of appropriateness for the context.
+Heavily penalize responses which hallucinate things that were not in the context or merely repeat the client's words. Reward responses which are empathetic, congruent, and reflect the client's feelings and attitudes.
+Without yet ranking them, write a terse explanation of each ranking choice's appropriateness in the order they were presented (ie Response 1, Response 2...).
+Then on a new line write a comma-separated list of the response numbers in order of appropriateness.
+E.g. "2,1,3"
+"""
+
+
+class LLMRanker(Ranker):
+
+    def __init__(self, transport: LLMTransport, model: str, on_completion: Callable = None):
+        """
+        :param on_completion: Called with each ranking completion, e.g. to count its tokens
+        """
+        self.transport = transport
+        self.model = model
+        self.on_completion = on_completion
+
+    def _rank_kwargs(self, dialogue: List[Dict[str, str]], responses: List[str]) -> dict:
+        # The instructions are a fixed system message so they're a cacheable
+        # prompt prefix; the dialogue and responses follow
+        ranking_data = f"""[BEGIN DATA]
+***
+{stringify_dialogue(dialogue)}
+***
+"""
+        for i, response in enumerate(responses, start=1):
+            ranking_data += f"[Response {i}]\n{response}\n\n"
+        ranking_data += "[END DATA]"
+        return dict(
+            model=self.model,
+            messages=[{"role": "system", "content": RANKING_INSTRUCTIONS},
+                      {"role": "user", "content": ranking_data}],
+            max_tokens=100*len(responses),  # 100 left unfinished bullets
+            temperature=0.0)
+
+    @staticmethod
+    def parse_ranking(ranking: str, responses: List[str]) -> List[str]:
+        """
+        Read the ranking from the last line which is a list of response numbers.
+        Responses the model left out keep their original order at the end, and
+        if there's no ranking at all the responses are returned as they were.
+        """
+        order = []
+        for line in reversed(ranking.strip().split("\n")):
+            line = line.strip().strip('."\'')
+            if re.fullmatch(r"\d+(\s*,\s*\d+)*", line):
+                order = [int(rank) - 1 for rank in line.split(",")]
+                break
+        order = [i for i in dict.fromkeys(order) if 0 <= i < len(responses)]
+        order += [i for i in range(len(responses)) if i not in order]
+        return [responses[i] for i in order]
+
+    def _parse_completion(self, completion, responses: List[str]) -> List[str]:
+        if self.on_completion is not None:
+            self.on_completion(completion)
+        return self.parse_ranking(completion.choices[0].message.content, responses)
+
+    def rank(self, dialogue: List[Dict[str, str]], responses: List[str]) -> List[str]:
+        completion = self.transport.chat(RANKING, **self._rank_kwargs(dialogue, responses))
+        return self._parse_completion(completion, responses)
+
+    async def arank(self, dialogue: List[Dict[str, str]], responses: List[str]) -> List[str]:
+        completion = await self.transport.achat(RANKING, **self._rank_kwargs(dialogue, responses))
+        return self._parse_completion(completion, responses)
+
+
+class HeuristicRanker(Ranker):
+    """
+    Scores each response on:
+    - overlap with the client's last message (a reflection should pick up their
+      words), but penalized when it's so high the response just parrots them
+    - questions and advice, which the system prompt tells the bot not to give
+    - length, preferring short replies
+    - repetition of the bot's own recent replies
+    - reflective feeling language
+    """
+    STOPWORDS = set("""
+        a an the and or but if so to of in on at for with about as by from into is are was were be been am
+        it its this that these those i me my you your we our they them their he she his her him do does did
+        have has had not no just very really what there here then than too can could would will
+    """.split())
+    ADVICE_PATTERNS = [
+        r"\byou should\b", r"\byou could\b", r"\btry\b", r"\bhave you (considered|tried|thought about)\b",
+        r"\bi (suggest|recommend)\b", r"\bwhy don't you\b", r"\bmake sure\b", r"\bit might help\b", r"\bmaybe you\b",
+    ]
+    REFLECTION_PATTERNS = [
+        r"\bfeel", r"\bsounds like\b", r"\bsense\b", r"\byou're\b", r"\byou are\b", r"\bseems\b", r"\bi hear\b",
+    ]
+
+    def __init__(self,
+                 overlap_weight=2.0,
+                 parrot_threshold=0.6,
+                 parrot_penalty=3.0,
+                 question_penalty=1.0,
+                 advice_penalty=1.5,
+                 reflection_weight=0.5,
+                 repetition_penalty=2.0,
+                 ideal_max_words=40,
+                 length_penalty=0.05,
+                 n_recent_replies=5):
+        self.overlap_weight = overlap_weight
+        self.parrot_threshold = parrot_threshold
+        self.parrot_penalty = parrot_penalty
+        self.question_penalty = question_penalty
+        self.advice_penalty = advice_penalty
+        self.reflection_weight = reflection_weight
+        self.repetition_penalty = repetition_penalty
+        self.ideal_max_words = ideal_max_words
+        self.length_penalty = length_penalty
+        self.n_recent_replies = n_recent_replies
+
+    def content_words(self, text: str) -> set:
+        return {word for word in re.findall(r"[a-z']+", text.lower()) if word not in self.STOPWORDS}
+
+    @staticmethod
+    def overlap(words: set, other_words: set) -> float:
+        """Fraction of words which are in other_words"""
+        if not words:
+            return 0.0
+        return len(words & other_words) / len(words)
+
+    def score(self, dialogue: List[Dict[str, str]], response: str) -> float:
+        client_messages = [message["content"] for message in dialogue if message["role"] == "user"]
+        recent_replies = [message["content"] for message in dialogue if message["role"] == "assistant"][-self.n_recent_replies:]
+        response_words = self.content_words(response)
+        lowered = response.lower()
+
+        score = 0.0
+        if client_messages:
+            client_words = self.content_words(client_messages[-1])
+            overlap = self.overlap(client_words, response_words)
+            score += self.overlap_weight * overlap
+            if self.overlap(response_words, client_words) > self.parrot_threshold:
+                score -= self.parrot_penalty
+        score -= self.question_penalty * response.count("?")
+        score -= self.advice_penalty * sum(bool(re.search(pattern, lowered)) for pattern in self.ADVICE_PATTERNS)
+        score += self.reflection_weight * sum(bool(re.search(pattern, lowered)) for pattern in self.REFLECTION_PATTERNS)
+        n_words = len(response.split())
+        score -= self.length_penalty * max(0, n_words - self.ideal_max_words)
+        if recent_replies:
+            score -= self.repetition_penalty * max(
+                self.overlap(response_words, self.content_words(reply)) for reply in recent_replies)
+        return score
+
+    def rank(self, dialogue: List[Dict[str, str]], responses: List[str]) -> List[str]:
+        return sorted(responses, key=lambda response: -self.score(dialogue, response))
+
+
+def make_ranker(name: str, transport: LLMTransport, model: str, on_completion: Callable = None) -> Ranker:
+    if name == "llm":
+        return LLMRanker(transport, model, on_completion)
+    if name == "heuristic":
+        return HeuristicRanker()
+    raise ValueError(f"Unknown ranker {name}")
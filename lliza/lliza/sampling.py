@@ -0,0 +1,118 @@
+"""
+Policy for how many candidate responses CarlBot generates and ranks per turn.
+
+Generating a fixed 5 candidates multiplies output tokens and the ranking
+prompt even when the client just said "ok". Instead:
+- trivial messages (acknowledgements like "ok thanks") get 1 candidate and
+  no ranking. Short isn't enough: "dad died" is two words
+- the first few turns of a conversation get the full max_n, since they set the
+  tone
+- otherwise initial_n candidates are generated first, and more only if they
+  disagree with each other (early stopping)
+- if the ranker rarely prefers the extra candidates, fewer extras are requested
+"""
+import os
+import re
+import threading
+from collections import deque
+from typing import Dict, List
+
+ACKNOWLEDGEMENTS = {
+    "ok", "okay", "k", "thanks", "thank you", "thx", "yes", "yeah", "yep", "no", "nope",
+    "sure", "cool", "got it", "alright", "right", "bye", "goodbye", "hi", "hello", "hey",
+}
+
+
+def words(text: str) -> set:
+    return set(re.findall(r"[a-z']+", text.lower()))
+
+
+def similarity(text: str, other_text: str) -> float:
+    """Jaccard similarity of the words in two texts"""
+    text_words, other_words = words(text), words(other_text)
+    if not text_words and not other_words:
+        return 1.0
+    return len(text_words & other_words) / len(text_words | other_words)
+
+
+class SamplingPolicy:
+
+    def __init__(self,
+                 max_n: int = 5,
+                 initial_n: int = 2,
+                 early_stage_replies: int = 2,
+                 agreement_threshold: float = 0.5,
+                 min_extra_win_rate: float = 0.2,
+                 min_escalations: int = 20,
+                 history_size: int = 200):
+        """
+        :param max_n: Most candidates generated in a turn
+        :param initial_n: Candidates generated before deciding whether more are needed
+        :param early_stage_replies: Turns until the bot has replied this many times get max_n candidates
+        :param agreement_threshold: Word similarity above which initial candidates agree
+        :param min_extra_win_rate: If the ranker picks an extra candidate less often than this,
+            only one extra candidate is requested
+        :param min_escalations: Escalations seen before trusting the win rate
+        :param history_size: Recent escalations to compute the win rate over
+        """
+        self.max_n = max_n
+        self.initial_n = min(initial_n, max_n)
+        self.early_stage_replies = early_stage_replies
+        self.agreement_threshold = agreement_threshold
+        self.min_extra_win_rate = min_extra_win_rate
+        self.min_escalations = min_escalations
+        self._extra_wins = deque(maxlen=history_size)
+        self._extra_wins_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        # SAMPLING_INITIAL_N=5 restores a fixed 5 candidates per turn
+        return cls(max_n=int(os.getenv("SAMPLING_MAX_N", "5")),
+                   initial_n=int(os.getenv("SAMPLING_INITIAL_N", "2")))
+
+    def is_trivial(self, content: str) -> bool:
+        """Whether the message is nothing but acknowledgements, like ok thanks"""
+        message_words = re.findall(r"[a-z']+", content.lower())
+        i = 0
+        while i < len(message_words):
+            if " ".join(message_words[i:i + 2]) in ACKNOWLEDGEMENTS:
+                i += 2
+            elif message_words[i] in ACKNOWLEDGEMENTS:
+                i += 1
+            else:
+                return False
+        return bool(message_words)
+
+    def choose_n(self, dialogue: List[Dict[str, str]]) -> int:
+        """Number of candidates to generate first for the reply to dialogue"""
+        client_messages = [message["content"] for message in dialogue if message["role"] == "user"]
+        n_replies = sum(message["role"] == "assistant" for message in dialogue)
+        if client_messages and self.is_trivial(client_messages[-1]):
+            return 1
+        if n_replies < self.early_stage_replies:
+            return self.max_n
+        return self.initial_n
+
+    def agree(self, candidates: List[str]) -> bool:
+        return all(similarity(candidate, other) >= self.agreement_threshold
+                   for i, candidate in enumerate(candidates) for other in candidates[i + 1:])
+
+    def extra_wins_rate(self):
+        with self._extra_wins_lock:
+            if len(self._extra_wins) < self.min_escalations:
+                return None
+            return sum(self._extra_wins) / len(self._extra_wins)
+
+    def choose_extra_n(self, candidates: List[str]) -> int:
+        """Number of extra candidates to generate after the first ones, 0 to stop early"""
+        if len(candidates) < 2 or len(candidates) >= self.max_n or self.agree(candidates):
+            return 0
+        extra_wins_rate = self.extra_wins_rate()
+        if extra_wins_rate is not None and extra_wins_rate < self.min_extra_win_rate:
+            return 1
+        return self.max_n - len(candidates)
+
+    def record_escalation(self, extra_won: bool):
+        """Record whether the ranker picked one of the extra candidates"""
+        with self._extra_wins_lock:
+            self._extra_wins.append(extra_won)
@@ -0,0 +1,86 @@
+"""
+Batched session starts.
+
+A single django-q Schedule runs dispatch_due_sessions every minute. It claims
+the SessionSlots which are due and hands them to the cluster's workers in
+chunks. A slot is only moved on to its next run once its session has started,
+so a start which fails, or whose task is lost, is retried by a later dispatch. Each chunk is started with bounded
+parallelism, so a popular time (e.g. Monday 9am) fans out across workers and
+threads instead of running one start_session after another.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from django_q import tasks
+
+from lliza import metrics
+from lliza.models import SessionSlot
+from lliza.twilio_views import start_user_session
+from lliza.utils import log_message, next_cron_time, outbound_queue
+
+SESSION_DISPATCH_CHUNK_SIZE = int(os.getenv("SESSION_DISPATCH_CHUNK_SIZE", "20"))  # Sessions per django-q task
+SESSION_START_PARALLELISM = int(os.getenv("SESSION_START_PARALLELISM", "8"))  # Sessions each task starts at once
+SESSION_MAX_LAG = timedelta(hours=1)  # Sessions missed by more than this (e.g. during an outage) are skipped
+SESSION_CLAIM_LEASE = timedelta(minutes=10)  # A claimed session not started by then is dispatched again
+
+def dispatch_due_sessions():
+    """Claim the due SessionSlots and queue them to be started in chunks"""
+    now = timezone.now()
+    unclaimed = Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - SESSION_CLAIM_LEASE)
+    due = SessionSlot.objects.filter(unclaimed, next_run__lte=now).order_by('next_run').values_list('pk', 'cron', 'next_run')
+    claimed = []
+    n_skipped = 0
+    for pk, cron, next_run in due:
+        slot = SessionSlot.objects.filter(unclaimed, pk=pk, next_run=next_run)
+        if now - next_run > SESSION_MAX_LAG:
+            if slot.update(next_run=next_cron_time(cron, now), claimed_at=None):
+                n_skipped += 1
+            continue
+        # Claiming the run stops an overlapping dispatch from starting it too
+        if slot.update(claimed_at=now):
+            claimed.append((pk, next_run.isoformat(), now.isoformat()))
+    for start in range(0, len(claimed), SESSION_DISPATCH_CHUNK_SIZE):
+        tasks.async_task("lliza.scheduler.start_sessions", claimed[start:start + SESSION_DISPATCH_CHUNK_SIZE])
+    if claimed or n_skipped:
+        log_message(f"Dispatched {len(claimed)} sessions, skipped {n_skipped} missed ones")
+
+def start_sessions(slots: List[Tuple[int, str, str]]):
+    """
+    django-q task which starts a chunk of sessions.
+
+    :param slots: (SessionSlot pk, time it was due, time it was claimed) with the times as ISO strings
+    """
+    with ThreadPoolExecutor(max_workers=SESSION_START_PARALLELISM, thread_name_prefix="session-start") as pool:
+        lags = [lag for lag in pool.map(start_slot, slots) if lag is not None]
+    outbound_queue.flush(timeout=60)  # Don't let the task end before its texts are sent
+    if lags:
+        log_message(f"Started {len(lags)} sessions, lag mean {sum(lags) / len(lags):.1f}s max {max(lags):.1f}s")
+
+def start_slot(slot: Tuple[int, str, str]):
+    """Start one session, returning seconds between when it was due and when its text was queued or call placed"""
+    pk, due_at, claimed_at = slot
+    started_at = timezone.now()
+    try:
+        # Fails if the slot was unscheduled, or its claim ran out while this task
+        # was queued and a later dispatch claimed the run again
+        if not SessionSlot.objects.filter(pk=pk, next_run=datetime.fromisoformat(due_at),
+                                          claimed_at=datetime.fromisoformat(claimed_at)).update(claimed_at=started_at):
+            return None
+        session_slot = SessionSlot.objects.select_related('user').get(pk=pk)
+        start_user_session(session_slot.user, session_slot.call_or_text)
+        lag = (timezone.now() - datetime.fromisoformat(due_at)).total_seconds()
+        metrics.record("session_start_lag_seconds", lag)
+        SessionSlot.objects.filter(pk=pk, claimed_at=started_at).update(
+            next_run=next_cron_time(session_slot.cron, timezone.now()), claimed_at=None)
+        return lag
+    except Exception as e:
+        log_message(f"Error starting session for slot {pk}, a later dispatch will retry it: {e}")
+        SessionSlot.objects.filter(pk=pk, claimed_at=started_at).update(claimed_at=None)
+        return None
+    finally:
+        connection.close()  # Each thread has its own connection
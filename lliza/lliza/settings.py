@@ -129,7 +129,7 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 Q_CLUSTER = {
     'orm': 'default',
-    'workers': 1,
+    'workers': int(os.getenv("Q_CLUSTER_WORKERS", "4")),
     'max_attempts': 1,
     'retry': 300,
     'catch_up': False,
@@ -0,0 +1,25 @@
+"""
+Token counting with the chat models' tokenizer, for budgeting prompts.
+"""
+import os
+from functools import lru_cache
+from typing import Dict
+
+import tiktoken
+
+ENCODING = os.getenv("TIKTOKEN_ENCODING", "o200k_base")  # The gpt-4o family's encoding
+MESSAGE_OVERHEAD_TOKENS = 4  # Role and separators the chat format adds per message
+
+@lru_cache(maxsize=1)
+def encoder():
+    return tiktoken.get_encoding(ENCODING)
+
+def count_tokens(text: str) -> int:
+    return len(encoder().encode(text))
+
+def count_message_tokens(message: Dict[str, str]) -> int:
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+def truncate(text: str, n_tokens: int) -> str:
+    """The longest prefix of text which is at most n_tokens tokens"""
+    return encoder().decode(encoder().encode(text)[:n_tokens])
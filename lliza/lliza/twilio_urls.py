@@ -1,5 +1,5 @@
 from django.urls import path
-from lliza.twilio_views import webhook, health, message_status, schedule_webhook, handle_call
+from lliza.twilio_views import webhook, health, message_status, schedule_webhook, handle_call, metrics_view
 
 urlpatterns = [
     path('webhook', webhook, name='webhook'),
@@ -7,5 +7,6 @@ urlpatterns = [
     path('message-status', message_status, name='message-status'),
     path('schedule-webhook', schedule_webhook, name='schedule-webhook'),
     path('handle-call', handle_call, name='handle-call'),
+    path('metrics', metrics_view, name='metrics'),
 
 ]
\ No newline at end of file
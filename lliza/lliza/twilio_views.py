@@ -1,37 +1,76 @@
 import os
-import cryptocode
 import json
 import urllib
-from ast import literal_eval
 
 
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.twiml.voice_response import VoiceResponse
 
-from django.http import HttpResponse
+from django.db import connection
+from django_q import tasks
+from django.http import HttpResponse, JsonResponse
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
-from django_q import tasks
-from django_q.models import Schedule
-from croniter import croniter
-from datetime import datetime
 
+from lliza import crypto, metrics
+from lliza.debounce import Debouncer
 from lliza.lliza import CarlBot
-from lliza.models import User
-from lliza.utils import get_user_from_number, log_message, load_carlbot, save_carlbot, load_client, send_message, DELETE_KEYWORD, DELETE_MESSAGE, HELP_KEYWORD, HELP_MESSAGE, OPT_OUT_KEYWORD, OPT_IN_KEYWORD, FIRST_SESSION_MESSAGE, WELCOME_MESSAGE, ENCRYPTION_KEY, make_connect, make_call, delete_memory
+from lliza.models import User, ProcessedEvent
+from lliza.utils import get_user_from_number, log_message, load_carlbot, save_carlbot, load_client, send_message, send_message_now, DELETE_KEYWORD, DELETE_MESSAGE, HELP_KEYWORD, HELP_MESSAGE, OPT_OUT_KEYWORD, OPT_IN_KEYWORD, FIRST_SESSION_MESSAGE, WELCOME_MESSAGE, ENCRYPTION_KEY, make_connect, make_call, delete_memory, schedule_session, delete_user_schedules, add_to_inbox, run_turns, claim_turn, release_turn, start_new_session, SMS_AGGREGATION_SECONDS, ASYNC_REPLIES, dedup_store
+
+def make_responder(is_me: bool):
+    """The respond callback run_turns uses to answer a user's texts"""
+    def respond(carl, content):
+        log_message("Getting CarlBot response")
+        reply = carl.respond_to_user(content, is_me=is_me)
+        log_message("Registering CarlBot response")
+        carl.add_message(role="assistant", content=reply)
+        return reply
+    return respond
+
+@metrics.trace("sms_reply", log=log_message)
+def reply_to_inbox(user_pk, coalesce_seconds=0):
+    """
+    Answer the texts in a user's inbox in one turn, replying by REST.
+    Run by the aggregation debouncer once a burst is over, or as a django-q
+    task in ASYNC_REPLIES mode, where it waits coalesce_seconds for the burst.
+    """
+    try:
+        user = User.objects.get(pk=user_pk)
+        number = crypto.decrypt(user.user_id, ENCRYPTION_KEY)
+        is_me = "8583662653" in number
+        for reply in run_turns(user, make_responder(is_me), coalesce_seconds=coalesce_seconds):
+            log_message("Sending reply")
+            send_message_now(number, reply)  # Not queued, so it isn't lost if the process stops
+    finally:
+        connection.close()  # Runs outside a request, so Django won't clean up after it
+
+reply_debouncer = Debouncer(SMS_AGGREGATION_SECONDS, reply_to_inbox, log=log_message)
 
 @csrf_exempt
+@metrics.trace("webhook", log=log_message)
 def webhook(request):
     """Send a dynamic reply to an incoming text message"""
+    message_sid = request.POST.get('MessageSid')
+    if dedup_store.is_duplicate(ProcessedEvent.INBOUND_MESSAGE, message_sid):
+        # Twilio retried a message which is already being or has been answered
+        return HttpResponse(str(MessagingResponse()), content_type='application/xml')
+    try:
+        return reply_to_text(request)
+    except Exception:
+        # The message wasn't answered or put in the inbox, so let Twilio's retry of it through
+        dedup_store.forget(ProcessedEvent.INBOUND_MESSAGE, message_sid)
+        raise
+
+def reply_to_text(request):
     # Print all the data from the incoming message
     from_number = request.POST.get('From', None)
     is_me = "8583662653" in from_number
 
     # Get the message the user sent our Twilio number
     body = request.POST.get('Body', None)
-    log_message(f"Received message from {from_number}")
+    log_message("Received message")
     user = get_user_from_number(from_number)
-    log_message(f"Received message from {from_number} with user_id {user.user_id}")
     text = body
     
     url_compatible_user_id = urllib.parse.quote(user.user_id)
@@ -44,13 +83,14 @@ def webhook(request):
         if text.lower() == OPT_OUT_KEYWORD.lower():
             log_message("Opting out")
             user.opt_out = True
+            user.save(update_fields=["opt_out"])
             delete_memory(user)
             log_message("User opted out")
             return HttpResponse(status=200)
         elif text.lower() == OPT_IN_KEYWORD.lower():
             log_message("Resubscribing")
             user.opt_out = False
-            user.save()
+            user.save(update_fields=["opt_out"])
     
     if text.lower() == DELETE_KEYWORD.lower():
         log_message("Deleting conversation history")
@@ -60,31 +100,55 @@ def webhook(request):
         reply = HELP_MESSAGE.format(url_compatible_user_id)
     elif new_user or (text.lower() == OPT_IN_KEYWORD.lower()):
         reply = WELCOME_MESSAGE.format(url_compatible_user_id)
-        carl = load_carlbot(user)
-        carl.add_message(role="assistant", content=FIRST_SESSION_MESSAGE)
-        save_carlbot(user, carl)
+        claimed_at = claim_turn(user)
+        if claimed_at is None:
+            log_message("User is mid-conversation, not recording the first session message")
+        else:
+            try:
+                carl = load_carlbot(user)
+                carl.add_message(role="assistant", content=FIRST_SESSION_MESSAGE)
+                save_carlbot(user, carl)
+            finally:
+                release_turn(user, claimed_at)
     else:
         if len(text) > 2100:
             log_message("Message too long")
             reply = "[Message too long, not processed. Please send a shorter message.]"
         else:
             log_message("Processing message")
-            log_message("Loading CarlBot")
-            carl = load_carlbot(user)
-            log_message("Adding message to CarlBot")
-            carl.add_message(role="user", content=text)
-            log_message("Getting CarlBot response")
-            reply = carl.get_response(is_me=is_me)
-            log_message("Registering CarlBot response")
-            carl.add_message(role="assistant", content=reply)
-            log_message("Saving CarlBot")
-            save_carlbot(user, carl)
-            user.num_messages += 1
-            user.save()
+            # Texts sent while a turn is running for the user are answered by
+            # that turn, together with any others which arrive meanwhile
+            add_to_inbox(user, text)
+            if ASYNC_REPLIES:
+                # A django-q worker runs the turn, so slow turns can't time out the
+                # webhook. The first task waits for the rest of a burst, and tasks
+                # for texts that arrive meanwhile find the turn claimed and return.
+                tasks.async_task("lliza.twilio_views.reply_to_inbox", user.pk, SMS_AGGREGATION_SECONDS)
+                return HttpResponse(str(MessagingResponse()), content_type='application/xml')
+            if SMS_AGGREGATION_SECONDS > 0:
+                # Carriers deliver a long text as several webhooks, so acknowledge
+                # each now and answer them all once no more have come for a while.
+                # The timer is in memory, but the texts are in the inbox, so ones
+                # a restart interrupts are answered by the user's next turn.
+                reply_debouncer.trigger(user.pk)
+                return HttpResponse(str(MessagingResponse()), content_type='application/xml')
 
+            try:
+                replies = run_turns(user, make_responder(is_me))  # Waits TURN_COALESCE_SECONDS, 0 by default
+            except Exception as e:
+                # The text stays in the inbox, so rather than Twilio retrying it,
+                # a django-q task answers it by REST
+                metrics.increment("sms_turn_failed")
+                log_message(f"Error answering message, retrying it in the background: {e}")
+                tasks.async_task("lliza.twilio_views.reply_to_inbox", user.pk)
+                return HttpResponse(str(MessagingResponse()), content_type='application/xml')
+            if not replies:
+                log_message("Message will be answered by the turn in progress")
+                return HttpResponse(str(MessagingResponse()), content_type='application/xml')
+            reply = "\n\n".join(replies)
 
-    log_message(f"Received message: {body}")
-    log_message(f"Sending reply: {reply}")
+
+    log_message("Sending reply")
     # Start our TwiML response
     resp = MessagingResponse()
     resp.message(body=reply,
@@ -99,14 +163,16 @@ def message_status(request):
     message_status = request.POST.get('MessageStatus', None)
     log_message(f"Message status: {message_status} for message SID: {message_sid}")
 
-    # Check if the message is undelivered, and if so, resend it
-    if message_status == 'undelivered':
+    # Check if the message is undelivered, and if so, resend it, once. The
+    # resend has no status callback, so its own failure isn't resent again.
+    if message_status == 'undelivered' and not dedup_store.is_duplicate(
+            ProcessedEvent.MESSAGE_STATUS, f"{message_sid}:{message_status}"):
         print(f"We got one! Resending message {message_sid}")
         client = load_client()
         message = client.messages(message_sid).fetch()
         to = message.to
         body = message.body
-        send_message(to, body)
+        send_message_now(to, body, status_callback=False)
 
     return HttpResponse(status=204)
 
@@ -114,30 +180,44 @@ def message_status(request):
 def health(request):
     return HttpResponse("Healthy", status=200)
 
+@require_http_methods(["GET"])
+def metrics_view(request):
+    """Report this worker's latency metrics"""
+    return JsonResponse(metrics.summary())
+
 def start_session(user_id, call_or_text) -> None:
     """
     Send an introductory message to a user for a new session.
+    Run by django-q Schedules made before SessionSlots, see lliza.scheduler.
 
     :param user_id: User ID to send the message to
     """
     log_message(f"Sending intro message to {user_id}")
-    number = cryptocode.decrypt(user_id, ENCRYPTION_KEY)
-    is_me = "8583662653" in number
+    number = crypto.decrypt(user_id, ENCRYPTION_KEY)
     user = get_user_from_number(number)
     if not user:
         print(f"Error sending intro message: no users for number {number}")
         return
+    start_user_session(user, call_or_text)
+
+@metrics.trace("start_session", log=log_message)
+def start_user_session(user, call_or_text) -> None:
+    """Text or call a user to start a new session, unless they've opted out"""
+    number = crypto.decrypt(user.user_id, ENCRYPTION_KEY)
+    is_me = "8583662653" in number
     if user.opt_out:
-        log_message(f"User {number} has opted out, not sending intro message and deleting schedules")
-        number = cryptocode.decrypt(user_id, ENCRYPTION_KEY)
-        schedules_matching_user = [schedule for schedule in Schedule.objects.all() if cryptocode.decrypt(literal_eval(schedule.args)[0], ENCRYPTION_KEY) == number]
-        for schedule in schedules_matching_user:
-            schedule.delete()
+        log_message("User has opted out, not sending intro message and deleting schedules")
+        delete_user_schedules(user)
     else:
         if call_or_text == "Text":
-            carl = load_carlbot(user)
-            new_session_message = carl.start_new_session(is_me=is_me)
-            save_carlbot(user, carl)
+            claimed_at = claim_turn(user)
+            if claimed_at is None:
+                log_message("User is mid-conversation, not starting a new session")
+                return
+            try:
+                new_session_message = start_new_session(user, is_me=is_me)
+            finally:
+                release_turn(user, claimed_at)
             send_message(number, new_session_message)
         elif call_or_text == "Call":
             make_call(number)
@@ -165,12 +245,6 @@ def day_and_time_to_utc_cron_str(day: str, time: str) -> str:
 
     return cron_string
 
-def get_next_cron_time(cron_string: str) -> str:
-    now = datetime.now()
-    cron = croniter(cron_string, now)
-    next_time = cron.get_next(datetime)
-    return next_time.strftime("%Y-%m-%d %H:%M:%S")
-
 # Webhook for receiving responses from a Google Form set up to schedule sessions
 @csrf_exempt
 @require_http_methods(["POST", "GET"])
@@ -198,17 +272,15 @@ def schedule_webhook(request):
         print("Error scheduling: no user ID")
         return HttpResponse(status=404)
     log_message(f"Received scheduling request for user {user_id}")
-    number = cryptocode.decrypt(user_id, ENCRYPTION_KEY)
+    number = crypto.decrypt(user_id, ENCRYPTION_KEY)
     user = get_user_from_number(number)
     if user is None:
         print(f"Error scheduling: no users for number {number}")
         return HttpResponse(status=404)
     
     # Delete all existing schedules for the user
-    schedules_matching_user = [schedule for schedule in Schedule.objects.all() if cryptocode.decrypt(literal_eval(schedule.args)[0], ENCRYPTION_KEY) == number]
-    for schedule in schedules_matching_user:
-        schedule.delete()
-    message_to_send_user = f"Deleted {len(schedules_matching_user)} existing schedules.\n"
+    n_deleted = delete_user_schedules(user)
+    message_to_send_user = f"Deleted {n_deleted} existing schedules.\n"
     
     first_day = data.get("What day of the week for the first session?")
     first_time = data.get("What time (EST) for the first session of the week?")
@@ -217,14 +289,7 @@ def schedule_webhook(request):
         first_cron_string = day_and_time_to_utc_cron_str(first_day, first_time)
         log_message(f"First day: {first_day}, first time: {first_time}")
         log_message(f"First cron string: {first_cron_string}")
-        tasks.schedule(
-            "lliza.twilio_views.start_session",
-            user_id,
-            first_call_or_text,
-            schedule_type="C",
-            cron=first_cron_string,
-            next_run=get_next_cron_time(first_cron_string)
-        )
+        schedule_session(user, first_call_or_text, first_cron_string)
         message_to_send_user += f"\nScheduled first repeating session for {first_day} at {first_time}"
     
     second_day = data.get("What day of the week for the second session?")
@@ -234,17 +299,10 @@ def schedule_webhook(request):
         log_message(f"Second day: {second_day}, second time: {second_time}")
         second_cron_string = day_and_time_to_utc_cron_str(second_day, second_time)
         log_message(f"Second cron string: {second_cron_string}")
-        tasks.schedule(
-            "lliza.twilio_views.start_session",
-            user_id,
-            second_call_or_text,
-            schedule_type="C",
-            cron=second_cron_string,
-            next_run=get_next_cron_time(second_cron_string)
-        )
+        schedule_session(user, second_call_or_text, second_cron_string)
         message_to_send_user += f"\nScheduled second repeating session for {second_day} at {second_time}\n"
 
-    send_message(number, message_to_send_user)
+    send_message_now(number, message_to_send_user)
     
     return HttpResponse(status=200)
 
@@ -258,13 +316,22 @@ def handle_call(request):
     is_me = "8583662653" in number
     user = get_user_from_number(number)
 
-    carl = load_carlbot(user)
-    if len(carl.dialogue_buffer) == 0:
-        new_session_message = FIRST_SESSION_MESSAGE
-        carl.add_message(role="assistant", content=new_session_message)
+    claimed_at = claim_turn(user)
+    if claimed_at is None:
+        # A text turn is running, don't make it fail by writing the memory under it
+        log_message("User is mid-conversation, not recording the new session")
+        new_session_message = CarlBot.get_new_session_message(is_me=is_me)
     else:
-        new_session_message = carl.start_new_session(is_me=is_me)
-    save_carlbot(user, carl)
+        try:
+            carl = load_carlbot(user)
+            if len(carl.dialogue_buffer) == 0:
+                new_session_message = FIRST_SESSION_MESSAGE
+                carl.add_message(role="assistant", content=new_session_message)
+            else:
+                new_session_message = carl.start_new_session(is_me=is_me)
+            save_carlbot(user, carl)
+        finally:
+            release_turn(user, claimed_at)
 
     connect = make_connect(new_session_message)
     response.append(connect)
@@ -0,0 +1,112 @@
+"""
+Accounting of the tokens OpenAI calls use.
+
+The transport adds the usage of every response to in-process counters, keyed
+by the user whose turn made the call, the (UTC) day, the call type and the model. A
+background thread hands the counters to a flush function every so often, so
+persisting them costs a few writes a minute rather than one per call.
+The user is set for a block of code with account(user_pk); calls made outside
+one are counted against no user.
+"""
+import atexit
+import contextvars
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from typing import Callable, Dict, Optional, Tuple
+
+USAGE_FIELDS = ("n_calls", "prompt_tokens", "cached_tokens", "completion_tokens")
+
+_account = contextvars.ContextVar("usage_account", default=None)
+
+
+@contextmanager
+def account(user_pk: Optional[int]):
+    """Count the usage of OpenAI calls made in this block against the user"""
+    token = _account.set(user_pk)
+    try:
+        yield
+    finally:
+        _account.reset(token)
+
+
+def _today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+class UsageMeter:
+
+    def __init__(self):
+        self._counters = defaultdict(Counter)  # (user pk, day, call type, model) -> USAGE_FIELDS
+        self._lock = threading.Lock()
+        self._flush = None
+        self._flush_seconds = None
+        self._log = print
+        self._flusher = None
+
+    def start_flushing(self, flush: Callable[[Dict[Tuple, Counter]], None], flush_seconds: float,
+                       log: Callable[[str], None] = print):
+        """
+        :param flush: Persists a batch of counters, called as flush({(user pk, day, call type, model): Counter})
+        :param flush_seconds: How often to flush
+        """
+        self._flush = flush
+        self._flush_seconds = flush_seconds
+        self._log = log
+        atexit.register(self.flush)
+
+    def record(self, call_type: str, model: Optional[str], usage=None):
+        """Count a call and the tokens in its usage, if the response had any"""
+        # The day is part of the key, so calls just before midnight aren't counted in the day they're flushed
+        key = (_account.get(), _today(), call_type, model or "")
+        with self._lock:
+            counter = self._counters[key]
+            counter["n_calls"] += 1
+            if usage is not None:
+                counter["prompt_tokens"] += usage.prompt_tokens or 0
+                counter["completion_tokens"] += getattr(usage, "completion_tokens", None) or 0
+                details = getattr(usage, "prompt_tokens_details", None)
+                counter["cached_tokens"] += (details and details.cached_tokens) or 0
+        self._ensure_flusher()
+
+    def drain(self) -> Dict[Tuple, Counter]:
+        """Take the counters accumulated since the last drain"""
+        with self._lock:
+            counters, self._counters = self._counters, defaultdict(Counter)
+        return dict(counters)
+
+    def flush(self):
+        counters = self.drain()
+        if not counters or self._flush is None:
+            self._restore(counters)
+            return
+        try:
+            self._flush(counters)
+        except Exception as e:
+            self._log(f"Error flushing usage, keeping it for the next flush: {e}")
+            self._restore(counters)
+
+    def _restore(self, counters: Dict[Tuple, Counter]):
+        with self._lock:
+            for key, counter in counters.items():
+                self._counters[key].update(counter)
+
+    def _ensure_flusher(self):
+        # Started lazily so the thread belongs to the process which makes the
+        # calls, e.g. a django-q worker rather than the process which forked it
+        if self._flush is None or (self._flusher is not None and self._flusher.is_alive()):
+            return
+        with self._lock:
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._run_flusher, name="usage-flusher", daemon=True)
+                self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self._flush_seconds)
+            self.flush()
+
+
+meter = UsageMeter()
@@ -1,16 +1,48 @@
 import os
-import cryptocode
+import copy
 import json
+import hmac
+import hashlib
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Callable, List, Optional
 
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Max, Q
+from django.utils import timezone
+from croniter import croniter
+from django_q import tasks
+from django_q.models import Schedule
+from twilio.http.http_client import TwilioHttpClient
 from twilio.rest import Client
 from twilio.twiml.voice_response import Connect
 
+from lliza import crypto, metrics, usage
+from lliza.cache import BotStateCache
+from lliza.dedup import DedupStore
+from lliza.outbound import OutboundMessageQueue
 from lliza.lliza import CarlBot
-from lliza.models import User
+from lliza.models import User, UserSchedule, PendingSummary, MemoryRecord, InboxMessage, SessionSlot, UsageCounter
 
 logging_enabled = True
 
 ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY")
+DEFERRED_SUMMARY = os.getenv("DEFERRED_SUMMARY", "false").lower() == "true"  # Summarize full dialogue buffers in django-q instead of during the turn
+BOT_STATE_CACHE_SIZE = int(os.getenv("BOT_STATE_CACHE_SIZE", "1000"))  # Users whose decoded memory each worker keeps
+BOT_STATE_CACHE_TTL_SECONDS = float(os.getenv("BOT_STATE_CACHE_TTL_SECONDS", "600"))
+OUTBOUND_MESSAGES_PER_SECOND = float(os.getenv("OUTBOUND_MESSAGES_PER_SECOND", "10"))
+OUTBOUND_SENDER_THREADS = int(os.getenv("OUTBOUND_SENDER_THREADS", "4"))
+TURN_COALESCE_SECONDS = float(os.getenv("TURN_COALESCE_SECONDS", "0"))  # How long a turn answered in the webhook response waits for the rest of a burst of texts
+ASYNC_REPLIES = os.getenv("ASYNC_REPLIES", "false").lower() == "true"  # Answer texts in django-q and reply by REST, so webhooks return at once
+SMS_AGGREGATION_SECONDS = float(os.getenv("SMS_AGGREGATION_SECONDS", "0"))  # Quiet time before answering texts by REST, 0 to answer each in its webhook response. Its timers are in memory, ASYNC_REPLIES keeps them across restarts
+TURN_LEASE_SECONDS = float(os.getenv("TURN_LEASE_SECONDS", "120"))  # After this a claimed turn is assumed to have died
+SUMMARY_LEASE_SECONDS = float(os.getenv("SUMMARY_LEASE_SECONDS", "600"))  # After this a requested summary is assumed to have died
+DEDUP_TTL_SECONDS = float(os.getenv("DEDUP_TTL_SECONDS", str(24 * 60 * 60)))  # How long handled webhooks are remembered, well past Twilio's retries
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "10000"))
+TWILIO_API_BASE_URL = os.getenv("TWILIO_API_BASE_URL")  # Overrides https://api.twilio.com, e.g. with benchmarks/fake_twilio.py
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "60"))  # How often each worker saves its OpenAI usage counters
+VOICE_STREAMING = os.getenv("VOICE_STREAMING", "false").lower() == "true"  # Stream single unranked voice replies token by token
 SYSTEM_PROMPT = "You are LLiza, a Rogerian therapist AI. Your mission is to embody congruence (transparency about your own feelings and reactions), unconditional positive regard (a strong sense of caring for the client), and empathetic understanding (understand the client's frame of reference well enough to sense deeper meanings underneath the surface) so therapeutic movement occurs in your client.\nSpecifically, she'll explore her feelings more deeply, discover hidden aspects of herself, prize herself more, understand her own meanings better, be more real with herself, feel what's going on inside more clearly, relate more directly, see life less rigidly, accept herself, and recognize her own judgment capacity.\nStart by asking what the client wants to talk about. Don't give advice, direct the client, ask questions, interpret, bring in outside opinions, merely repeat facts, summarize all of what they said, or use long sentences. Allow the client to lead the session and discover their own answers while you understand their inner world, reflect their most important emotions succinctly, and be transparent with your reactions.\nExample 1:\n###\nClient: I would like to be more present and comfortable with myself so that other people, including my children and so forth, could do what they do, and that I could be a source of support and not be personally threatened  by every little thing. \nYou: And that has meaning to me. You'd like to be sufficiently accepting of yourself, that then you can be comfortable with what your children do or what other people do and not feel frightened, thrown off balance. \n###\nExample 2:\n###\nClient: I plan to go to work in the fall, and I believe that deep down I'm really afraid. \nYou: Are you afraid of the responsibility or, or what aspect of it is most frightening?\n###\n"
 OPT_OUT_KEYWORD = "STOP"
 OPT_IN_KEYWORD = "START"
@@ -54,70 +86,432 @@ to delete your conversation history
 WELCOME_MESSAGE = f"{HELP_MESSAGE}\nNow Lliza, say hello:\n{FIRST_SESSION_MESSAGE}"
 LLIZA_VOICE = "en-US-Standard-C"
 
+bot_state_cache = BotStateCache(BOT_STATE_CACHE_SIZE, BOT_STATE_CACHE_TTL_SECONDS)
+dedup_store = DedupStore(DEDUP_TTL_SECONDS, DEDUP_CACHE_SIZE)
+
+class StaleMemoryError(Exception):
+    """The user's memory was written by someone else since the bot was loaded"""
+
+def hash_number(number: str) -> str:
+    """
+    Deterministic keyed hash of a phone number.
+    The encrypted user_id is salted so it can't be queried on, this can.
+    """
+    return hmac.new(ENCRYPTION_KEY.encode(), number.encode(), hashlib.sha256).hexdigest()
+
+@metrics.span("user_lookup")
 def get_user_from_number(number: str) -> User:
-    users = User.objects.all()
-    matching_users = [user for user in users if cryptocode.decrypt(user.user_id, ENCRYPTION_KEY) == number]
-    if len(matching_users) == 0:
-        user_id = cryptocode.encrypt(number, ENCRYPTION_KEY)
-        blank_carl = CarlBot()
-        memory_dict = blank_carl.save_to_dict()
-        encrypted_memory_dict_string = dict_to_encrypted_string(ENCRYPTION_KEY, memory_dict)
-        user = User.objects.create(user_id=user_id, encrypted_memory_dict_string=encrypted_memory_dict_string)
-        log_message("New user created")
-    elif len(matching_users) == 1:
-        user = matching_users[0]
-        log_message("Loaded user")
+    number_hash = hash_number(number)
+    user = User.objects.filter(number_hash=number_hash).first()
+    if user is None:
+        # Two first webhooks from a number can both get here, so the loser
+        # of the unique number_hash gets the winner's user
+        user, created = User.objects.get_or_create(
+            number_hash=number_hash, defaults={"user_id": crypto.encrypt(number, ENCRYPTION_KEY)})
+        log_message("New user created" if created else "Loaded user")
     else:
-        raise RuntimeError(f"Multiple users matching {number}")
+        if crypto.is_legacy(user.user_id):
+            user.user_id = crypto.encrypt(number, ENCRYPTION_KEY)
+            user.save(update_fields=["user_id"])
+        log_message("Loaded user")
     return user
 
 def dict_to_encrypted_string(secret, dictionary):
-    return cryptocode.encrypt(json.dumps(dictionary), secret)
+    return crypto.encrypt(json.dumps(dictionary), secret)
 
 def encrypted_string_to_dict(secret, encrypted_string):
-    return json.loads(cryptocode.decrypt(encrypted_string, secret))
+    return json.loads(crypto.decrypt(encrypted_string, secret))
 
 def log_message(message):
     global logging_enabled
     if logging_enabled:
         print(message)
 
-def load_carlbot(user: User) -> CarlBot:
-    carl = CarlBot()
-    if user.encrypted_memory_dict_string is not None:
+def load_memory_dict(user: User) -> tuple:
+    """
+    Read and decrypt the active window of the user's MemoryRecords.
+    Also returns the records still encrypted with the legacy backend, decrypted,
+    so save_carlbot can re-encrypt them.
+    """
+    records = MemoryRecord.objects.filter(user=user).filter(
+        Q(kind=MemoryRecord.DIALOGUE, seq__gte=user.dialogue_offset)
+        | Q(kind=MemoryRecord.SUMMARY, seq__gte=user.summary_offset)
+    ).order_by('seq')
+    memory_dict = {
+        "dialogue_buffer": [],
+        "summary_buffer": [],
+        "crisis_mode": user.crisis_mode,
+        "dialogue_offset": user.dialogue_offset,
+    }
+    legacy_records = []
+    for record in records:
+        content = encrypted_string_to_dict(ENCRYPTION_KEY, record.encrypted_content)
+        if crypto.is_legacy(record.encrypted_content):
+            legacy_records.append((record, content))
+        if record.kind == MemoryRecord.DIALOGUE:
+            memory_dict["dialogue_buffer"].append(content)
+        else:
+            memory_dict["summary_buffer"].append(content)
+    return memory_dict, legacy_records
+
+def saved_memory_snapshot(carl: CarlBot, summary_end: int) -> dict:
+    """What's in the bot's MemoryRecords, so save_carlbot can write only what's new"""
+    return {
+        "dialogue": {carl.dialogue_offset + i: message for i, message in enumerate(copy.deepcopy(carl.dialogue_buffer))},
+        "dialogue_end": carl.dialogue_offset + len(carl.dialogue_buffer),
+        "summary_buffer": list(carl.summary_buffer),
+        "summary_end": summary_end,
+        "n_summary_points": len(carl.all_summary_points),
+    }
+
+@metrics.span("load")
+def load_carlbot(user: User, bot_class=CarlBot) -> CarlBot:
+    carl = bot_class(defer_summary=DEFERRED_SUMMARY)
+    cached_state = bot_state_cache.get(user.pk, user.memory_version)
+    if cached_state is not None:
+        carl.load_from_dict(cached_state["memory_dict"])
+        carl.saved_memory = cached_state["saved_memory"]
+    elif user.encrypted_memory_dict_string is not None:
+        # Not yet moved to MemoryRecords, save_carlbot will move it
         memory_dict = encrypted_string_to_dict(ENCRYPTION_KEY, user.encrypted_memory_dict_string)
-        log_message(f"Loaded memory dict: {memory_dict}")
         carl.load_from_dict(memory_dict)
+    else:
+        memory_dict, legacy_records = load_memory_dict(user)
+        carl.load_from_dict(memory_dict)
+        carl.saved_memory = saved_memory_snapshot(carl, user.summary_offset + len(carl.summary_buffer))
+        bot_state_cache.put(user.pk, user.memory_version,
+                            {"memory_dict": memory_dict, "saved_memory": carl.saved_memory})
+        carl.saved_memory["legacy_records"] = legacy_records
+    log_message(f"Loaded {len(carl.dialogue_buffer)} messages")
+    pending_summary = PendingSummary.objects.filter(user=user).first()
+    if pending_summary is not None:
+        summary = encrypted_string_to_dict(ENCRYPTION_KEY, pending_summary.encrypted_summary_string)
+        if carl.apply_summary(summary):
+            log_message("Applied pending summary")
     return carl
 
+def schedule_summary(user: User, carl: CarlBot):
+    """
+    Summarize the user's dialogue buffer in the background if it's full,
+    unless a summary is already queued or running for it.
+    """
+    if not (carl.defer_summary and carl.needs_summary):
+        return
+    now = timezone.now()
+    requested = User.objects.filter(pk=user.pk).filter(
+        Q(summary_requested_at__isnull=True)
+        | Q(summary_requested_at__lt=now - timedelta(seconds=SUMMARY_LEASE_SECONDS))
+    ).update(summary_requested_at=now)
+    if requested:
+        tasks.async_task("lliza.utils.summarize_memory", user.pk)
+
+def summarize_memory(user_pk: int):
+    """
+    django-q task which summarizes a user's oldest messages into a PendingSummary.
+    It never writes the memory itself, so it can't race with a turn in progress.
+    """
+    user = User.objects.get(pk=user_pk)
+    try:
+        carl = load_carlbot(user)
+        if not carl.needs_summary:  # Already summarized by an earlier task
+            return
+        with usage.account(user.pk):
+            summary = carl.compute_summary()
+        PendingSummary.objects.update_or_create(
+            user=user,
+            defaults={"encrypted_summary_string": dict_to_encrypted_string(ENCRYPTION_KEY, summary)})
+        log_message("Saved pending summary")
+    finally:
+        # Saves from here on may request the next summary, or retry this one if it failed
+        User.objects.filter(pk=user.pk).update(summary_requested_at=None)
+
+@metrics.span("save")
 def save_carlbot(user: User, carl: CarlBot):
-    memory_dict = carl.save_to_dict()
-    log_message(f"Saving memory dict: {memory_dict}")
-    encrypted_memory_dict_string = dict_to_encrypted_string(ENCRYPTION_KEY, memory_dict)
-    user.encrypted_memory_dict_string = encrypted_memory_dict_string
-    user.save()
+    """
+    Write the records added or changed since the bot was loaded.
+    Message seqs are positions in the whole dialogue, so trimmed messages keep
+    their records and the active window is just the records from the offset on.
+    """
+    with transaction.atomic():
+        # Only one save can move the memory on from the version this bot was
+        # loaded at, so a concurrent turn fails here instead of losing messages
+        if not User.objects.filter(pk=user.pk, memory_version=user.memory_version).update(
+                memory_version=user.memory_version + 1):
+            raise StaleMemoryError(f"Memory changed since version {user.memory_version} was loaded")
+        user.memory_version += 1
+        _save_records(user, carl)
+    bot_state_cache.put(user.pk, user.memory_version,
+                        {"memory_dict": carl.save_to_dict(), "saved_memory": carl.saved_memory})
+    schedule_summary(user, carl)
+
+def save_carlbot_merging(user: User, carl: CarlBot, max_attempts: int = 3):
+    """
+    Save the bot, or if the memory was written by someone else since it was
+    loaded (e.g. a session started during a call), append the messages it
+    added to the current memory and save that instead, so they aren't lost.
+    """
+    saved = carl.saved_memory
+    messages = [message for _, message in _unsaved_dialogue(
+        carl, carl.dialogue_offset if saved is None else saved["dialogue_end"])]
+    for attempt in range(1, max_attempts + 1):
+        try:
+            save_carlbot(user, carl)
+            return
+        except StaleMemoryError:
+            if attempt == max_attempts:
+                raise
+            log_message("Memory changed since it was loaded, appending the new messages to it")
+            crisis_mode = carl.crisis_mode
+            user.refresh_from_db()
+            carl = load_carlbot(user)
+            carl.crisis_mode = carl.crisis_mode or crisis_mode
+            for message in messages:
+                carl._add_message(message["role"], message["content"], moderate=False)
+
+def _unsaved_dialogue(carl: CarlBot, dialogue_end: int) -> List[tuple]:
+    """
+    The (seq, message) of the messages from dialogue_end on. Messages added
+    this turn may already have been trimmed from the buffer by a summary,
+    but they're still at the end of full_dialogue.
+    """
+    n_dialogue = carl.dialogue_offset + len(carl.dialogue_buffer)
+    messages = []
+    for seq in range(dialogue_end, n_dialogue):
+        if seq >= carl.dialogue_offset:
+            messages.append((seq, carl.dialogue_buffer[seq - carl.dialogue_offset]))
+        else:
+            messages.append((seq, carl.full_dialogue[len(carl.full_dialogue) - (n_dialogue - seq)]))
+    return messages
+
+def _save_records(user: User, carl: CarlBot):
+    saved = carl.saved_memory
+    if saved is None:  # Nothing has been saved as records yet
+        saved = {"dialogue": {}, "dialogue_end": carl.dialogue_offset, "summary_buffer": [],
+                 "summary_end": user.summary_offset, "n_summary_points": 0}
+    new_records = []
+
+    # Dialogue
+    for seq, message in _unsaved_dialogue(carl, saved["dialogue_end"]):
+        new_records.append(MemoryRecord(user=user, kind=MemoryRecord.DIALOGUE, seq=seq,
+                                        encrypted_content=dict_to_encrypted_string(ENCRYPTION_KEY, message)))
+
+    # Re-encrypt records still using the legacy backend, then rewrite amended messages
+    legacy_records = saved.get("legacy_records", [])
+    for record, content in legacy_records:
+        record.encrypted_content = dict_to_encrypted_string(ENCRYPTION_KEY, content)
+    MemoryRecord.objects.bulk_update([record for record, _ in legacy_records], ["encrypted_content"])
+    for seq, saved_message in saved["dialogue"].items():
+        # Messages amended in place, e.g. when a call is interrupted
+        if seq >= carl.dialogue_offset and carl.dialogue_buffer[seq - carl.dialogue_offset] != saved_message:
+            MemoryRecord.objects.filter(user=user, kind=MemoryRecord.DIALOGUE, seq=seq).update(
+                encrypted_content=dict_to_encrypted_string(ENCRYPTION_KEY, carl.dialogue_buffer[seq - carl.dialogue_offset]))
+
+    # Summary buffer. Extensions are appended, a condensed buffer starts a new window.
+    summary_offset = user.summary_offset
+    n_saved_summary = len(saved["summary_buffer"])
+    if carl.summary_buffer[:n_saved_summary] == saved["summary_buffer"]:
+        new_bullets = carl.summary_buffer[n_saved_summary:]
+    else:
+        new_bullets = carl.summary_buffer
+        summary_offset = saved["summary_end"]
+    new_records += [MemoryRecord(user=user, kind=MemoryRecord.SUMMARY, seq=saved["summary_end"] + i,
+                                 encrypted_content=dict_to_encrypted_string(ENCRYPTION_KEY, bullet))
+                    for i, bullet in enumerate(new_bullets)]
+
+    # Summary points, which are only ever appended to and aren't loaded
+    new_points = carl.all_summary_points[saved["n_summary_points"]:]
+    if new_points:
+        n_saved_points = MemoryRecord.objects.filter(user=user, kind=MemoryRecord.SUMMARY_POINT).count()
+        new_records += [MemoryRecord(user=user, kind=MemoryRecord.SUMMARY_POINT, seq=n_saved_points + i,
+                                     encrypted_content=dict_to_encrypted_string(ENCRYPTION_KEY, point))
+                        for i, point in enumerate(new_points)]
 
+    MemoryRecord.objects.bulk_create(new_records)
+    log_message(f"Saved {len(new_records)} memory records")
+    user.dialogue_offset = carl.dialogue_offset
+    user.summary_offset = summary_offset
+    user.crisis_mode = carl.crisis_mode
+    user.encrypted_memory_dict_string = None
+    user.save(update_fields=["dialogue_offset", "summary_offset", "crisis_mode",
+                             "encrypted_memory_dict_string", "memory_version", "last_message_time"])
+    carl.saved_memory = saved_memory_snapshot(carl, saved["summary_end"] + len(new_bullets))
+
+def start_new_session(user: User, is_me: bool = False) -> str:
+    """
+    Append a session boundary and opener to the user's memory records and
+    return the opener. Unlike a turn it doesn't read, decrypt or re-encrypt
+    the rest of the memory, just writes the two new records.
+    """
+    if user.encrypted_memory_dict_string is not None:  # Not yet moved to MemoryRecords
+        carl = load_carlbot(user)
+        new_session_message = carl.start_new_session(is_me=is_me)
+        save_carlbot(user, carl)
+        return new_session_message
+    new_session_message = CarlBot.get_new_session_message(is_me=is_me)
+    messages = [CarlBot.session_boundary(), {"role": "assistant", "content": new_session_message}]
+    for message in messages:
+        CarlBot.n_tokens(message)
+    loaded_version = user.memory_version
+    with metrics.span("save"), transaction.atomic():
+        if not User.objects.filter(pk=user.pk, memory_version=loaded_version).update(
+                memory_version=loaded_version + 1):
+            raise StaleMemoryError(f"Memory changed since version {loaded_version} was loaded")
+        user.memory_version += 1
+        last_seq = MemoryRecord.objects.filter(user=user, kind=MemoryRecord.DIALOGUE).aggregate(Max('seq'))['seq__max']
+        start = user.dialogue_offset if last_seq is None else max(last_seq + 1, user.dialogue_offset)
+        MemoryRecord.objects.bulk_create([
+            MemoryRecord(user=user, kind=MemoryRecord.DIALOGUE, seq=start + i,
+                         encrypted_content=dict_to_encrypted_string(ENCRYPTION_KEY, message))
+            for i, message in enumerate(messages)])
+        user.save(update_fields=["memory_version", "last_message_time"])
+    # Carry a cached copy of the memory forward, so the reply doesn't have to load it
+    cached_state = bot_state_cache.get(user.pk, loaded_version)
+    if cached_state is not None and cached_state["saved_memory"]["dialogue_end"] == start:
+        cached_state["memory_dict"]["dialogue_buffer"].extend(messages)
+        saved = cached_state["saved_memory"]
+        saved["dialogue"].update({start + i: copy.deepcopy(message) for i, message in enumerate(messages)})
+        saved["dialogue_end"] = start + len(messages)
+        bot_state_cache.put(user.pk, user.memory_version, cached_state)
+    log_message("Appended new session records")
+    return new_session_message
+
+def claim_turn(user: User) -> Optional[datetime]:
+    """
+    Claim the right to run a turn for the user, refreshing user if it's granted.
+    Returns the claim to pass to release_turn, or None if another worker holds it.
+    """
+    now = timezone.now()
+    claimed = User.objects.filter(pk=user.pk).filter(
+        Q(turn_claimed_at__isnull=True) | Q(turn_claimed_at__lt=now - timedelta(seconds=TURN_LEASE_SECONDS))
+    ).update(turn_claimed_at=now)
+    if not claimed:
+        return None
+    user.refresh_from_db()
+    return now
+
+def release_turn(user: User, claimed_at: datetime):
+    User.objects.filter(pk=user.pk, turn_claimed_at=claimed_at).update(turn_claimed_at=None)
+    user.turn_claimed_at = None
+
+def add_to_inbox(user: User, content: str):
+    InboxMessage.objects.create(user=user, encrypted_content=crypto.encrypt(content, ENCRYPTION_KEY))
+
+def read_inbox(user: User) -> tuple:
+    """
+    Return the pks and contents of the messages waiting in the user's inbox,
+    oldest first. They stay in it until the turn answering them is saved.
+    """
+    messages = list(InboxMessage.objects.filter(user=user).order_by('pk'))
+    return ([message.pk for message in messages],
+            [crypto.decrypt(message.encrypted_content, ENCRYPTION_KEY) for message in messages])
+
+def run_turns(user: User, respond: Callable[[CarlBot, str], str],
+              coalesce_seconds: float = TURN_COALESCE_SECONDS) -> List[str]:
+    """
+    Answer the messages in the user's inbox, one turn per batch of messages
+    which arrived together, unless another worker is already running turns
+    for the user, in which case it answers them and this returns no replies.
+
+    :param respond: Called as respond(carl, content) to add the messages
+        (joined by newlines) and the reply to carl, returning the reply
+    :param coalesce_seconds: How long to wait for more messages after claiming the turn
+    :return: The replies, in order
+    """
+    replies = []
+    while True:
+        claimed_at = claim_turn(user)
+        if claimed_at is None:
+            break
+        try:
+            time.sleep(coalesce_seconds)  # Let the rest of a burst arrive
+            while True:
+                inbox_pks, contents = read_inbox(user)
+                if not contents:
+                    break
+                user.refresh_from_db()
+                carl = load_carlbot(user)
+                with usage.account(user.pk):
+                    replies.append(respond(carl, "\n".join(contents)))
+                save_carlbot(user, carl)
+                # Only now the turn is saved, so the messages of a turn which
+                # fails are kept and answered by the user's next turn
+                InboxMessage.objects.filter(pk__in=inbox_pks).delete()
+                User.objects.filter(pk=user.pk).update(num_messages=F('num_messages') + len(contents))
+        finally:
+            release_turn(user, claimed_at)
+        # A message which arrived after the inbox was emptied but before the
+        # claim was released couldn't claim a turn of its own, so answer it here
+        if not InboxMessage.objects.filter(user=user).exists():
+            break
+    return replies
+
+def save_usage(counters: dict):
+    """Add a batch of usage.meter's counters to the UsageCounters of the days they were counted on"""
+    try:
+        with transaction.atomic():  # All or nothing, since a failed batch is retried
+            for (user_pk, day, call_type, model), counter in counters.items():
+                lookup = dict(user_id=user_pk, day=day, call_type=call_type, model=model)
+                increments = {field: F(field) + counter[field] for field in usage.USAGE_FIELDS}
+                if UsageCounter.objects.filter(**lookup).update(**increments):
+                    continue
+                try:
+                    with transaction.atomic():
+                        UsageCounter.objects.create(**lookup, **{field: counter[field] for field in usage.USAGE_FIELDS})
+                except IntegrityError:  # Another worker created it since the update
+                    UsageCounter.objects.filter(**lookup).update(**increments)
+    finally:
+        connection.close()  # Runs in the meter's thread, so Django won't clean up after it
+
+usage.meter.start_flushing(save_usage, USAGE_FLUSH_SECONDS, log=log_message)
+
+@lru_cache(maxsize=1)
 def load_client():
-    return Client(
+    """Process-wide Twilio client, which keeps its HTTPS connections open between requests"""
+    client = Client(
         os.environ.get("TWILIO_ACCOUNT_SID"),
-        os.environ.get("TWILIO_AUTH_TOKEN")
+        os.environ.get("TWILIO_AUTH_TOKEN"),
+        http_client=TwilioHttpClient(pool_connections=True, timeout=30, max_retries=2)
     )
+    if TWILIO_API_BASE_URL:
+        client.api.base_url = TWILIO_API_BASE_URL
+    return client
 
-def send_message(to, body):
+@metrics.span("twilio_send")
+def send_message_now(to, body, status_callback=True):
     """
-    Send a message using the Twilio API
+    Send a message using the Twilio API, blocking until Twilio accepts it.
 
     :param to: Number to send the message to
     :param body: Body of the message
+    :param status_callback: Whether to report delivery updates to the message_status view,
+        which resends undelivered messages. Resends pass False, so they are only tried once.
     """
     client = load_client()
 
+    kwargs = {}
+    if status_callback:
+        host = os.environ["RAILWAY_PUBLIC_DOMAIN"]
+        kwargs["status_callback"] = f"https://{host}/message-status"
     client.messages.create(
         messaging_service_sid=os.environ.get("TWILIO_MESSAGING_SERVICE_SID"),
         to=to,
-        body=body
+        body=body,
+        **kwargs
     )
 
+outbound_queue = OutboundMessageQueue(send_message_now, OUTBOUND_MESSAGES_PER_SECOND,
+                                      n_senders=OUTBOUND_SENDER_THREADS, log=log_message)
+
+def send_message(to, body):
+    """
+    Queue a message to be sent using the Twilio API, for fan-outs such as
+    scheduled session starts. Replies to a user use send_message_now.
+
+    :param to: Number to send the message to
+    :param body: Body of the message
+    """
+    outbound_queue.enqueue(to, body)
+
 def make_connect(new_session_message):
     connect = Connect()
     host = os.environ["RAILWAY_PUBLIC_DOMAIN"]
@@ -131,6 +525,7 @@ def make_connect(new_session_message):
     )
     return connect
 
+@metrics.span("twilio_call")
 def make_call(to):
     client = load_client()
 
@@ -143,7 +538,32 @@ def make_call(to):
                         )
 
 def delete_memory(user: User):
-    memory_dict = CarlBot().save_to_dict()
-    encrypted_memory_dict_string = dict_to_encrypted_string(ENCRYPTION_KEY, memory_dict)
-    user.encrypted_memory_dict_string = encrypted_memory_dict_string
-    user.save()
\ No newline at end of file
+    # Bumped in the database rather than from this copy of the user, so a turn
+    # saving meanwhile fails instead of either write being lost
+    memory_fields = ["encrypted_memory_dict_string", "dialogue_offset", "summary_offset", "crisis_mode", "memory_version"]
+    with transaction.atomic():
+        MemoryRecord.objects.filter(user=user).delete()
+        PendingSummary.objects.filter(user=user).delete()
+        User.objects.filter(pk=user.pk).update(
+            encrypted_memory_dict_string=None, dialogue_offset=0, summary_offset=0, crisis_mode=False,
+            memory_version=F('memory_version') + 1)
+    user.refresh_from_db(fields=memory_fields)
+    bot_state_cache.invalidate(user.pk)
+
+def next_cron_time(cron_string: str, after: datetime) -> datetime:
+    return croniter(cron_string, after).get_next(datetime)
+
+def schedule_session(user: User, call_or_text: str, cron_string: str) -> SessionSlot:
+    return SessionSlot.objects.create(user=user, call_or_text=call_or_text, cron=cron_string,
+                                      next_run=next_cron_time(cron_string, timezone.now()))
+
+def delete_user_schedules(user: User) -> int:
+    """
+    Delete all of a user's session schedules, including any django-q
+    Schedules from before SessionSlots.
+
+    :return: Number of schedules deleted
+    """
+    n_slots, _ = SessionSlot.objects.filter(user=user).delete()
+    _, deleted_per_model = Schedule.objects.filter(user_schedule__user=user).delete()
+    return n_slots + deleted_per_model.get(Schedule._meta.label, 0)
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+# Enough configuration for Django, for tests of code which uses the models
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lliza.settings")
+os.environ.setdefault("DJANGO_SECRET_KEY", "test")
+os.environ.setdefault("DATABASE_PUBLIC_URL", "sqlite:///:memory:")
+os.environ.setdefault("ENCRYPTION_KEY", "test")
+
+
+class WhitespaceEncoder:
+    """Stands in for the tiktoken encoder, whose vocabulary is downloaded on first use"""
+
+    def encode(self, text):
+        return text.split(" ")
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+@pytest.fixture(autouse=True)
+def whitespace_encoder(monkeypatch):
+    monkeypatch.setattr("lliza.tokens.encoder", WhitespaceEncoder)
+
+
+@pytest.fixture(scope="session")
+def django_db():
+    """Set up Django and a test database, once for the whole run"""
+    import django
+    from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+    django.setup()
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    yield
+    teardown_databases(old_config, verbosity=0)
+    teardown_test_environment()
+
+
+@pytest.fixture
+def db(django_db, monkeypatch):
+    """Run the test in a transaction which is rolled back after it"""
+    from django.db import transaction
+    from lliza import utils
+    from lliza.cache import BotStateCache
+    # Rolled back pks are reused, so state cached by earlier tests mustn't be found
+    monkeypatch.setattr(utils, "bot_state_cache", BotStateCache(100, 600))
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
@@ -0,0 +1,38 @@
+from unittest.mock import patch
+
+from lliza.cache import BotStateCache
+
+
+def test_get_returns_copy_for_same_version():
+    cache = BotStateCache(max_size=2, ttl_seconds=60)
+    state = {"dialogue_buffer": [{"role": "user", "content": "Hello"}]}
+    cache.put(1, 3, state)
+    cached = cache.get(1, 3)
+    assert cached == state
+    cached["dialogue_buffer"].append({"role": "assistant", "content": "Hi"})
+    assert cache.get(1, 3) == state
+
+
+def test_get_misses_on_new_version():
+    cache = BotStateCache(max_size=2, ttl_seconds=60)
+    cache.put(1, 3, {"crisis_mode": False})
+    assert cache.get(1, 4) is None
+    assert cache.get(1, 3) is None
+
+
+def test_least_recently_used_evicted():
+    cache = BotStateCache(max_size=2, ttl_seconds=60)
+    cache.put(1, 0, "one")
+    cache.put(2, 0, "two")
+    cache.get(1, 0)
+    cache.put(3, 0, "three")
+    assert cache.get(2, 0) is None
+    assert cache.get(1, 0) == "one"
+
+
+def test_expired_entries_miss():
+    cache = BotStateCache(max_size=2, ttl_seconds=60)
+    with patch("lliza.cache.time.monotonic", return_value=0):
+        cache.put(1, 0, "one")
+    with patch("lliza.cache.time.monotonic", return_value=61):
+        assert cache.get(1, 0) is None
@@ -0,0 +1,52 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from lliza.lliza import AsyncCarlBot
+
+
+@pytest.fixture
+def consumer(django_db):
+    from lliza.consumers import ConversationRelayConsumer
+    consumer = ConversationRelayConsumer()
+    consumer.user = MagicMock(pk=1, num_messages=1)
+    consumer.carlbot = AsyncCarlBot(base_system_prompt="Test System Prompt")
+    consumer.is_me = False
+    consumer.prompt_lock = asyncio.Lock()
+    consumer.prompt_tasks = set()
+    consumer.interrupted_reply = None
+    consumer.send = AsyncMock()
+    return consumer
+
+
+def test_interrupt_amends_the_last_reply(consumer):
+    consumer.carlbot.dialogue_buffer = [{"role": "user", "content": "Hello"},
+                                        {"role": "assistant", "content": "It sounds like a hard week."}]
+    consumer.handle_interrupt({"utteranceUntilInterrupt": "It sounds"})
+    assert consumer.carlbot.dialogue_buffer == [{"role": "user", "content": "Hello"},
+                                                {"role": "assistant", "content": "It sounds..."}]
+
+
+def test_interrupt_mid_prompt_amends_the_reply_once_added(consumer):
+    generating = asyncio.Event()
+    interrupted = asyncio.Event()
+
+    async def respond_to_user(content, is_me=False):
+        await consumer.carlbot._add_message("user", content, moderate=False)
+        generating.set()
+        await interrupted.wait()
+        return "It sounds like a hard week."
+    consumer.carlbot.respond_to_user = respond_to_user
+
+    async def prompt_then_interrupt():
+        task = asyncio.create_task(consumer.handle_prompt({"voicePrompt": "Hello"}))
+        await generating.wait()
+        consumer.handle_interrupt({"utteranceUntilInterrupt": "It sounds"})
+        interrupted.set()
+        await task
+
+    with patch("lliza.consumers.User"), patch("lliza.consumers.VOICE_STREAMING", False):
+        asyncio.run(prompt_then_interrupt())
+    assert [(message["role"], message["content"]) for message in consumer.carlbot.dialogue_buffer] == [
+        ("user", "Hello"), ("assistant", "It sounds...")]
@@ -0,0 +1,60 @@
+import hashlib
+from unittest.mock import patch
+
+import cryptocode
+
+from lliza import crypto
+
+
+def test_roundtrip():
+    token = crypto.encrypt("+15550000000", "secret")
+    assert token.startswith(crypto.V2_PREFIX)
+    assert crypto.decrypt(token, "secret") == "+15550000000"
+
+
+def test_tokens_are_salted():
+    assert crypto.encrypt("+15550000000", "secret") != crypto.encrypt("+15550000000", "secret")
+
+
+def test_decrypts_legacy_tokens():
+    token = cryptocode.encrypt("+15550000000", "secret")
+    assert crypto.is_legacy(token)
+    assert crypto.decrypt(token, "secret") == "+15550000000"
+
+
+def test_is_legacy():
+    assert not crypto.is_legacy(crypto.encrypt("Hello", "secret"))
+    assert crypto.is_legacy(cryptocode.encrypt("Hello", "secret"))
+
+
+def test_wrong_key_returns_false():
+    assert crypto.decrypt(crypto.encrypt("Hello", "secret"), "other secret") is False
+
+
+def test_tampered_token_returns_false():
+    token = crypto.encrypt("Hello", "secret")
+    body = token[len(crypto.V2_PREFIX):]
+    flipped = "A" if body[20] != "A" else "B"  # In the tag
+    assert crypto.decrypt(crypto.V2_PREFIX + body[:20] + flipped + body[21:], "secret") is False
+    assert crypto.decrypt(token[:-8], "secret") is False
+    assert crypto.decrypt(crypto.V2_PREFIX + "not base64!", "secret") is False
+
+
+def test_key_is_derived_once_per_secret():
+    crypto.derive_key.cache_clear()
+    with patch("lliza.crypto.hashlib.scrypt", wraps=hashlib.scrypt) as scrypt:
+        for _ in range(3):
+            crypto.decrypt(crypto.encrypt("Hello", "secret"), "secret")
+        crypto.encrypt("Hello", "other secret")
+    assert scrypt.call_count == 2
+
+
+def test_legacy_user_id_is_reencrypted_on_lookup(db):
+    from lliza.models import User
+    from lliza.utils import ENCRYPTION_KEY, get_user_from_number, hash_number
+    User.objects.create(user_id=cryptocode.encrypt("+15550000000", ENCRYPTION_KEY),
+                        number_hash=hash_number("+15550000000"))
+    user = get_user_from_number("+15550000000")
+    assert not crypto.is_legacy(user.user_id)
+    assert User.objects.get(pk=user.pk).user_id == user.user_id
+    assert crypto.decrypt(user.user_id, ENCRYPTION_KEY) == "+15550000000"
@@ -0,0 +1,24 @@
+import time
+
+from lliza.debounce import Debouncer
+
+
+def test_debouncer_runs_once_with_last_arguments():
+    calls = []
+    debouncer = Debouncer(0.1, lambda *args: calls.append(args))
+    debouncer.trigger("user", "first")
+    time.sleep(0.05)
+    debouncer.trigger("user", "second")
+    debouncer.trigger("other user", "third")
+    assert debouncer.pending("user")
+    time.sleep(0.3)
+    assert sorted(calls) == [("other user", "third"), ("user", "second")]
+    assert not debouncer.pending("user")
+
+
+def test_debouncer_logs_callback_errors():
+    logged = []
+    debouncer = Debouncer(0.01, lambda key: 1 / 0, log=logged.append)
+    debouncer.trigger("user")
+    time.sleep(0.1)
+    assert len(logged) == 1
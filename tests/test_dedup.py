@@ -0,0 +1,45 @@
+from datetime import timedelta
+
+import pytest
+
+
+@pytest.fixture
+def dedup_store(db):
+    from lliza.dedup import DedupStore
+    return DedupStore(ttl_seconds=60, cache_size=10)
+
+
+def test_second_delivery_is_a_duplicate(dedup_store):
+    assert not dedup_store.is_duplicate("message", "SM1")
+    assert dedup_store.is_duplicate("message", "SM1")
+    assert not dedup_store.is_duplicate("message", "SM2")
+    assert not dedup_store.is_duplicate("status", "SM1")
+
+
+def test_duplicates_are_found_across_workers(dedup_store):
+    from lliza.dedup import DedupStore
+    assert not dedup_store.is_duplicate("message", "SM1")
+    assert DedupStore(ttl_seconds=60, cache_size=10).is_duplicate("message", "SM1")
+
+
+def test_events_without_a_key_are_never_duplicates(dedup_store):
+    assert not dedup_store.is_duplicate("message", None)
+    assert not dedup_store.is_duplicate("message", None)
+
+
+def test_forgotten_event_is_not_a_duplicate(dedup_store):
+    from lliza.models import ProcessedEvent
+    assert not dedup_store.is_duplicate("message", "SM1")
+    dedup_store.forget("message", "SM1")
+    assert not ProcessedEvent.objects.exists()
+    assert not dedup_store.is_duplicate("message", "SM1")
+
+
+def test_prune_deletes_expired_events(dedup_store):
+    from django.utils import timezone
+    from lliza.models import ProcessedEvent
+    dedup_store.is_duplicate("message", "SM1")
+    dedup_store.is_duplicate("message", "SM2")
+    ProcessedEvent.objects.filter(key="SM1").update(processed_at=timezone.now() - timedelta(seconds=120))
+    dedup_store.prune()
+    assert list(ProcessedEvent.objects.values_list("key", flat=True)) == ["SM2"]
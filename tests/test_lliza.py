@@ -1,13 +1,14 @@
+import asyncio
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 
-from lliza.lliza import CarlBot
+from lliza.lliza import CarlBot, AsyncCarlBot, LEGACY_NEW_SESSION_PROMPT, NEW_SESSION_NOTE
 
 
 @pytest.fixture
 def bot():
     return CarlBot(base_system_prompt="Test System Prompt",
-                   max_n_dialogue_buffer_messages=4,
+                   max_dialogue_buffer_tokens=24,  # 4 messages like "Message 1"
                    max_summary_buffer_points=2)
 
 
@@ -47,6 +48,15 @@ def test_summarize_attitudes_in_dialogue(mock_openai, bot):
     assert mock_openai.Completion.create.call_count == 1
 
 
+def test_messages_put_static_system_prompt_first(bot):
+    other_bot = CarlBot(base_system_prompt="Test System Prompt")
+    bot.summary_buffer = ["I feel bad"]
+    bot.dialogue_buffer = [{"role": "user", "content": "Hello"}]
+    assert bot.messages[0] == other_bot.messages[0] == {"role": "system", "content": "Test System Prompt"}
+    assert bot.messages[1] == {"role": "system", "content": "Previously Expressed Attitudes:\n- I feel bad"}
+    assert bot.messages[2:] == [{"role": "user", "content": "Hello"}]
+
+
 # add_message
 def test_add_message_single_message(bot):
     bot.is_crisis = MagicMock(return_value=False)
@@ -57,13 +67,179 @@ def test_add_message_single_message(bot):
 
 def test_add_message_max_messages(bot):
     bot.is_crisis = MagicMock(return_value=False)
-    max_n = bot.max_n_dialogue_buffer_messages
-    min_n = bot.min_n_dialogue_buffer_messages
+    bot.min_dialogue_buffer_tokens = 12
     bot.update_summary = MagicMock()
-    for i in range(max_n + 1):
+    for i in range(5):
         bot.add_message("user", f"Message {i}")
     assert bot.update_summary.call_count == 1
-    assert len(bot.dialogue_buffer) == min_n
+    assert len(bot.dialogue_buffer) == 2
+
+def test_split_content_by_tokens(bot):
+    bot.max_user_message_tokens = 3
+    assert bot.split_content("one two three") == ["one two three"]
+    assert bot.split_content("one two three four five") == ["one two", "three four five"]
+
+
+def test_messages_fit_token_budget_and_omit_counts(bot):
+    bot.defer_summary = True
+    bot.is_crisis = MagicMock(return_value=False)
+    for i in range(6):
+        bot.add_message("user", f"Message {i}")
+    assert bot.dialogue_buffer_tokens == 36
+    assert all(message["n_tokens"] == 6 for message in bot.dialogue_buffer)
+    assert bot.messages[2:] == [{"role": "user", "content": f"Message {i}"} for i in range(2, 6)]
+
+
+def test_session_boundaries_take_no_tokens_and_only_the_latest_is_noted(bot):
+    bot.is_crisis = MagicMock(return_value=False)
+    bot.load([{"role": "system", "content": LEGACY_NEW_SESSION_PROMPT, "n_tokens": 40},
+              {"role": "assistant", "content": "Hi"}], [], False)
+    bot.get_new_session_message = MagicMock(return_value="Hello")
+    bot.start_new_session()
+    assert bot.dialogue_buffer_tokens == 2 * 5
+    assert bot.messages[2:] == [{"role": "assistant", "content": "Hi"},
+                                {"role": "system", "content": NEW_SESSION_NOTE},
+                                {"role": "assistant", "content": "Hello"}]
+
+
+def test_session_boundaries_are_not_summarized(bot):
+    bot.load([bot.session_boundary(), {"role": "user", "content": "Hello"}], [], False)
+    kwargs = bot._summarize_attitudes_in_dialogue_kwargs(bot.dialogue_buffer, 2)
+    assert kwargs["messages"][0]["content"].startswith("user: Hello\n###")
+
+
+# respond_to_user
+def test_respond_to_user_returns_generated_response(bot):
+    bot.is_crisis = MagicMock(return_value=False)
+    bot.get_response = MagicMock(return_value="I hear you")
+    assert bot.respond_to_user("Hello") == "I hear you"
+    assert bot.messages[-1] == {"role": "user", "content": "Hello"}
+    assert not bot.crisis_mode
+
+
+def test_respond_to_user_discards_response_in_crisis(bot):
+    bot.is_crisis = MagicMock(return_value=True)
+    bot.get_response = MagicMock(return_value="I hear you")
+    assert bot.respond_to_user("Hello") == bot.crisis_response
+    assert bot.crisis_mode
+    assert bot.respond_to_user("Hello", is_me=True) == "I hear you"
+
+def test_async_respond_to_user_discards_response_in_crisis():
+    bot = AsyncCarlBot(base_system_prompt="Test System Prompt")
+    bot.is_crisis = AsyncMock(return_value=True)
+    bot.get_response = AsyncMock(return_value="I hear you")
+    assert asyncio.run(bot.respond_to_user("Hello")) == bot.crisis_response
+    assert bot.crisis_mode
+    assert bot.messages[-1] == {"role": "user", "content": "Hello"}
+
+def _collect(async_iterator):
+    async def collect():
+        return [item async for item in async_iterator]
+    return asyncio.run(collect())
+
+
+def test_stream_respond_to_user_streams_tokens():
+    bot = AsyncCarlBot(base_system_prompt="Test System Prompt")
+    bot.is_crisis = AsyncMock(return_value=False)
+
+    async def stream_response(is_me=False):
+        for token in ["I ", "hear ", "you"]:
+            yield token
+    bot.stream_response = stream_response
+    assert _collect(bot.stream_respond_to_user("Hello")) == ["I ", "hear ", "you"]
+
+
+def test_stream_respond_to_user_holds_tokens_in_crisis():
+    bot = AsyncCarlBot(base_system_prompt="Test System Prompt")
+    bot.is_crisis = AsyncMock(return_value=True)
+
+    async def stream_response(is_me=False):
+        for token in ["I ", "hear ", "you"]:
+            yield token
+    bot.stream_response = stream_response
+    assert _collect(bot.stream_respond_to_user("Hello")) == [bot.crisis_response]
+    assert bot.crisis_mode
+
+def test_stream_respond_to_user_closes_stream_in_crisis():
+    bot = AsyncCarlBot(base_system_prompt="Test System Prompt")
+    bot.is_crisis = AsyncMock(return_value=True)
+    closed = []
+
+    async def stream_response(is_me=False):
+        try:
+            for token in ["I ", "hear ", "you"]:
+                await asyncio.sleep(0)
+                yield token
+        finally:
+            closed.append(True)
+    bot.stream_response = stream_response
+
+    async def closed_when_crisis_response_arrives():
+        return [bool(closed) async for _ in bot.stream_respond_to_user("Hello")]
+    assert asyncio.run(closed_when_crisis_response_arrives()) == [True]
+
+# adaptive sampling
+def completion(*contents, prompt_tokens=100, completion_tokens=10, cached_tokens=0):
+    return MagicMock(choices=[MagicMock(message=MagicMock(content=content)) for content in contents],
+                     usage=MagicMock(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                     prompt_tokens_details=MagicMock(cached_tokens=cached_tokens)))
+
+def test_sampling_stops_early_when_candidates_agree(bot):
+    bot.dialogue_buffer = [{"role": "user", "content": "Hi there"}, {"role": "assistant", "content": "Hello."}] * 2
+    bot.dialogue_buffer.append({"role": "user", "content": "My brother never listens to me"})
+    bot.rank_responses = MagicMock()
+    with patch("lliza.lliza.transport") as transport:
+        transport.chat.return_value = completion("You feel unheard.", "You feel unheard!")
+        bot._start_turn()
+        bot.get_response()
+    assert transport.chat.call_count == 1
+    assert transport.chat.call_args.kwargs["n"] == 2
+    assert bot.turn_usage == {"prompt_tokens": 100, "completion_tokens": 10, "cached_tokens": 0}
+
+def test_sampling_generates_more_when_candidates_disagree(bot):
+    bot.dialogue_buffer = [{"role": "user", "content": "Hi there"}, {"role": "assistant", "content": "Hello."}] * 2
+    bot.dialogue_buffer.append({"role": "user", "content": "My brother never listens to me"})
+    bot.rank_responses = MagicMock(side_effect=lambda responses: responses[::-1])
+    with patch("lliza.lliza.transport") as transport:
+        transport.chat.side_effect = [completion("You feel unheard.", "That sounds lonely."),
+                                      completion("a", "b", "It hurts.")]
+        bot._start_turn()
+        assert bot.get_response() == "It hurts."
+    assert [call.kwargs["n"] for call in transport.chat.call_args_list] == [2, 3]
+    assert len(bot.rank_responses.call_args.args[0]) == 5
+    assert bot.turn_usage == {"prompt_tokens": 200, "completion_tokens": 20, "cached_tokens": 0}
+
+def test_cancelled_turn_skips_extra_generation_and_ranking(bot):
+    bot.dialogue_buffer = [{"role": "user", "content": "My brother never listens to me"}]
+    bot.rank_responses = MagicMock()
+    bot.sampling_policy = MagicMock()
+    bot.sampling_policy.choose_n.return_value = 2
+    with patch("lliza.lliza.transport") as transport:
+        bot._start_turn()
+        transport.chat.side_effect = lambda *args, **kwargs: (bot.turn_cancelled.set(), completion("a", "b"))[1]
+        assert bot.get_response() == bot.crisis_response
+    assert transport.chat.call_count == 1
+    bot.rank_responses.assert_not_called()
+    bot.sampling_policy.choose_extra_n.assert_not_called()
+    bot.sampling_policy.record_escalation.assert_not_called()
+
+# deferred summary
+def test_apply_summary_keeps_messages_added_since(bot):
+    bot.is_crisis = MagicMock(return_value=False)
+    bot.min_dialogue_buffer_tokens = 12
+    bot.defer_summary = True
+    for i in range(5):
+        bot.add_message("user", f"Message {i}")
+    assert bot.needs_summary
+    bot.summarize_attitudes_in_dialogue = MagicMock(return_value=["Bullet 1"])
+    summary = bot.compute_summary()
+    assert len(bot.dialogue_buffer) == 5
+    bot.add_message("user", "Message 5")
+    assert bot.apply_summary(summary)
+    assert [m["content"] for m in bot.dialogue_buffer] == ["Message 3", "Message 4", "Message 5"]
+    assert bot.summary_buffer == ["Bullet 1"]
+    assert bot.dialogue_offset == 3
+    assert not bot.apply_summary(summary)
 
 # update_summary
 def test_update_summary_no_recursive_summary(bot):
@@ -0,0 +1,108 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from lliza import metrics, usage
+from lliza.llm_transport import LLMTransport, GENERATION, RANKING
+from lliza.usage import UsageMeter
+
+
+def make_transport():
+    return LLMTransport(hedged_call_types=[GENERATION], hedge_min_samples=3)
+
+
+def test_no_hedge_without_enough_samples():
+    transport = make_transport()
+    assert transport.hedge_delay(GENERATION) is None
+    for latency in [0.1, 0.2, 0.3]:
+        transport._record_latency(GENERATION, latency)
+    assert transport.hedge_delay(GENERATION) == 0.3
+    transport._record_latency(RANKING, 0.1)
+    assert transport.hedge_delay(RANKING) is None
+
+
+def test_hedged_call_returns_faster_duplicate():
+    transport = make_transport()
+    for _ in range(3):
+        transport._record_latency(GENERATION, 0.01)
+    delays = iter([1.0, 0.0])
+
+    def slow_then_fast():
+        delay = next(delays)
+        time.sleep(delay)
+        return delay
+    start = time.perf_counter()
+    assert transport._call(GENERATION, slow_then_fast) == 0.0
+    assert time.perf_counter() - start < 0.5
+
+
+def test_async_hedged_call_returns_faster_duplicate():
+    transport = make_transport()
+    for _ in range(3):
+        transport._record_latency(GENERATION, 0.01)
+    delays = iter([1.0, 0.0])
+
+    async def slow_then_fast():
+        delay = next(delays)
+        await asyncio.sleep(delay)
+        return delay
+    assert asyncio.run(transport._acall(GENERATION, slow_then_fast)) == 0.0
+
+
+def hedged_transport():
+    transport = make_transport()
+    for _ in range(3):
+        transport._record_latency(GENERATION, 0.01)
+    return transport
+
+
+def response(prompt_tokens):
+    return SimpleNamespace(model="chat-model", usage=SimpleNamespace(
+        prompt_tokens=prompt_tokens, completion_tokens=1, prompt_tokens_details=None))
+
+
+def hedges():
+    return metrics.summary().get("openai_generation_hedged", {}).get("total", 0)
+
+
+def test_hedge_is_counted_and_both_responses_are_metered():
+    transport = hedged_transport()
+    responses = iter([(1.0, response(100)), (0.0, response(10))])
+
+    def create(**kwargs):
+        delay, result = next(responses)
+        time.sleep(delay)
+        return result
+    transport.client = SimpleNamespace(with_options=lambda **options: SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+    hedged = hedges()
+    with patch("lliza.usage.meter", UsageMeter()) as meter, usage.account(7):
+        assert transport.chat(GENERATION, messages=[]).usage.prompt_tokens == 10
+        transport._hedge_executor.shutdown(wait=True)
+    assert hedges() == hedged + 1
+    counter = meter.drain()[(7, usage._today(), GENERATION, "chat-model")]
+    assert (counter["n_calls"], counter["prompt_tokens"]) == (2, 110)
+
+
+def test_async_hedge_is_counted_and_both_responses_are_metered():
+    transport = hedged_transport()
+    responses = iter([(1.0, response(100)), (0.0, response(10))])
+
+    async def create(**kwargs):
+        delay, result = next(responses)
+        await asyncio.sleep(delay)
+        return result
+    transport.async_client = SimpleNamespace(with_options=lambda **options: SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+
+    async def chat():
+        reply = await transport.achat(GENERATION, messages=[])
+        await asyncio.gather(*transport._hedge_losers)
+        return reply
+    hedged = hedges()
+    with patch("lliza.usage.meter", UsageMeter()) as meter, usage.account(7):
+        assert asyncio.run(chat()).usage.prompt_tokens == 10
+    assert hedges() == hedged + 1
+    counter = meter.drain()[(7, usage._today(), GENERATION, "chat-model")]
+    assert (counter["n_calls"], counter["prompt_tokens"]) == (2, 110)
@@ -0,0 +1,153 @@
+import pytest
+
+
+@pytest.fixture
+def user(db):
+    from lliza.utils import get_user_from_number
+    return get_user_from_number("+15550000000")
+
+
+def reload(user):
+    """Load the user's bot from their records, as another worker would"""
+    from lliza import utils
+    from lliza.models import User
+    user = User.objects.get(pk=user.pk)
+    utils.bot_state_cache.invalidate(user.pk)
+    return user, utils.load_carlbot(user)
+
+
+def contents(messages):
+    return [(message["role"], message["content"]) for message in messages]
+
+
+def add_messages(carl, *contents):
+    for i, content in enumerate(contents):
+        carl._add_message("user" if i % 2 == 0 else "assistant", content, moderate=False)
+
+
+def records(user, kind):
+    from lliza.models import MemoryRecord
+    from lliza.utils import ENCRYPTION_KEY, encrypted_string_to_dict
+    return [(record.seq, encrypted_string_to_dict(ENCRYPTION_KEY, record.encrypted_content))
+            for record in MemoryRecord.objects.filter(user=user, kind=kind).order_by("seq")]
+
+
+def test_save_and_load_roundtrip(user):
+    from lliza.models import MemoryRecord
+    from lliza.utils import load_carlbot, save_carlbot
+    carl = load_carlbot(user)
+    add_messages(carl, "Hello", "Hi, what's on your mind?", "My brother never listens")
+    carl.all_summary_points = ["I feel unheard"]
+    carl.summary_buffer = ["I feel unheard"]
+    carl.crisis_mode = True
+    save_carlbot(user, carl)
+
+    user, loaded = reload(user)
+    assert contents(loaded.dialogue_buffer) == contents(carl.dialogue_buffer)
+    assert loaded.summary_buffer == ["I feel unheard"]
+    assert loaded.crisis_mode
+    assert records(user, MemoryRecord.SUMMARY_POINT) == [(0, "I feel unheard")]
+    assert [seq for seq, _ in records(user, MemoryRecord.DIALOGUE)] == [0, 1, 2]
+
+
+def test_save_after_reload_appends_only_the_new_messages(user):
+    from lliza.models import MemoryRecord
+    from lliza.utils import load_carlbot, save_carlbot
+    carl = load_carlbot(user)
+    add_messages(carl, "Hello", "Hi, what's on your mind?")
+    save_carlbot(user, carl)
+    saved_pks = list(MemoryRecord.objects.filter(user=user).order_by("seq").values_list("pk", flat=True))
+
+    user, carl = reload(user)
+    carl._add_message("user", "My brother never listens", moderate=False)
+    save_carlbot(user, carl)
+
+    dialogue = MemoryRecord.objects.filter(user=user, kind=MemoryRecord.DIALOGUE).order_by("seq")
+    assert list(dialogue.values_list("pk", flat=True))[:2] == saved_pks
+    assert [(seq, message["content"]) for seq, message in records(user, MemoryRecord.DIALOGUE)] == [
+        (0, "Hello"), (1, "Hi, what's on your mind?"), (2, "My brother never listens")]
+
+
+def test_offsets_after_a_summary(user):
+    from lliza.models import MemoryRecord
+    from lliza.utils import load_carlbot, save_carlbot
+    carl = load_carlbot(user)
+    add_messages(carl, "Hello", "Hi, what's on your mind?", "My brother never listens", "That hurts.")
+    carl.summary_buffer = ["Old bullet"]
+    save_carlbot(user, carl)
+
+    # Summarize the first two messages into a condensed summary buffer, which starts a new summary window
+    user, carl = reload(user)
+    summary = carl._summary_result(carl.dialogue_buffer[:2], ["New bullet"], ["Condensed bullet"])
+    assert carl.apply_summary(summary)
+    save_carlbot(user, carl)
+
+    user, loaded = reload(user)
+    assert (user.dialogue_offset, user.summary_offset) == (2, 1)
+    assert contents(loaded.dialogue_buffer) == [("user", "My brother never listens"), ("assistant", "That hurts.")]
+    assert loaded.dialogue_offset == 2
+    assert loaded.summary_buffer == ["Condensed bullet"]
+    # Summarized messages and the old summary window are kept, just no longer loaded
+    assert [seq for seq, _ in records(user, MemoryRecord.DIALOGUE)] == [0, 1, 2, 3]
+    assert records(user, MemoryRecord.SUMMARY) == [(0, "Old bullet"), (1, "Condensed bullet")]
+    assert records(user, MemoryRecord.SUMMARY_POINT) == [(0, "New bullet")]
+
+
+def test_legacy_memory_is_moved_to_records(user):
+    from lliza.models import MemoryRecord
+    from lliza.utils import ENCRYPTION_KEY, dict_to_encrypted_string, load_carlbot, save_carlbot
+    user.encrypted_memory_dict_string = dict_to_encrypted_string(ENCRYPTION_KEY, {
+        "dialogue_buffer": [{"role": "user", "content": "Hello"}, {"role": "assistant", "content": "Hi"}],
+        "summary_buffer": ["I feel unheard"],
+        "crisis_mode": False,
+    })
+    user.save()
+
+    carl = load_carlbot(user)
+    save_carlbot(user, carl)
+
+    user, loaded = reload(user)
+    assert user.encrypted_memory_dict_string is None
+    assert contents(loaded.dialogue_buffer) == [("user", "Hello"), ("assistant", "Hi")]
+    assert loaded.summary_buffer == ["I feel unheard"]
+    assert [seq for seq, _ in records(user, MemoryRecord.DIALOGUE)] == [0, 1]
+
+
+def test_migration_moves_memory_dicts_to_records(user):
+    import importlib
+    import json
+    import cryptocode
+    from django.apps import apps
+    from lliza.utils import ENCRYPTION_KEY
+    migration = importlib.import_module("lliza.migrations.0008_memoryrecord")
+    user.encrypted_memory_dict_string = cryptocode.encrypt(json.dumps({
+        "dialogue_buffer": [{"role": "user", "content": "Hello"}, {"role": "assistant", "content": "Hi"}],
+        "summary_buffer": ["I feel unheard"],
+        "crisis_mode": True,
+        "dialogue_offset": 5,
+    }), ENCRYPTION_KEY)
+    user.save()
+
+    migration.move_memory_dicts_to_records(apps, None)
+
+    user, loaded = reload(user)
+    assert user.encrypted_memory_dict_string is None
+    assert (user.dialogue_offset, user.summary_offset, user.crisis_mode) == (5, 0, True)
+    assert contents(loaded.dialogue_buffer) == [("user", "Hello"), ("assistant", "Hi")]
+    assert loaded.summary_buffer == ["I feel unheard"]
+
+
+def test_summary_is_requested_once_until_it_runs(user):
+    from types import SimpleNamespace
+    from unittest.mock import patch
+    from lliza import utils
+    full = SimpleNamespace(defer_summary=True, needs_summary=True)
+    with patch("lliza.utils.tasks.async_task") as async_task:
+        utils.schedule_summary(user, full)
+        utils.schedule_summary(user, full)
+        assert async_task.call_count == 1
+
+        # Nothing left to summarize, so the task just releases the request
+        utils.summarize_memory(user.pk)
+        utils.schedule_summary(user, full)
+        assert async_task.call_count == 2
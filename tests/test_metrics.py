@@ -0,0 +1,50 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+from lliza import metrics
+
+
+def test_spans_in_a_trace_are_logged_when_it_is_slow():
+    log = MagicMock()
+
+    def threaded_stage():
+        with metrics.span("test_thread_stage"):
+            pass
+
+    with patch("lliza.metrics.SLOW_TRACE_SECONDS", -1):
+        with metrics.trace("test_request", log=log):
+            with metrics.span("test_stage"):
+                pass
+            with ThreadPoolExecutor() as pool:
+                pool.submit(contextvars.copy_context().run, threaded_stage).result()
+    stats = metrics.summary()
+    assert stats["stage_test_stage_seconds"]["histogram"]["+Inf"] >= 1
+    assert stats["test_request_seconds"]["count"] >= 1
+    message = log.call_args[0][0]
+    assert message.startswith("Slow test_request took")
+    assert "test_stage" in message and "test_thread_stage" in message
+
+
+def test_histogram_buckets_are_cumulative():
+    for seconds in (0.001, 0.3, 100):
+        metrics.observe("test_cumulative_seconds", seconds)
+    histogram = metrics.summary()["test_cumulative_seconds"]["histogram"]
+    assert histogram["0.01"] == 1
+    assert histogram["0.5"] == 2
+    assert histogram["60"] == 2
+    assert histogram["+Inf"] == 3
+
+
+def test_trace_collects_async_spans_and_skips_fast_traces():
+    log = MagicMock()
+
+    async def turn():
+        with metrics.trace("test_async_request", log=log):
+            with metrics.span("test_async_stage"):
+                await asyncio.sleep(0)
+
+    asyncio.run(turn())
+    assert metrics.summary()["stage_test_async_stage_seconds"]["count"] >= 1
+    log.assert_not_called()
@@ -0,0 +1,59 @@
+import time
+from unittest.mock import MagicMock
+
+from lliza.outbound import OutboundMessageQueue
+
+
+def test_sends_every_message():
+    send = MagicMock()
+    outbound_queue = OutboundMessageQueue(send, max_per_second=1000, log=MagicMock())
+    for i in range(5):
+        outbound_queue.enqueue(f"+1555000000{i}", "Hello")
+    assert outbound_queue.flush(timeout=5)
+    assert sorted(call.args[0] for call in send.call_args_list) == [f"+1555000000{i}" for i in range(5)]
+
+
+def test_retries_failed_sends():
+    send = MagicMock(side_effect=[RuntimeError("Twilio down"), None])
+    outbound_queue = OutboundMessageQueue(send, max_per_second=1000, log=MagicMock())
+    outbound_queue.enqueue("+15550000000", "Hello")
+    assert outbound_queue.flush(timeout=5)
+    assert send.call_count == 2
+
+
+def test_rate_limited():
+    send = MagicMock()
+    outbound_queue = OutboundMessageQueue(send, max_per_second=20, log=MagicMock())
+    start = time.monotonic()
+    for _ in range(5):
+        outbound_queue.enqueue("+15550000000", "Hello")
+    assert outbound_queue.flush(timeout=5)
+    assert time.monotonic() - start >= 4 / 20
+
+
+def test_sends_in_order_per_number():
+    sent = []
+    send = MagicMock(side_effect=lambda to, body: (time.sleep(0.01), sent.append((to, body))))
+    outbound_queue = OutboundMessageQueue(send, max_per_second=1000, n_senders=4, log=MagicMock())
+    for i in range(10):
+        outbound_queue.enqueue("+15550000000", str(i))
+        outbound_queue.enqueue("+15550000001", str(i))
+    assert outbound_queue.flush(timeout=5)
+    assert [body for to, body in sent if to == "+15550000000"] == [str(i) for i in range(10)]
+    assert [body for to, body in sent if to == "+15550000001"] == [str(i) for i in range(10)]
+
+
+def test_retry_goes_before_later_messages():
+    sent = []
+
+    def send(to, body):
+        if body == "first" and "first" not in failed:
+            failed.add("first")
+            raise RuntimeError("Twilio down")
+        sent.append(body)
+    failed = set()
+    outbound_queue = OutboundMessageQueue(send, max_per_second=1000, log=MagicMock())
+    outbound_queue.enqueue("+15550000000", "first")
+    outbound_queue.enqueue("+15550000000", "second")
+    assert outbound_queue.flush(timeout=5)
+    assert sent == ["first", "second"]
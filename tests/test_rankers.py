@@ -0,0 +1,45 @@
+from unittest.mock import MagicMock
+
+from lliza.rankers import HeuristicRanker, LLMRanker, RANKING_INSTRUCTIONS
+
+
+def test_parse_ranking_reads_last_line_after_explanations():
+    responses = ["a", "b", "c"]
+    ranking = "Response 1 is fine.\nResponse 2 asks a question, 3 is best.\n\n3, 1, 2."
+    assert LLMRanker.parse_ranking(ranking, responses) == ["c", "a", "b"]
+
+
+def test_parse_ranking_fills_in_missing_and_invalid_responses():
+    responses = ["a", "b", "c"]
+    assert LLMRanker.parse_ranking('"2,2,7"', responses) == ["b", "a", "c"]
+    assert LLMRanker.parse_ranking("I can't rank these.", responses) == responses
+
+
+def test_rank_kwargs_start_with_static_instructions():
+    ranker = LLMRanker(MagicMock(), "model")
+    dialogue = [{"role": "user", "content": "Hello"}]
+    messages = ranker._rank_kwargs(dialogue, ["a", "b"])["messages"]
+    other_messages = ranker._rank_kwargs(dialogue + [{"role": "assistant", "content": "Hi"}], ["c", "d", "e"])["messages"]
+    assert messages[0] == other_messages[0] == {"role": "system", "content": RANKING_INSTRUCTIONS}
+    assert "[Response 2]\nb" in messages[1]["content"]
+
+
+def test_heuristic_prefers_reflection_over_questions_and_advice():
+    dialogue = [{"role": "user", "content": "My sister moved away and I've been so lonely."}]
+    reflection = "It sounds like you're feeling lonely since your sister left."
+    question = "Why did she move? How often do you talk?"
+    advice = "You should try joining a club to meet new people."
+    ranked = HeuristicRanker().rank(dialogue, [question, advice, reflection])
+    assert ranked[0] == reflection
+
+
+def test_heuristic_penalizes_parroting_and_repetition():
+    dialogue = [
+        {"role": "assistant", "content": "You're feeling stuck at work."},
+        {"role": "user", "content": "My boss ignores every idea I bring up"},
+    ]
+    parrot = "Your boss ignores every idea you bring up."
+    repeat = "You're feeling stuck at work."
+    reflection = "You feel unheard when your ideas are ignored."
+    ranked = HeuristicRanker().rank(dialogue, [parrot, repeat, reflection])
+    assert ranked[0] == reflection
@@ -0,0 +1,41 @@
+from lliza.sampling import SamplingPolicy
+
+
+def dialogue(client_message, n_replies=3):
+    messages = []
+    for _ in range(n_replies):
+        messages += [{"role": "user", "content": "Something happened"}, {"role": "assistant", "content": "Mm."}]
+    return messages + [{"role": "user", "content": client_message}]
+
+
+def test_choose_n():
+    policy = SamplingPolicy(max_n=5, initial_n=2)
+    assert policy.choose_n(dialogue("ok thanks")) == 1
+    assert policy.choose_n(dialogue("Thank you.")) == 1
+    assert policy.choose_n(dialogue("I keep fighting with my brother about our mom", n_replies=0)) == 5
+    assert policy.choose_n(dialogue("I keep fighting with my brother about our mom")) == 2
+
+
+def test_short_messages_are_not_trivial():
+    policy = SamplingPolicy()
+    assert policy.is_trivial("Ok, thank you!")
+    assert policy.is_trivial("yeah got it")
+    assert not policy.is_trivial("")
+    assert not policy.is_trivial("I'm suicidal")
+    assert not policy.is_trivial("dad died")
+    assert not policy.is_trivial("no one cares")
+    assert policy.choose_n(dialogue("dad died")) == 2
+
+
+def test_choose_extra_n_stops_early_when_candidates_agree():
+    policy = SamplingPolicy(max_n=5, initial_n=2)
+    assert policy.choose_extra_n(["You feel hurt by him.", "You feel hurt by him!"]) == 0
+    assert policy.choose_extra_n(["You feel hurt by him.", "That sounds exhausting."]) == 3
+    assert policy.choose_extra_n(["You feel hurt by him."]) == 0
+
+
+def test_choose_extra_n_requests_fewer_when_extras_rarely_win():
+    policy = SamplingPolicy(max_n=5, initial_n=2, min_escalations=10)
+    for _ in range(10):
+        policy.record_escalation(False)
+    assert policy.choose_extra_n(["You feel hurt by him.", "That sounds exhausting."]) == 1
@@ -0,0 +1,109 @@
+import importlib
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+
+
+@pytest.fixture
+def user(db):
+    from lliza.utils import get_user_from_number
+    return get_user_from_number("+15550000000")
+
+
+@pytest.fixture
+def dispatched():
+    """The chunks of slots dispatch_due_sessions queues"""
+    chunks = []
+    with patch("lliza.scheduler.tasks.async_task", lambda func, slots: chunks.append(slots)):
+        yield chunks
+
+
+def make_slot(user, due_ago: timedelta):
+    from django.utils import timezone
+    from lliza.models import SessionSlot
+    return SessionSlot.objects.create(user=user, call_or_text="Text", cron="0 14 * * 1",
+                                      next_run=timezone.now() - due_ago)
+
+
+def test_dispatch_claims_due_slots_once(user, dispatched):
+    from lliza.scheduler import dispatch_due_sessions
+    slot = make_slot(user, timedelta(seconds=5))
+    make_slot(user, timedelta(seconds=-60))  # Not due yet
+    dispatch_due_sessions()
+    dispatch_due_sessions()
+    assert [[pk for pk, _, _ in chunk] for chunk in dispatched] == [[slot.pk]]
+    slot.refresh_from_db()
+    assert slot.claimed_at is not None
+
+
+def test_slot_moves_on_only_once_its_session_starts(user, dispatched):
+    from django.utils import timezone
+    from lliza.scheduler import dispatch_due_sessions, start_slot
+    slot = make_slot(user, timedelta(seconds=5))
+    due = slot.next_run
+    dispatch_due_sessions()
+    with patch("lliza.scheduler.start_user_session", side_effect=RuntimeError("Twilio is down")):
+        assert start_slot(dispatched[0][0]) is None
+    slot.refresh_from_db()
+    assert (slot.next_run, slot.claimed_at) == (due, None)
+
+    # Retried by the next dispatch
+    dispatch_due_sessions()
+    with patch("lliza.scheduler.start_user_session") as start_user_session:
+        assert start_slot(dispatched[1][0]) >= 5
+    start_user_session.assert_called_once()
+    slot.refresh_from_db()
+    assert slot.next_run > timezone.now()
+    assert slot.claimed_at is None
+
+
+def test_expired_claim_is_dispatched_again_and_the_old_one_ignored(user, dispatched):
+    from django.utils import timezone
+    from lliza.models import SessionSlot
+    from lliza.scheduler import SESSION_CLAIM_LEASE, dispatch_due_sessions, start_slot
+    slot = make_slot(user, timedelta(seconds=5))
+    dispatch_due_sessions()
+    SessionSlot.objects.filter(pk=slot.pk).update(claimed_at=timezone.now() - SESSION_CLAIM_LEASE - timedelta(seconds=1))
+    dispatch_due_sessions()
+    assert len(dispatched) == 2
+    with patch("lliza.scheduler.start_user_session") as start_user_session:
+        assert start_slot(dispatched[0][0]) is None
+        assert start_slot(dispatched[1][0]) is not None
+    start_user_session.assert_called_once()
+
+
+def test_long_missed_slots_are_skipped(user, dispatched):
+    from django.utils import timezone
+    from lliza.scheduler import dispatch_due_sessions
+    slot = make_slot(user, timedelta(hours=3))
+    dispatch_due_sessions()
+    assert dispatched == []
+    slot.refresh_from_db()
+    assert slot.next_run > timezone.now()
+    assert slot.claimed_at is None
+
+
+def test_migration_converts_linked_schedules(user):
+    from django.apps import apps
+    from django_q import tasks
+    from django_q.models import Schedule
+    from lliza.models import SessionSlot, UserSchedule
+    migration = importlib.import_module("lliza.migrations.0012_sessionslot")
+    linked = tasks.schedule(migration.START_SESSION_FUNC, user.user_id, "Call", schedule_type="C",
+                            cron="30 13 * * 2", next_run="2026-10-20 13:30:00+00:00")
+    UserSchedule.objects.create(user=user, schedule=linked)
+    unlinked = tasks.schedule(migration.START_SESSION_FUNC, "v2$unknown", "Text", schedule_type="C",
+                              cron="0 14 * * 1", next_run="2026-10-19 14:00:00+00:00")
+
+    migration.move_schedules_to_slots(apps, None)
+    slot = SessionSlot.objects.get()
+    assert (slot.user, slot.call_or_text, slot.cron) == (user, "Call", "30 13 * * 2")
+    assert set(Schedule.objects.values_list("func", flat=True)) == {migration.START_SESSION_FUNC, migration.DISPATCH_FUNC}
+    assert Schedule.objects.filter(pk=unlinked.pk).exists()
+
+    migration.move_slots_to_schedules(apps, None)
+    restored = Schedule.objects.get(user_schedule__user=user)
+    assert (restored.func, restored.cron, restored.next_run) == (migration.START_SESSION_FUNC, slot.cron, slot.next_run)
+    assert restored.args == repr((user.user_id, "Call"))
+    assert not Schedule.objects.filter(func=migration.DISPATCH_FUNC).exists()
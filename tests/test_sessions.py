@@ -0,0 +1,68 @@
+from unittest.mock import patch
+
+import pytest
+
+from lliza.lliza import CarlBot, SESSION_BOUNDARY
+
+
+@pytest.fixture
+def user(db):
+    from lliza.utils import get_user_from_number, load_carlbot, save_carlbot
+    user = get_user_from_number("+15550000000")
+    carl = load_carlbot(user)
+    carl._add_message("user", "Hello", moderate=False)
+    carl._add_message("assistant", "Hi, what's on your mind?", moderate=False)
+    save_carlbot(user, carl)
+    return user
+
+
+def dialogue_records(user):
+    from lliza.models import MemoryRecord
+    return list(MemoryRecord.objects.filter(user=user, kind=MemoryRecord.DIALOGUE)
+                .order_by("seq").values_list("pk", "seq", "encrypted_content"))
+
+
+def test_new_session_appends_a_boundary_without_rewriting_history(user):
+    from lliza import utils
+    from lliza.models import User
+    before = dialogue_records(user)
+    version = user.memory_version
+    with patch.object(CarlBot, "get_new_session_message", return_value="How is it today?"):
+        assert utils.start_new_session(user) == "How is it today?"
+
+    after = dialogue_records(user)
+    assert after[:2] == before
+    assert [seq for _, seq, _ in after] == [0, 1, 2, 3]
+    user = User.objects.get(pk=user.pk)
+    assert user.memory_version == version + 1
+    utils.bot_state_cache.invalidate(user.pk)
+    dialogue = utils.load_carlbot(user).dialogue_buffer
+    assert [(message["role"], message["content"]) for message in dialogue[2:]] == [
+        (SESSION_BOUNDARY, ""), ("assistant", "How is it today?")]
+
+
+def test_scheduled_text_session_claims_the_turn(user):
+    from lliza.models import User
+    from lliza.twilio_views import start_user_session
+    claimed_during_start = []
+
+    def start_new_session(user, is_me=False):
+        claimed_during_start.append(User.objects.get(pk=user.pk).turn_claimed_at is not None)
+        return "How is it today?"
+    with patch("lliza.twilio_views.send_message") as send_message, \
+            patch("lliza.twilio_views.start_new_session", start_new_session):
+        start_user_session(user, "Text")
+    assert claimed_during_start == [True]
+    assert User.objects.get(pk=user.pk).turn_claimed_at is None
+    send_message.assert_called_once_with("+15550000000", "How is it today?")
+
+
+def test_scheduled_text_session_waits_for_a_turn_in_progress(user):
+    from lliza.twilio_views import start_user_session
+    from lliza.utils import claim_turn
+    claim_turn(user)
+    before = dialogue_records(user)
+    with patch("lliza.twilio_views.send_message") as send_message:
+        start_user_session(user, "Text")
+    send_message.assert_not_called()
+    assert dialogue_records(user) == before
@@ -0,0 +1,83 @@
+from datetime import timedelta
+
+import pytest
+
+
+@pytest.fixture
+def user(db):
+    from lliza.utils import get_user_from_number
+    return get_user_from_number("+15550000000")
+
+
+def respond(carl, content):
+    carl._add_message("user", content, moderate=False)
+    reply = f"Reply to {content}"
+    carl._add_message("assistant", reply, moderate=False)
+    return reply
+
+
+def test_second_claim_fails_while_the_lease_is_live(user):
+    from lliza.models import User
+    from lliza.utils import claim_turn, release_turn
+    claimed_at = claim_turn(user)
+    assert claimed_at is not None
+    assert claim_turn(User.objects.get(pk=user.pk)) is None
+    release_turn(user, claimed_at)
+    assert claim_turn(User.objects.get(pk=user.pk)) is not None
+
+
+def test_expired_lease_can_be_reclaimed(user):
+    from django.utils import timezone
+    from lliza.models import User
+    from lliza.utils import TURN_LEASE_SECONDS, claim_turn, release_turn
+    claimed_at = claim_turn(user)
+    User.objects.filter(pk=user.pk).update(turn_claimed_at=timezone.now() - timedelta(seconds=TURN_LEASE_SECONDS + 1))
+    assert claim_turn(User.objects.get(pk=user.pk)) is not None
+    # The first worker's late release doesn't free the new claim
+    release_turn(user, claimed_at)
+    assert User.objects.get(pk=user.pk).turn_claimed_at is not None
+
+
+def test_texts_arriving_during_a_turn_are_answered_by_its_loop(user):
+    from lliza.models import InboxMessage, User
+    from lliza.utils import add_to_inbox, load_carlbot, run_turns
+
+    def respond_while_texts_arrive(carl, content):
+        if content == "Hello":
+            add_to_inbox(user, "Are you there?")
+            add_to_inbox(user, "I had a bad day")
+        return respond(carl, content)
+
+    add_to_inbox(user, "Hello")
+    assert run_turns(user, respond_while_texts_arrive, coalesce_seconds=0) == [
+        "Reply to Hello", "Reply to Are you there?\nI had a bad day"]
+    user = User.objects.get(pk=user.pk)
+    assert not InboxMessage.objects.exists()
+    assert user.num_messages == 3
+    assert user.turn_claimed_at is None
+    assert [message["content"] for message in load_carlbot(user).dialogue_buffer] == [
+        "Hello", "Reply to Hello", "Are you there?\nI had a bad day", "Reply to Are you there?\nI had a bad day"]
+
+
+def test_texts_are_left_to_the_turn_in_progress(user):
+    from lliza.models import InboxMessage
+    from lliza.utils import add_to_inbox, claim_turn, run_turns
+    claim_turn(user)
+    add_to_inbox(user, "Hello")
+    assert run_turns(user, respond, coalesce_seconds=0) == []
+    assert InboxMessage.objects.count() == 1
+
+
+def test_failed_turn_releases_the_lease_and_keeps_the_texts(user):
+    from lliza.models import InboxMessage, User
+    from lliza.utils import add_to_inbox, run_turns
+
+    def fail(carl, content):
+        raise RuntimeError("OpenAI is down")
+
+    add_to_inbox(user, "Hello")
+    with pytest.raises(RuntimeError):
+        run_turns(user, fail, coalesce_seconds=0)
+    assert User.objects.get(pk=user.pk).turn_claimed_at is None
+    assert InboxMessage.objects.count() == 1
+    assert run_turns(user, respond, coalesce_seconds=0) == ["Reply to Hello"]
@@ -0,0 +1,50 @@
+from datetime import date
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from lliza import usage
+from lliza.usage import UsageMeter
+
+
+def make_usage(prompt_tokens, completion_tokens, cached_tokens=0):
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                           prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens))
+
+
+def test_usage_is_counted_against_the_account():
+    meter = UsageMeter()
+    with usage.account(7):
+        meter.record("generation", "chat-model", make_usage(100, 20, cached_tokens=60))
+        meter.record("generation", "chat-model", make_usage(50, 10))
+        meter.record("moderation", "moderation-model")
+    meter.record("summarization", "summary-model", make_usage(30, 5))
+    counters = meter.drain()
+    today = usage._today()
+    assert counters[(7, today, "generation", "chat-model")] == {
+        "n_calls": 2, "prompt_tokens": 150, "completion_tokens": 30, "cached_tokens": 60}
+    assert counters[(7, today, "moderation", "moderation-model")]["n_calls"] == 1
+    assert counters[(None, today, "summarization", "summary-model")]["prompt_tokens"] == 30
+    assert meter.drain() == {}
+
+
+def test_failed_flush_keeps_counters_for_the_next():
+    meter = UsageMeter()
+    flush = MagicMock(side_effect=[Exception("database down"), None])
+    meter.start_flushing(flush, flush_seconds=3600, log=MagicMock())
+    with patch("lliza.usage._today", return_value=date(2026, 1, 1)):
+        meter.record("generation", "chat-model", make_usage(100, 20))
+        meter.flush()
+        meter.record("generation", "chat-model", make_usage(100, 20))
+        meter.flush()
+    assert flush.call_args[0][0][(None, date(2026, 1, 1), "generation", "chat-model")]["prompt_tokens"] == 200
+    assert meter.drain() == {}
+
+
+def test_usage_is_counted_on_the_day_of_the_call():
+    meter = UsageMeter()
+    with patch("lliza.usage._today", side_effect=[date(2026, 1, 1), date(2026, 1, 2)]):
+        meter.record("generation", "chat-model", make_usage(100, 20))
+        meter.record("generation", "chat-model", make_usage(50, 10))
+    counters = meter.drain()
+    assert counters[(None, date(2026, 1, 1), "generation", "chat-model")]["prompt_tokens"] == 100
+    assert counters[(None, date(2026, 1, 2), "generation", "chat-model")]["prompt_tokens"] == 50